@@ -0,0 +1,31 @@
+# Atomic file writes shared by the record cache, checkpoints, catalogs, master layers and manifests. Every file is written to a
+# temporary file next to its destination and moved into place once complete, so an interrupted write (a killed notebook kernel, a full
+# disk) never leaves a partial file behind for the next run to read.
+import os
+import json
+
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_path(path: str):
+    """Yields a temporary path to write path's contents to, which replaces path once the block completes. Parent folders are created,
+       and the temporary file is removed if the block raises"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp = f'{path}.tmp'
+    try:
+        yield temp
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def write_bytes(path: str, body: bytes):
+    with atomic_path(path) as temp:
+        with open(temp, 'wb') as f:
+            f.write(body)
+
+def write_json(path: str, obj, **kwargs):
+    """Writes obj as JSON, kwargs are passed to json.dump() (i.e. indent, sort_keys)"""
+    with atomic_path(path) as temp:
+        with open(temp, 'w') as f:
+            json.dump(obj, f, **kwargs)
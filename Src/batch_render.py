@@ -0,0 +1,186 @@
+# Headless batch rendering of the aquifer map grid (aquifer x metric x 30/50 x 90/95 dataset, plus the multi-aquifer maps) into
+# Saved_Visuals. Figures are described by FigureSpec objects, rendered with the Agg backend across a process pool, and each worker keeps
+# its reference layers and datasets loaded (see Src/reference.py) from one figure to the next. A manifest next to the images records a
+# fingerprint of every figure's spec and input files (dataset sheet and map layers, by modification time and size), so after a data
+# refresh only the figures whose inputs changed are rendered again.
+#
+# Usage: python -m Src.batch_render [--workers N] [--force] [--output Saved_Visuals]
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import matplotlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+import Src.classes as cl
+import Src.atomic as at
+import Src.func as fn
+import Src.reference as rf
+
+OUTPUT_FOLDER = 'Saved_Visuals'
+MANIFEST_NAME = '_render_manifest.json'
+# (data_range, quantile) of the 4 datasets produced for every aquifer
+DATASETS = [(30, 90), (30, 95), (50, 90), (50, 95)]
+MAP_LAYERS = ['lower48', 'aquifers']
+# Part of every fingerprint, bump it when the figure code changes so every figure is rendered again
+RENDER_VERSION = 2
+MAX_WORKERS = os.cpu_count() or 1
+AQUIFERS_BY_NAME = {aq.name: aq for aq in cl.ALL_AQUIFERS}
+
+class FigureSpec:
+    """A single figure, kind is 'aquifer' (one aquifer's gauges, see fn.aquifer_map()) or 'multi_aquifer' (every aquifer in aquifers on a
+       national map, see fn.multi_aquifer_map()). Aquifers are given by name, see AQUIFERS_BY_NAME"""
+    __slots__ = ('kind', 'aquifers', 'metric', 'data_range', 'quantile', 'basemap', 'show_huc4')
+
+    def __init__(self, kind: str, aquifers: list, metric: str, data_range: int, quantile: int, basemap: bool=False, show_huc4: bool=False):
+        self.kind = kind
+        self.aquifers = list(aquifers)
+        self.metric = metric
+        self.data_range = data_range
+        self.quantile = quantile
+        self.basemap = basemap
+        self.show_huc4 = show_huc4
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def dataset_path(self):
+        if self.kind == 'aquifer':
+            aquifer = AQUIFERS_BY_NAME[self.aquifers[0]]
+            return f'{aquifer.datasets_dir}/{aquifer.name}_{self.data_range}_{self.quantile}'
+        return f'Prelim_Data/National_Metrics_{self.data_range}_{self.quantile}'
+
+    def output_name(self):
+        """Image names follow the ones already in Saved_Visuals, i.e. Central_Valley_30_90_annual_hmf.png"""
+        if self.kind == 'aquifer':
+            return f'{self.aquifers[0]}_{self.data_range}_{self.quantile}_{self.metric}.png'
+        return f'Multi_Aquifer_{self.metric}_{self.data_range}_{self.quantile}.png'
+
+    def inputs(self):
+        layers = MAP_LAYERS + (['huc4'] if self.show_huc4 else [])
+        return [rf.dataset_file(self.dataset_path(), 'site_metrics')] + [rf.LAYERS[name] for name in layers]
+
+    def fingerprint(self):
+        """Hash of the spec, RENDER_VERSION and the modification time and size of every input file"""
+        stats = []
+        for path in self.inputs():
+            stat = os.stat(path) if os.path.exists(path) else None
+            stats.append([path, stat.st_mtime_ns if stat else None, stat.st_size if stat else None])
+        text = json.dumps({'spec': self.as_dict(), 'version': RENDER_VERSION, 'inputs': stats}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+def aquifer_grid(aquifers: list=cl.ALL_AQUIFERS, metrics: list=None, datasets: list=DATASETS, multi: bool=True):
+    """Returns the specs of every aquifer x metric x dataset map, plus a multi-aquifer map per metric and dataset if multi is set. Specs
+       whose dataset has not been generated yet are skipped"""
+    metrics = metrics or list(fn.FLOW_METRIC_UNITS)
+    specs = [FigureSpec('aquifer', [aq.name], metric, data_range, quantile)
+             for aq in aquifers for data_range, quantile in datasets for metric in metrics]
+    if multi:
+        specs += [FigureSpec('multi_aquifer', [aq.name for aq in aquifers], metric, data_range, quantile)
+                  for data_range, quantile in datasets for metric in metrics]
+    available = [spec for spec in specs if os.path.exists(rf.dataset_file(spec.dataset_path(), 'site_metrics'))]
+    if len(available) < len(specs):
+        print(f'Skipping {len(specs) - len(available)} figures without a dataset')
+    return available
+
+def draw(spec: FigureSpec):
+    """Draws a spec's figure and returns it"""
+    df = rf.dataset(spec.dataset_path(), 'site_metrics')
+    df_valid, _ = fn.filter_by_valid(df)
+    df_valid = df_valid.reset_index(drop=True)
+    aquifers = [AQUIFERS_BY_NAME[name] for name in spec.aquifers]
+    if spec.kind == 'aquifer':
+        fig, _ = fn.aquifer_map(df_valid, aquifers[0], spec.metric, f'{spec.aquifers[0]}_{spec.data_range}_{spec.quantile}',
+                                basemap=spec.basemap)
+    else:
+        title = f'Multi-Aquifer {spec.metric} Plot for {spec.data_range} Years & {spec.quantile}th Quantile'
+        fig, _ = fn.multi_aquifer_map(df_valid, aquifers, spec.metric, title, show_huc4=spec.show_huc4, basemap=spec.basemap)
+    return fig
+
+def render(spec: FigureSpec, output_folder: str=OUTPUT_FOLDER):
+    """Renders a spec to its image. Errors are returned rather than raised so one missing dataset does not stop the pool"""
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    fingerprint = spec.fingerprint()
+    path = os.path.join(output_folder, spec.output_name())
+    try:
+        fig = draw(spec)
+        fig.savefig(path)
+        plt.close(fig)
+        error = None
+    except Exception as e:
+        plt.close('all')
+        error = f'{type(e).__name__}: {e}'
+    return {'path': path, 'fingerprint': fingerprint, 'seconds': time.perf_counter() - start, 'error': error}
+
+def init_worker(layers: list=MAP_LAYERS):
+    """Switches a worker to the Agg backend and loads the map layers once, every figure the worker renders then reuses them"""
+    matplotlib.use('Agg', force=True)
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    for name in layers:
+        rf.layer(name)
+
+def load_manifest(output_folder: str):
+    path = os.path.join(output_folder, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest: dict, output_folder: str):
+    at.write_json(os.path.join(output_folder, MANIFEST_NAME), manifest, indent=1, sort_keys=True)
+
+def stale_specs(specs: list, output_folder: str=OUTPUT_FOLDER, force: bool=False):
+    """Returns the specs whose image is missing or whose fingerprint differs from the one it was last rendered with"""
+    manifest = load_manifest(output_folder)
+    return [spec for spec in specs if force or not os.path.exists(os.path.join(output_folder, spec.output_name()))
+            or manifest.get(spec.output_name()) != spec.fingerprint()]
+
+def render_figures(specs: list, output_folder: str=OUTPUT_FOLDER, workers: int=MAX_WORKERS, force: bool=False):
+    """Renders every stale spec (all of them if force is set) across workers processes, workers <= 1 renders in this process. The
+       manifest is updated as figures finish, so an interrupted batch only renders the rest when run again. Returns the render results"""
+    os.makedirs(output_folder, exist_ok=True)
+    todo = stale_specs(specs, output_folder, force)
+    # Figures of the same dataset are kept together so each worker's chunk reads its dataset once
+    todo.sort(key=lambda spec: (spec.dataset_path(), spec.kind, spec.output_name()))
+    print(f'Rendering {len(todo)} of {len(specs)} figures ({len(specs) - len(todo)} up to date)')
+
+    manifest = load_manifest(output_folder)
+    results = []
+    if workers <= 1 or len(todo) <= 1:
+        result_iter = (render(spec, output_folder) for spec in todo)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+        chunksize = max(1, len(todo) // (4 * workers))
+        result_iter = executor.map(render, todo, [output_folder] * len(todo), chunksize=chunksize)
+    try:
+        for spec, result in zip(todo, result_iter):
+            results.append(result)
+            if result['error'] is not None:
+                print(f"ERROR: {spec.output_name()}: {result['error']}")
+                continue
+            manifest[spec.output_name()] = result['fingerprint']
+            save_manifest(manifest, output_folder)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the aquifer map grid into Saved_Visuals')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--force', action='store_true', help='render every figure, even those that are up to date')
+    parser.add_argument('--output', default=OUTPUT_FOLDER)
+    args = parser.parse_args()
+
+    matplotlib.use('Agg')
+    start = time.perf_counter()
+    results = render_figures(aquifer_grid(), args.output, args.workers, args.force)
+    failed = sum(result['error'] is not None for result in results)
+    print(f'Rendered {len(results) - failed} figures in {time.perf_counter() - start:.1f}s, {failed} failed')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,476 @@
+# Offline benchmarks for the HMF analysis pipeline. Synthetic daily discharge records (log-normal flow with a seasonal cycle, multi-day
+# persistence, gaps, missing values and a few years of tidal 72137_Mean overlap) stand in for NWIS records, so every public function in
+# Src/func.py and the end to end merge_tidal() -> single_site_data() path can be timed at 1, 100 and 10,000 sites and 30, 50 and 120 year
+# records without network access. Throughput (sites/s) and peak traced memory are compared against a stored baseline, and the run exits
+# with status 1 if any case regresses by more than the tolerance.
+#
+# Usage: python -m Src.benchmark [--sites 1 100 10000] [--years 30 50 120] [--only single_site_data hmf_kernel] [--budget 5]
+#                                [--baseline path] [--tolerance 0.5] [--save-baseline]
+import os
+import io
+import sys
+import json
+import time
+import inspect
+import warnings
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import shapely
+
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from scipy.signal import lfilter
+
+import Src.func as fn
+import Src.atomic as at
+import Src.classes as cl
+
+SITE_COUNTS = [1, 100, 10000]
+RECORD_YEARS = [30, 50, 120]
+BASELINE_PATH = 'Prelim_Data/_Benchmarks/baseline.json'
+# Allowed slowdown in throughput (and growth in peak memory) before a case counts as a regression. Individual cases vary by up to about
+# 30% between runs on a busy machine, even after calibration, so this only catches real slowdowns
+TOLERANCE = 0.5
+# Baseline/results entry holding the calibrate() speed
+CALIBRATION_KEY = 'calibration'
+# Peak memory differences below this are noise from interpreter/library caches rather than regressions
+MEMORY_SLACK_MB = 1.0
+# Seconds each case may spend before its throughput is taken from the sites completed so far
+BUDGET_SECONDS = 5.0
+# Shortest timed window, quick cases are repeated until it is filled so single calls are not dominated by timer noise
+MIN_SECONDS = 0.2
+# Number of min_seconds windows each case is timed over, the best window is reported
+WINDOWS = 3
+# Distinct synthetic records per record length, larger site counts cycle through them
+POOL_SIZE = 16
+# Largest sites x days flow matrix the batched cases are run with (5e7 cells is 400 MB of float64)
+MAX_BATCH_CELLS = 5e7
+# Years at the end of each record with tidal data, and how many of those the stream gauge also covers
+TIDAL_YEARS = 5
+TIDAL_OVERLAP_YEARS = 3
+# Rough lower 48 extent (lon_min, lat_min, lon_max, lat_max) for synthetic gauge locations and region layers
+CONUS_BOUNDS = (-124.0, 25.0, -67.0, 49.0)
+
+#--------------------------------------#
+#-------# SYNTHETIC FLOW RECORDS #------#
+#--------------------------------------#
+
+def synthetic_record(site_no: str, years: int, seed: int=0, end: str=fn.DEFAULT_END, gaps: bool=True, tidal: bool=True):
+    """Creates a get_record() style frame (after reset_index()) with years of daily discharge ending at end. Log flows follow an AR(1)
+       process around a seasonal cycle, a few gaps are cut out of the record, some values are missing, and the last TIDAL_YEARS are
+       reported as tidal 72137_Mean with the stream gauge stopping TIDAL_OVERLAP_YEARS into them"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(end=end, periods=int(round(365.25 * years)), freq='D', tz='UTC')
+    season = 1 + 0.8 * np.sin(2 * np.pi * (dates.dayofyear.values - 30) / 365.25)
+    log_flow = lfilter([np.sqrt(1 - 0.9 ** 2)], [1, -0.9], rng.normal(0, 1, len(dates)))
+    flow = np.round(np.exp(rng.normal(3, 0.5) + log_flow) * season, 2)
+    df = pd.DataFrame({'datetime': dates, 'site_no': site_no, '00060_Mean': flow, '00060_Mean_cd': 'A'})
+
+    if tidal:
+        tidal_start = len(df) - int(365.25 * TIDAL_YEARS)
+        stream_end = tidal_start + int(365.25 * TIDAL_OVERLAP_YEARS)
+        df['72137_Mean'] = np.nan
+        df.loc[tidal_start:, '72137_Mean'] = np.round(flow[tidal_start:] * rng.normal(1, 0.05, len(df) - tidal_start), 2)
+        df.loc[stream_end:, '00060_Mean'] = np.nan
+        df['72137_Mean_cd'] = np.where(df['72137_Mean'].notna(), 'A', None)
+
+    df.loc[rng.choice(len(df), len(df) // 1000, replace=False), '00060_Mean'] = np.nan
+    if gaps:
+        keep = np.ones(len(df), dtype=bool)
+        for start in rng.integers(0, len(df) - 200, size=max(1, years // 10)):
+            keep[start:start + rng.integers(10, 150)] = False
+        df = df[keep].reset_index(drop=True)
+    return df
+
+def tied_record(site_no: str, years: int, seed: int=0, end: str=fn.DEFAULT_END):
+    """Creates a get_record() style frame in which every water year holds the same daily flows in a different order (leap days adding
+       a zero flow day), so the annual HMF volumes of every full water year are equal and only a sum matching the pandas one keeps them
+       tied"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(end=end, periods=int(round(365.25 * years)), freq='D', tz='UTC')
+    water_year, _ = fn.water_year_calendar(dates.values)
+    days = np.round(np.exp(rng.normal(3, 1, 366)), 2)
+    days[-1] = 0.0
+    flow = np.concatenate([rng.permutation(days[:count]) for count in np.unique(water_year, return_counts=True)[1]])
+    return pd.DataFrame({'datetime': dates, 'site_no': site_no, '00060_Mean': flow, '00060_Mean_cd': 'A'})
+
+def prepare_site(raw: pd.DataFrame, years: int):
+    """Runs the pipeline once (untimed) to build the inputs of every per-site case from a synthetic_record() frame"""
+    df = fn.merge_tidal(raw.copy())
+    threshold = fn.calc_threshold(df, fn.QUANTILE)
+    defl, cont = fn.filter_hmf(df, threshold)
+    record = cl.FlowRecord.from_frame(df)
+    excess = np.where(record.flow >= threshold, (record.flow - threshold) * fn.SEC_PER_DAY, 0.0)
+    _, series = fn.hmf_kernel(record, fn.QUANTILE, threshold)
+    pairs = [series[name] for name in fn.MK_SERIES]
+    site_rows, mk_rows = fn.site_records(record)
+    return {
+        'years': years, 'raw': raw, 'df': df, 'threshold': threshold, 'defl': defl, 'cont': cont, 'record': record, 'excess': excess,
+        'defl_hmf': fn.convert_hmf(defl.copy(), threshold), 'cont_hmf': fn.convert_hmf(cont.copy(), threshold),
+        'hmf_years': fn.num_hmf_years(defl), 'pairs': pairs, 'mk_frame': fn.mann_kendall(*pairs[0], fn.MK_TREND_ALPHA),
+        'site_rows': site_rows, 'mk_rows': mk_rows, 'start': pd.to_datetime(fn.DEFAULT_END) - pd.DateOffset(years=years),
+    }
+
+def site_pool(years: int, size: int=POOL_SIZE):
+    """Returns size prepared synthetic sites with years long records"""
+    return [prepare_site(synthetic_record(f'{i:08d}', years, seed=i), years) for i in range(size)]
+
+def synthetic_layer(num_cells: int, column: str, bounds: tuple=CONUS_BOUNDS, crs: int=4269):
+    """Returns a GeoDataFrame tiling bounds with about num_cells square polygons, labelled '01', '02', ... in column"""
+    side = max(1, int(np.ceil(np.sqrt(num_cells))))
+    xs, ys = np.linspace(bounds[0], bounds[2], side + 1), np.linspace(bounds[1], bounds[3], side + 1)
+    cells = [shapely.box(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(side) for j in range(side)]
+    return gpd.GeoDataFrame({column: [f'{k + 1:02d}' for k in range(len(cells))]}, geometry=cells, crs=crs)
+
+def prepare_tables(pool: list, num_sites: int, seed: int=0):
+    """Builds num_sites worth of site metric and MK tables (every data range and quantile, as the national run produces) from the pool,
+       with unique site numbers, gauge coordinates, a synthetic region layer per label column and a flow line layer"""
+    rng = np.random.default_rng(seed)
+    metric_rows, mk_rows = [], {name: [] for name in fn.MK_SERIES}
+    for i in range(num_sites):
+        site = pool[i % len(pool)]
+        site_no = f'{i:08d}'
+        metric_rows.extend({**row, 'site_no': site_no} for row in site['site_rows'])
+        for name in fn.MK_SERIES:
+            mk_rows[name].extend({**row, 'site_no': site_no} for row in site['mk_rows'][name])
+
+    df_metrics = pd.DataFrame(metric_rows, columns=fn.SITE_METRIC_COLS + fn.MONTHLY_HMF_COLS)
+    lons = rng.uniform(CONUS_BOUNDS[0], CONUS_BOUNDS[2], num_sites)
+    lats = rng.uniform(CONUS_BOUNDS[1], CONUS_BOUNDS[3], num_sites)
+    df_metrics['dec_long_va'] = np.repeat(lons, len(pool[0]['site_rows']))
+    df_metrics['dec_lat_va'] = np.repeat(lats, len(pool[0]['site_rows']))
+    frames = [df_metrics] + [pd.DataFrame(mk_rows[name], columns=['dataset_ID', 'site_no'] + fn.MK_COLS) for name in fn.MK_SERIES]
+
+    huc2 = synthetic_layer(18, 'huc2_code')
+    huc4 = synthetic_layer(max(18, num_sites // 10), 'huc4_code')
+    aquifers = synthetic_layer(8, 'aq_name').iloc[::2]
+    lines = gpd.GeoDataFrame(geometry=gpd.GeoSeries(shapely.box(lons - 0.1, lats - 0.1, lons + 0.1, lats + 0.1), crs=4269).boundary)
+    return {'frames': frames, 'lons': lons, 'lats': lats, 'huc2': huc2, 'huc4': huc4, 'aquifers': aquifers, 'lines': lines}
+
+#--------------------------------#
+#-------# BENCHMARK CASES #------#
+#--------------------------------#
+
+@contextmanager
+def in_directory(path: str):
+    """Temporarily changes the working directory, for the functions which write to fixed relative paths (i.e. save_data())"""
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def _plot(draw):
+    """Runs draw(ax) on a new Agg figure and closes it"""
+    fig, ax = plt.subplots()
+    try:
+        draw(ax)
+        fig.canvas.draw()
+    finally:
+        plt.close(fig)
+
+def _report(df: pd.DataFrame):
+    with redirect_stdout(io.StringIO()):
+        fn.single_site_report(df)
+
+def _save_plot(tables: dict):
+    fig, _ = plt.subplots()
+    fn.save_plot_as_image('figure.png', overwrite=True)
+    plt.close(fig)
+
+# Cases run once per site against a prepare_site() dict, so throughput scales with the site count. Functions which modify their input
+# (merge_tidal(), convert_hmf()) are given a copy
+SITE_CASES = {
+    'merge_tidal': lambda s: fn.merge_tidal(s['raw'].copy()),
+    'validate': lambda s: fn.validate(s['df'], s['start'], fn.DEFAULT_END),
+    'calc_threshold': lambda s: fn.calc_threshold(s['df'], fn.QUANTILE),
+    'filter_hmf': lambda s: fn.filter_hmf(s['df'], s['threshold']),
+    'convert_hmf': lambda s: fn.convert_hmf(s['cont'].copy(), s['threshold']),
+    'monthly_hmf': lambda s: fn.monthly_hmf(s['defl_hmf'], s['years'], fn.QUANTILE),
+    'num_hmf_years': lambda s: fn.num_hmf_years(s['defl']),
+    'three_six_range': lambda s: fn.three_six_range(s['defl'], 12, 2, 11, 4),
+    'calc_inter_annual': lambda s: fn.calc_inter_annual(s['df'], s['hmf_years']),
+    'calc_duration_intra_annual': lambda s: fn.calc_duration_intra_annual(s['cont_hmf'], s['hmf_years']),
+    'calc_oneday_peaks': lambda s: fn.calc_oneday_peaks(s['df']),
+    'calc_timing': lambda s: fn.calc_timing(s['defl_hmf']),
+    'convert_cubic_ft_hm': lambda s: fn.convert_cubic_ft_hm(s['excess']),
+    'mann_kendall': lambda s: fn.mann_kendall(*s['pairs'][0], fn.MK_TREND_ALPHA),
+    'mann_kendall_row': lambda s: fn.mann_kendall_row(*s['pairs'][0], fn.MK_TREND_ALPHA),
+    'mk_score_batch': lambda s: fn.mk_score_batch([series for pair in s['pairs'] for series in pair]),
+    'mk_variance_batch': lambda s: fn.mk_variance_batch([series for pair in s['pairs'] for series in pair]),
+    'sens_slope_batch': lambda s: fn.sens_slope_batch([series for pair in s['pairs'] for series in pair]),
+    'mk_test_batch': lambda s: fn.mk_test_batch([series for pair in s['pairs'] for series in pair], fn.MK_TREND_ALPHA),
+    'mann_kendall_rows': lambda s: fn.mann_kendall_rows(s['pairs'], fn.MK_TREND_ALPHA),
+    'water_year_calendar': lambda s: fn.water_year_calendar(s['record'].dates),
+    'as_flow_record': lambda s: fn.as_flow_record(s['df']),
+    'as_frame': lambda s: fn.as_frame(s['record']),
+    'hmf_excess': lambda s: fn.hmf_excess(s['record'].flow, s['threshold']),
+    'hmf_events': lambda s: fn.hmf_events(s['excess'], s['record'].year_idx),
+    'events_table': lambda s: fn.events_table(s['record'], fn.QUANTILE, s['threshold']),
+    'group_sum': lambda s: fn.group_sum(s['excess'], s['record'].year_idx, len(s['record'].years)),
+    'hmf_kernel': lambda s: fn.hmf_kernel(s['record'], fn.QUANTILE, s['threshold']),
+    'plan_scenarios': lambda s: fn.plan_scenarios(s['record'].dates),
+    'site_records': lambda s: fn.site_records(s['record']),
+    'single_site_data': lambda s: fn.single_site_data(fn.merge_tidal(s['raw'].copy())),
+    'merge_mk_results': lambda s: fn.merge_mk_results(pd.DataFrame(), s['mk_frame'].copy(), s['record'].site_no, s['years'], fn.QUANTILE),
+    'create_state_uri': lambda s: fn.create_state_uri(fn.STATE_CODE, fn.PARAM_CODE),
+}
+
+# Cases run once over every site's record together (the batched engine)
+BATCH_CASES = {
+    'build_flow_matrix': lambda b: fn.build_flow_matrix(b['records']),
+    'batch_site_metrics': lambda b: fn.batch_site_metrics(*b['matrix'], b['years'], fn.QUANTILE, b['present']),
+    'batch_site_data': lambda b: fn.batch_site_data(b['records']),
+}
+
+# Cases run once over num_sites rows of output tables or gauge locations, which do not depend on the record length
+TABLE_CASES = {
+    'filter_by_valid': lambda t: fn.filter_by_valid(t['frames'][0]),
+    'gages_2_filtering': lambda t: fn.gages_2_filtering(t['frames'][0].copy()),
+    'region_labels': lambda t: fn.region_labels(t['lons'], t['lats'], t['huc4'], 'huc4_code'),
+    'assign_regions': lambda t: fn.assign_regions(t['lons'], t['lats'], t['huc2'], t['huc4'], t['aquifers']),
+    'write_dataset': lambda t: fn.write_dataset(dict(zip(fn.SHEET_NAMES, t['frames'])), 'dataset'),
+    'load_data': lambda t: fn.load_data('dataset'),
+    'save_data': lambda t: fn.save_data(*t['frames'], 'Benchmark'),
+    'single_site_report': lambda t: _report(t['frames'][0]),
+    'convert_geometry': lambda t: fn.convert_geometry(t['frames'][0]),
+    'scale_colorbar': lambda t: fn.scale_colorbar(t['frames'][0], 'annual_hmf'),
+    'set_plot_bounds': lambda t: fn.set_plot_bounds(t['huc4']),
+    'save_plot_as_image': _save_plot,
+    'plot_lower_48': lambda t: _plot(fn.plot_lower_48),
+    'plot_rateb_aquifers': lambda t: _plot(fn.plot_rateb_aquifers),
+    'plot_aquifers': lambda t: _plot(fn.plot_aquifers),
+    'plot_stream_network': lambda t: _plot(lambda ax: fn.plot_stream_network(t['lines'], ax)),
+    'plot_huc2': lambda t: _plot(lambda ax: fn.plot_huc2(ax, t['huc2'])),
+    'plot_huc4': lambda t: _plot(lambda ax: fn.plot_huc4(ax, t['huc4'])),
+}
+
+# Table cases which write files, these are run from a temporary directory
+WRITE_CASES = {'write_dataset', 'load_data', 'save_data', 'save_plot_as_image'}
+
+# Public functions which are deliberately not benchmarked
+SKIPPED = {
+    'plot_basemap': 'reads map tiles from the tile store, see python -m Src.tile_cache benchmark',
+    'aquifer_map': 'draws a full figure from the plot_* cases above and the real aquifer layer',
+    'multi_aquifer_map': 'draws a full figure from the plot_* cases above and the real aquifer layer',
+}
+
+def uncovered():
+    """Returns the public Src/func.py functions which have neither a benchmark case nor a SKIPPED entry"""
+    cases = set(SITE_CASES) | set(BATCH_CASES) | set(TABLE_CASES) | set(SKIPPED)
+    names = [name for name, obj in inspect.getmembers(fn, inspect.isfunction) if obj.__module__ == fn.__name__]
+    # Plotting and geospatial helpers are only attributes of fn once they have been used
+    names += [name for name in fn.LAZY_ATTRS if inspect.isfunction(getattr(fn, name))]
+    return [name for name in dict.fromkeys(names) if not name.startswith('_') and name not in cases]
+
+#-------------------------------------#
+#-------# TIMING AND BASELINES #------#
+#-------------------------------------#
+
+def peak_memory(run, arg):
+    """Returns the peak traced memory (MB) of a single run(arg) call"""
+    tracemalloc.start()
+    try:
+        run(arg)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+def time_site_case(run, pool: list, num_sites: int, budget: float=BUDGET_SECONDS, min_seconds: float=MIN_SECONDS):
+    """Runs a per-site case over num_sites sites (cycling through the pool), and on past num_sites for at least WINDOWS x min_seconds,
+       stopping early once budget seconds have passed. Returns the number of sites run, the elapsed seconds and the best throughput
+       over any min_seconds window, which is far less sensitive to other load on the machine than the overall mean"""
+    done = window_done = 0
+    best = 0.0
+    start = window_start = time.perf_counter()
+    while True:
+        run(pool[done % len(pool)])
+        done += 1
+        window_done += 1
+        now = time.perf_counter()
+        if now - window_start >= min_seconds or done == num_sites:
+            best = max(best, window_done / (now - window_start))
+            window_done, window_start = 0, now
+        if now - start > budget or (done >= num_sites and now - start >= WINDOWS * min_seconds):
+            return done, now - start, max(best, window_done / (now - window_start)) if window_done else best
+
+def time_repeated(run, arg, num_sites: int, budget: float=BUDGET_SECONDS, min_seconds: float=MIN_SECONDS):
+    """Runs a whole-batch case at least once and until WINDOWS x min_seconds have passed (or the budget runs out). Returns the number of
+       sites run (num_sites per call), the elapsed seconds and the throughput of the fastest call"""
+    calls = 0
+    fastest = float('inf')
+    start = time.perf_counter()
+    while True:
+        call_start = time.perf_counter()
+        run(arg)
+        calls += 1
+        now = time.perf_counter()
+        fastest = min(fastest, now - call_start)
+        if now - start >= min(budget, WINDOWS * min_seconds):
+            return calls * num_sites, now - start, num_sites / fastest
+
+def calibrate(rounds: int=5):
+    """Returns the speed (runs/s, best of rounds) of a fixed pandas/numpy workload. Results are compared relative to it so a machine which
+       is uniformly slower or busier than when the baseline was stored does not show up as a regression"""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'key': rng.integers(0, 100, 100000), 'value': rng.normal(0, 1, 100000)})
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        np.sort(df['value'].to_numpy())
+        df.groupby('key')['value'].median()
+        df['value'].apply(lambda x: x if x > 0 else 0)
+        best = min(best, time.perf_counter() - start)
+    return 1 / best
+
+def result_key(name: str, num_sites: int, years: int):
+    return f'{name}|{num_sites}|{years}'
+
+def run_benchmarks(site_counts: list=SITE_COUNTS, record_years: list=RECORD_YEARS, only: list=None, budget: float=BUDGET_SECONDS,
+                   max_cells: float=MAX_BATCH_CELLS):
+    """Runs every selected case at every site count and record length, printing one line per run. Returns {result_key(): result}"""
+    selected = lambda cases: {name: run for name, run in cases.items() if not only or name in only}
+    site_cases, batch_cases, table_cases = selected(SITE_CASES), selected(BATCH_CASES), selected(TABLE_CASES)
+    results = {}
+    calibration = calibrate()
+
+    def record(name, num_sites, years, memory, sites_run, seconds, sites_per_sec):
+        result = {'sites': num_sites, 'years': years, 'sites_run': sites_run, 'seconds': seconds, 'sites_per_sec': sites_per_sec,
+                  'peak_mb': memory}
+        results[result_key(name, num_sites, years)] = result
+        print(f'{name:<28} {num_sites:>6} sites {years:>4} yrs  {result["sites_per_sec"]:>12.1f} sites/s  '
+              f'{memory:>9.1f} MB peak  ({sites_run} sites in {seconds:.2f}s)')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for y, years in enumerate(record_years):
+            pool = site_pool(years)
+            for num_sites in site_counts:
+                for name, run in site_cases.items():
+                    # The memory pass also warms up any caches before timing
+                    memory = peak_memory(run, pool[0])
+                    record(name, num_sites, years, memory, *time_site_case(run, pool, num_sites, budget))
+
+                if batch_cases:
+                    records = [pool[i % len(pool)]['record'] for i in range(num_sites)]
+                    cells = num_sites * 365.25 * years
+                    if cells > max_cells:
+                        print(f'Skipping batched cases at {num_sites} sites x {years} years ({cells:.2g} cells > {max_cells:.2g})')
+                    else:
+                        site_nos, flow, present, dates = fn.build_flow_matrix(records)
+                        batch = {'records': records, 'years': years, 'matrix': (site_nos, flow, dates), 'present': present}
+                        for name, run in batch_cases.items():
+                            memory = peak_memory(run, batch)
+                            record(name, num_sites, years, memory, *time_repeated(run, batch, num_sites, budget))
+                        del batch, flow, present
+
+                # Output tables do not depend on the record length, so they are only run with the first one
+                if table_cases and y == 0:
+                    tables = prepare_tables(pool, num_sites)
+                    # The dataset load_data() reads back
+                    fn.write_dataset(dict(zip(fn.SHEET_NAMES, tables['frames'])), os.path.join(tmp_dir, 'dataset'))
+                    for name, run in table_cases.items():
+                        with in_directory(tmp_dir) if name in WRITE_CASES else nullcontext():
+                            memory = peak_memory(run, tables)
+                            record(name, num_sites, years, memory, *time_repeated(run, tables, num_sites, budget))
+    # Calibrated before and after the run so load changing part way through is averaged out
+    results[CALIBRATION_KEY] = (calibration + calibrate()) / 2
+    return results
+
+def load_baseline(path: str=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(results: dict, path: str=BASELINE_PATH):
+    """Writes results to the baseline, keeping the baseline entries of cases which were not run"""
+    baseline = {**load_baseline(path), **results}
+    at.write_json(path, baseline, indent=1, sort_keys=True)
+
+def regressions(results: dict, baseline: dict, tolerance: float=TOLERANCE):
+    """Returns a message for every result whose throughput dropped, or whose peak memory grew, by more than tolerance against the baseline"""
+    messages = []
+    # Baseline throughput rescaled to this machine's current speed
+    speed = results[CALIBRATION_KEY] / baseline[CALIBRATION_KEY] if CALIBRATION_KEY in results and CALIBRATION_KEY in baseline else 1.0
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None or key == CALIBRATION_KEY:
+            continue
+        if result['sites_per_sec'] < base['sites_per_sec'] * speed * (1 - tolerance):
+            messages.append(f'{key}: {result["sites_per_sec"]:.1f} sites/s vs {base["sites_per_sec"] * speed:.1f} baseline '
+                            f'(machine speed {speed:.2f}x)')
+        if result['peak_mb'] > base['peak_mb'] * (1 + tolerance) + MEMORY_SLACK_MB:
+            messages.append(f'{key}: {result["peak_mb"]:.1f} MB peak vs {base["peak_mb"]:.1f} MB baseline')
+    return messages
+
+#--------------------------------#
+#-------# BASELINE CHECKS #------#
+#--------------------------------#
+
+def baseline_mismatches(years: int=30, seeds: int=5, quantile: float=fn.QUANTILE):
+    """Compares hmf_kernel()'s annual HMF series with the pandas chain it replaced (filter_hmf() -> convert_hmf() ->
+       resample(HYDRO_YEAR).sum()) on tied_record()s. The MK magnitude test ranks these sums, so they must match to the bit rather than
+       to a tolerance. Returns a message per mismatching record"""
+    mismatches = []
+    for seed in range(seeds):
+        df = fn.merge_tidal(tied_record(f'{seed:08d}', years, seed))
+        threshold = fn.calc_threshold(df, quantile)
+        _, cont = fn.filter_hmf(df, threshold)
+        cont = fn.convert_hmf(cont, threshold).set_index('datetime')['00060_Mean']
+        # HYDRO_YEAR's 'AS-OCT' alias is deprecated in newer pandas
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            expected = (cont.where(cont >= 0, 0) * fn.CUBIC_FT_KM_FACTOR).resample(fn.HYDRO_YEAR).sum().to_numpy()
+        _, series = fn.hmf_kernel(cl.FlowRecord.from_frame(df), quantile, threshold)
+        if not np.array_equal(series['magnitude'][1], expected):
+            mismatches.append(f'Annual HMF of tied record {seed} differs from the pandas sum in '
+                              f'{np.sum(series["magnitude"][1] != expected)} of {len(expected)} water years')
+    return mismatches
+
+def main(argv: list=None):
+    parser = argparse.ArgumentParser(prog='python -m Src.benchmark', description='Synthetic-data benchmarks for the HMF analysis pipeline')
+    parser.add_argument('--sites', type=int, nargs='+', default=SITE_COUNTS)
+    parser.add_argument('--years', type=int, nargs='+', default=RECORD_YEARS)
+    parser.add_argument('--only', nargs='+', help='case (function) names to run, all by default')
+    parser.add_argument('--budget', type=float, default=BUDGET_SECONDS, help='seconds per per-site case before it stops early')
+    parser.add_argument('--max-cells', type=float, default=MAX_BATCH_CELLS, help='largest sites x days matrix for the batched cases')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline instead of comparing')
+    args = parser.parse_args(argv)
+
+    missing = uncovered()
+    if missing:
+        print(f'WARNING: No benchmark case for {", ".join(missing)}')
+
+    mismatches = baseline_mismatches()
+    for message in mismatches:
+        print(f'MISMATCH: {message}')
+    if mismatches:
+        return 1
+
+    plt.switch_backend('Agg')
+    results = run_benchmarks(args.sites, args.years, args.only, args.budget, args.max_cells)
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f'Saved {len(results) - 1} results to {args.baseline}')
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if not baseline:
+        print(f'No baseline at {args.baseline}, run with --save-baseline to store one')
+        return 0
+    failed = regressions(results, baseline, args.tolerance)
+    for message in failed:
+        print(f'REGRESSION: {message}')
+    print(f'{len(failed)} regressions across {len(results) - 1} results (tolerance {args.tolerance:.0%})')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
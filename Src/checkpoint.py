@@ -0,0 +1,74 @@
+# Append-only checkpoints for long multi-site runs. Site results are written out as numbered Parquet parts every few sites so a run
+# which dies part way (network error, kernel restart, out of memory) can skip every completed site on restart instead of starting over.
+# Each part holds one file per output table plus a 'sites' file which is written last and marks the part as complete, so a part
+# interrupted mid-write is ignored and rewritten.
+#
+# Layout: <CHECKPOINT_DIR>/<name>/<table>/part-00000.parquet
+import os
+import shutil
+import pandas as pd
+
+import Src.func as fn
+import Src.atomic as at
+import Src.site_runner as sr
+import Src.tracing as tr
+
+CHECKPOINT_DIR = 'Prelim_Data/_Checkpoints'
+# Number of sites per Parquet part
+PART_SIZE = 50
+# Same table order (and names) as the sheets written by fn.save_data()
+TABLES = ['site_metrics'] + [f'mk_{name}' for name in fn.MK_SERIES]
+SITES_TABLE = 'sites'
+
+def part_path(name: str, table: str, part: int, root: str=None):
+    """Returns the Parquet path of a single table part"""
+    return os.path.join(root or CHECKPOINT_DIR, name, table, f'part-{part:05d}.parquet')
+
+def completed_parts(name: str, root: str=None):
+    """Returns the sorted numbers of every completed part"""
+    sites_dir = os.path.join(root or CHECKPOINT_DIR, name, SITES_TABLE)
+    if not os.path.isdir(sites_dir):
+        return []
+    return sorted(int(f[5:10]) for f in os.listdir(sites_dir) if f.startswith('part-') and f.endswith('.parquet'))
+
+def completed_sites(name: str, root: str=None):
+    """Returns the set of site numbers already checkpointed, including sites whose analysis failed"""
+    parts = [pd.read_parquet(part_path(name, SITES_TABLE, part, root)) for part in completed_parts(name, root)]
+    return set(pd.concat(parts)['site_no']) if parts else set()
+
+@tr.traced('checkpoint')
+def write_part(name: str, results: list, root: str=None):
+    """Writes a list of sr.analyze_site() results as the next part. Table files are written first and the sites file last"""
+    parts = completed_parts(name, root)
+    part = parts[-1] + 1 if parts else 0
+    frames = sr.results_to_frames(results)
+    df_sites = pd.DataFrame({'site_no': [r['site_no'] for r in results], 'error': [r['error'] for r in results]})
+
+    for table, df in zip(TABLES + [SITES_TABLE], list(frames) + [df_sites]):
+        path = part_path(name, table, part, root)
+        with at.atomic_path(path) as temp:
+            df.to_parquet(temp, index=False)
+    return part
+
+def checkpointed(results, name: str, part_size: int=PART_SIZE, root: str=None):
+    """Passes sr.iter_site_results() results straight through while writing them out every part_size sites (and once more at the end)"""
+    buffer = []
+    for result in results:
+        buffer.append(result)
+        if len(buffer) >= part_size:
+            write_part(name, buffer, root)
+            buffer = []
+        yield result
+    if buffer:
+        write_part(name, buffer, root)
+
+def read_checkpoint(name: str, root: str=None):
+    """Returns the site metric frame and the 6 MK frames (same order as fn.single_site_data()) across every completed part"""
+    parts = completed_parts(name, root)
+    if not parts:
+        return sr.results_to_frames([])
+    return tuple(pd.concat([pd.read_parquet(part_path(name, table, part, root)) for part in parts], ignore_index=True) for table in TABLES)
+
+def clear_checkpoint(name: str, root: str=None):
+    """Deletes a checkpoint so the next run starts from the beginning"""
+    shutil.rmtree(os.path.join(root or CHECKPOINT_DIR, name), ignore_errors=True)
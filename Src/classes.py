@@ -1,3 +1,8 @@
+import numpy as np
+import pandas as pd
+
+import Src.func as fn
+
 # Streamgauge class used solely for early testing
 class StreamGauge:
     def __init__(self, id, name, mean_start_date, mean_end_date, post_start_date, post_end_date):
@@ -16,11 +21,12 @@ SJTB_Guage = StreamGauge('11303500', 'SAN JOAQUIN R NR VERNALIS CA', '1923-10-01
         
 # Aquifer class used for aquifer analysis
 class Aquifer():
-    def __init__(self, name, datasets_dir, huc2s, huc4s):
+    def __init__(self, name, datasets_dir, huc2s, huc4s, aq_names=[]):
         self.name = name # Aquifer name
         self.datasets_dir = datasets_dir
         self.huc2s = huc2s
         self.huc4s = huc4s
+        self.aq_names = list(aq_names) # Names of the aquifer's outlines in the master aquifer layer (USGS principal aquifers)
 
 # Aquifer Definitions for Aquifer Analysis
 upper_clairborne_aquifer = Aquifer(
@@ -28,6 +34,7 @@ upper_clairborne_aquifer = Aquifer(
     datasets_dir = "Prelim_Data/Upper_Clairborne",
     huc2s = [],
     huc4s = ['0315', '0316', '0317', '0318', '0514', '0604', '0714', '0801', '0802', '0803', '0804', '0805', '0806', '1101', '1111', '1114'],
+    aq_names = ['Mississippi embayment aquifer system'],
 )
 
 central_valley_aquifer = Aquifer(
@@ -35,6 +42,7 @@ central_valley_aquifer = Aquifer(
     datasets_dir = f"Prelim_Data/Central_Valley",
     huc2s = [],
     huc4s = ['1802', '1803', '1804', '1805'],
+    aq_names = ['Central Valley aquifer system'],
 )  
 
 columbia_plateau_aquifer = Aquifer(
@@ -42,6 +50,7 @@ columbia_plateau_aquifer = Aquifer(
     datasets_dir = "Prelim_Data/Columbia_Plateau",
     huc2s = [],
     huc4s = ['1701', '1702', '1703', '1705', '1706', '1707'],
+    aq_names = ['Columbia Plateau basaltic-rock aquifers'],
 )
 
 high_plains_aquifer = Aquifer(
@@ -49,6 +58,7 @@ high_plains_aquifer = Aquifer(
     datasets_dir = "Prelim_Data/High_Plains",
     huc2s = [],
     huc4s = ['1012', '1014', '1015', '1017', '1018', '1019', '1020', '1021', '1022', '1025', '1026', '1027', '1102', '1103', '1104', '1105', '1106', '1108', '1109', '1110', '1112', '1113', '1205', '1208', '1306', '1307'],
+    aq_names = ['High Plains aquifer'],
 )
 
 arizona_alluvial_aquifer = Aquifer(
@@ -56,6 +66,7 @@ arizona_alluvial_aquifer = Aquifer(
     datasets_dir = "Prelim_Data/Arizona_Alluvial",
     huc2s = [],
     huc4s = ['1501', '1503', '1504', '1505', '1506', '1507', '1508'],
+    aq_names = ['Basin and Range basin-fill aquifers'],
 )
 
 snake_river_aquifer = Aquifer(
@@ -63,6 +74,7 @@ snake_river_aquifer = Aquifer(
     datasets_dir = "Prelim_Data/Snake_River",
     huc2s = [],
     huc4s = ['1704', '1705'],
+    aq_names = ['Snake River Plain basaltic-rock aquifers'],
 )
 
 coastal_lowlands_aquifer = Aquifer(
@@ -70,27 +82,31 @@ coastal_lowlands_aquifer = Aquifer(
     datasets_dir = "Prelim_Data/Coastal_Lowlands",
     huc2s = [],
     huc4s = ['0314', '0315', '0316', '0317', '0318', '0804', '0805', '0806', '0807', '0808', '0809', '1114', '1201'],
+    aq_names = ['Coastal lowlands aquifer system'],
 )
 
 edwards_trinity_aquifer = Aquifer(
     name = 'Edwards_Trinity',
     datasets_dir = "Prelim_Data/Edwards_Trinity",
     huc2s = [],
-    huc4s = ['1211', '1210', '1209', '1207', '1206', '1203', '1201', '1114', '1113', '0804', '1307', '1304', '1308', '1208']
+    huc4s = ['1211', '1210', '1209', '1207', '1206', '1203', '1201', '1114', '1113', '0804', '1307', '1304', '1308', '1208'],
+    aq_names = ['Edwards-Trinity aquifer system'],
 )
 
 floridian_aquifer = Aquifer(
     name = 'Floridian',
     datasets_dir = "Prelim_Data/Floridian",
     huc2s = [],
-    huc4s = ['0309', '0310', '0308', '0311', '0312', '0314', '0313', '0307', '0306', '0305', '0304', '0303']
+    huc4s = ['0309', '0310', '0308', '0311', '0312', '0314', '0313', '0307', '0306', '0305', '0304', '0303'],
+    aq_names = ['Floridan aquifer system'],
 )
 
 texas_gulf_coast_aquifer = Aquifer(
     name = 'Texas_Gulf_Coast',
     datasets_dir = "Prelim_Data/Texas_Gulf_Coast",
     huc2s = [],
-    huc4s = ['1201', '1202', '1203', '1204', '1207', '1209', '1210', '1211', '1309', '1308', '1114']
+    huc4s = ['1201', '1202', '1203', '1204', '1207', '1209', '1210', '1211', '1309', '1308', '1114'],
+    aq_names = ['Coastal lowlands aquifer system'],
 )
 
 upper_colorado_aquifer = Aquifer(
@@ -122,4 +138,109 @@ ALL_AQUIFERS = [
     upper_clairborne_aquifer,
     upper_colorado_aquifer
 ]
-    
\ No newline at end of file
+    
+# Result collector used by the multi-site loops in place of growing the output frames with pd.concat() once per site
+class ResultCollector:
+    """Collects per-site site metric and Mann-Kendall rows as plain dicts and builds the site metric frame and the 6 MK frames (same
+       order as fn.single_site_data()) once in frames()"""
+    __slots__ = ('metric_rows', 'mk_rows', 'add_cols')
+
+    def __init__(self):
+        self.metric_rows = []
+        self.mk_rows = {name: [] for name in fn.MK_SERIES}
+        # Insertion ordered add_data column names
+        self.add_cols = {}
+
+    def __len__(self):
+        return len(self.metric_rows)
+
+    def add_site(self, site_rows: list, mk_rows: dict, add_data: dict=None):
+        """Appends a site's fn.site_records() rows, with the site level add_data columns (i.e. state, huc2_code) added to every row"""
+        add_data = add_data or {}
+        self.add_cols.update(dict.fromkeys(add_data))
+        self.metric_rows.extend({**row, **add_data} for row in site_rows)
+        for name in fn.MK_SERIES:
+            self.mk_rows[name].extend({**row, **add_data} for row in mk_rows.get(name, []))
+
+    def add_result(self, result: dict):
+        """Appends a site_runner.analyze_site() result, failed sites are skipped"""
+        if result['error'] is None:
+            self.add_site(result['site_metrics'], result['mk'], result['add_data'])
+
+    def add_metrics(self, row: dict):
+        """Appends a single site metric row"""
+        self.metric_rows.append(row)
+
+    def merge_mk(self, name: str, df_mk_metric: pd.DataFrame, site_no: str, date_range: float, quantile: float):
+        """Append-only counterpart of fn.merge_mk_results() for the MK_SERIES table name"""
+        for row in df_mk_metric.to_dict('records'):
+            self.mk_rows[name].append({'dataset_ID': date_range * quantile, 'site_no': site_no, **row})
+
+    def frames(self):
+        """Builds every table once, with the add_data columns after the metric/MK columns"""
+        add_cols = list(self.add_cols)
+        df_metrics = pd.DataFrame(self.metric_rows, columns=fn.SITE_METRIC_COLS + fn.MONTHLY_HMF_COLS + add_cols)
+        df_mk = [pd.DataFrame(self.mk_rows[name], columns=['dataset_ID', 'site_no'] + fn.MK_COLS + add_cols) for name in fn.MK_SERIES]
+        return (df_metrics, *df_mk)
+
+# Compact daily flow record used by the analysis in place of a full merge_tidal() frame
+class FlowRecord:
+    """A single site's daily flow as flat arrays, sorted by date: flow values, int32 day numbers (days since 1970-01-01), and the water
+       year index (year_idx into years) and day of water year of every row, computed once by fn.water_year_calendar(). Flow is float64
+       unless another dtype is given (i.e. np.float32, which halves the flow array). Every analysis function in Src/func.py takes one"""
+    __slots__ = ('site_no', 'flow', 'day', 'dohy', 'years', 'year_idx')
+
+    def __init__(self, site_no: str, flow: np.ndarray, day: np.ndarray, dtype=np.float64):
+        flow = np.asarray(flow, dtype=dtype)
+        day = np.asarray(day).astype(np.int32)
+        if np.any(day[1:] < day[:-1]):
+            order = np.argsort(day, kind='stable')
+            flow, day = flow[order], day[order]
+        water_year, dohy = fn.water_year_calendar(day.astype('datetime64[D]'))
+        years, year_idx = np.unique(water_year, return_inverse=True)
+
+        self.site_no = site_no
+        self.flow = flow
+        self.day = day
+        self.dohy = dohy.astype(np.int16)
+        self.years = years.astype(np.int16)
+        self.year_idx = year_idx.astype(np.int16)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, dtype=np.float64):
+        """Builds a record from a merge_tidal() frame (datetime as a column or the index). Only the date and '00060_Mean' are kept"""
+        if 'datetime' not in df.columns:
+            df = df.reset_index()
+        day = df['datetime'].values.astype('datetime64[D]').astype(np.int64)
+        return cls(df['site_no'].iloc[0], df['00060_Mean'].to_numpy(dtype=np.float64), day, dtype)
+
+    def __len__(self):
+        return len(self.day)
+
+    @property
+    def dates(self):
+        return self.day.astype('datetime64[D]')
+
+    @property
+    def water_year(self):
+        return self.years[self.year_idx]
+
+    @property
+    def nbytes(self):
+        return self.flow.nbytes + self.day.nbytes + self.dohy.nbytes + self.years.nbytes + self.year_idx.nbytes
+
+    def window(self, start: int):
+        """Returns the record from row start onwards. Arrays are views of this record's, with year_idx rebased to the window's first year"""
+        first = int(self.year_idx[start]) if start < len(self) else 0
+        window = FlowRecord.__new__(FlowRecord)
+        window.site_no = self.site_no
+        window.flow = self.flow[start:]
+        window.day = self.day[start:]
+        window.dohy = self.dohy[start:]
+        window.years = self.years[first:]
+        window.year_idx = self.year_idx[start:] - first if first else self.year_idx[start:]
+        return window
+
+    def to_frame(self):
+        """Returns the record as a 'datetime', 'site_no', '00060_Mean' frame for the pandas helpers"""
+        return pd.DataFrame({'datetime': pd.to_datetime(self.dates), 'site_no': self.site_no, '00060_Mean': self.flow})
@@ -0,0 +1,226 @@
+# A bounded, rate-limited thread pool for site record requests. The national, validity and outlet loops spend most of their time
+# waiting on one request at a time, so records are fetched a few sites ahead of the analysis with retry and exponential backoff on
+# transient errors. Results always come back in the order the sites were given.
+#
+# Usage for an offline throughput/retry benchmark against a local stand-in server: python -m Src.fetch_pool <num_sites> [workers] [rate]
+import sys
+import time
+import random
+import threading
+import requests
+import pandas as pd
+import numpy as np
+
+from io import StringIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import Src.func as fn
+import Src.nwis_cache as nc
+import Src.tracing as tr
+
+NWIS_URL = 'https://waterservices.usgs.gov/nwis'
+MAX_WORKERS = 8
+# NWIS asks that automated clients keep request rates modest
+REQUESTS_PER_SECOND = 5.0
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 1.0
+# HTTP statuses worth retrying, anything else is treated as a permanent failure for that site
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+class RateLimiter:
+    """Spaces calls to wait() at least 1/rate seconds apart across all threads"""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def retrieval_error():
+    """Returns dataretrieval's base exception, which its NWIS requests raise for HTTP and connection failures alike, or an empty tuple
+       (matching nothing) on releases that raise requests' exceptions instead"""
+    try:
+        from dataretrieval.exceptions import DataRetrievalError
+        return DataRetrievalError
+    except ImportError:
+        return ()
+
+def is_transient(error: Exception):
+    """Returns True for network errors and HTTP statuses that are worth retrying"""
+    if isinstance(error, retrieval_error()):
+        return error.retryable
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in TRANSIENT_STATUS
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, ConnectionError, TimeoutError))
+
+def retry_delay(error: Exception, attempt: int, backoff: float=BACKOFF_SECONDS):
+    """Returns the seconds to wait before retrying, the server's Retry-After if dataretrieval passed one on, otherwise exponential backoff
+       (plus jitter so retries from many threads spread out)"""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        return retry_after
+    return backoff * 2 ** attempt + random.uniform(0, backoff)
+
+def read_rdb(text: str):
+    """Parses an NWIS daily value RDB response, renaming '<ts_id>_<pcode>_00003' columns to the '<pcode>_Mean' names get_record() uses"""
+    lines = [line for line in text.splitlines() if not line.startswith('#')]
+    if len(lines) < 2:
+        return pd.DataFrame()
+    # The second non-comment line holds column formats (i.e. 5s, 15s, 20d) rather than data
+    df = pd.read_csv(StringIO('\n'.join([lines[0]] + lines[2:])), sep='\t', dtype={'site_no': str})
+    renames = {}
+    for col in df.columns:
+        parts = col.split('_')
+        if len(parts) >= 3 and parts[2] == '00003':
+            name = f'{parts[1]}_Mean' + ('_cd' if col.endswith('_cd') else '')
+            if name not in renames.values():
+                renames[col] = name
+    df = df.rename(columns=renames)
+    df['datetime'] = pd.to_datetime(df['datetime'], utc=True)
+    return df[['datetime', 'site_no'] + list(renames.values())].set_index('datetime')
+
+def fetch_rdb(site: str, service: str, param_codes: list, start, end, base_url: str=NWIS_URL, timeout: float=60):
+    """Requests a single site's daily values as RDB. Transient HTTP statuses are raised so the pool can retry them"""
+    params = {'format': 'rdb', 'sites': site, 'parameterCd': ','.join(param_codes), 'startDT': str(start), 'endDT': str(end)}
+    response = requests.get(f'{base_url}/{service}/', params=params, timeout=timeout)
+    # NWIS answers sites without data for the parameter with a 404
+    if response.status_code == 404:
+        return pd.DataFrame()
+    response.raise_for_status()
+    return read_rdb(response.text)
+
+@tr.traced('fetch_retry', site_arg='site')
+def fetch_with_retry(fetch, site: str, limiter: RateLimiter, max_retries: int=MAX_RETRIES, backoff: float=BACKOFF_SECONDS):
+    """Calls fetch(site), retrying transient errors after retry_delay()"""
+    for attempt in range(max_retries + 1):
+        limiter.wait()
+        try:
+            return fetch(site)
+        except Exception as e:
+            if attempt == max_retries or not is_transient(e):
+                raise
+            time.sleep(retry_delay(e, attempt, backoff))
+
+def iter_records(sites: list, fetch=None, workers: int=MAX_WORKERS, rate: float=REQUESTS_PER_SECOND, max_retries: int=MAX_RETRIES,
+                 backoff: float=BACKOFF_SECONDS, **record_kwargs):
+    """Yields (site_no, df) in input order while up to 2 x workers later sites are fetched in the background. fetch(site) defaults to the
+       cached nc.get_record() with record_kwargs passed through. Sites which still fail after retrying are printed and yield an empty frame,
+       which the notebook loops already skip"""
+    if fetch is None:
+        fetch = lambda site: nc.get_record(sites=site, **record_kwargs)
+    limiter = RateLimiter(rate)
+    site_iter = iter(sites)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit_next():
+            site = next(site_iter, None)
+            if site is not None:
+                pending.append((site, executor.submit(fetch_with_retry, fetch, site, limiter, max_retries, backoff)))
+
+        for _ in range(2 * workers):
+            submit_next()
+
+        while pending:
+            site, future = pending.popleft()
+            submit_next()
+            try:
+                df = future.result()
+            except Exception as e:
+                print(f'ERROR: Fetch failed for site {site}: {e}')
+                df = pd.DataFrame()
+            yield site, df
+
+def fetch_records(sites: list, **kwargs):
+    """Returns a list of records in the same order as sites, see iter_records() for the options"""
+    return [df for _, df in iter_records(sites, **kwargs)]
+
+#--------------------------------------#
+#-------# LOCAL STAND-IN SERVER #------#
+#--------------------------------------#
+
+def synthetic_rdb(site: str, start: str=fn.DEFAULT_START, end: str=fn.DEFAULT_END, seed: int=0):
+    """Creates a canned daily value RDB response in the same layout NWIS serves"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, end, freq='D')
+    flow = np.round(np.exp(rng.normal(3, 1, len(dates))), 2)
+    header = '# Canned NWIS daily values for offline testing\nagency_cd\tsite_no\tdatetime\t1234_00060_00003\t1234_00060_00003_cd\n5s\t15s\t20d\t14n\t10s\n'
+    rows = [f'USGS\t{site}\t{d:%Y-%m-%d}\t{q}\tA' for d, q in zip(dates, flow)]
+    return header + '\n'.join(rows) + '\n'
+
+class StandInServer:
+    """A local HTTP stand-in for the NWIS service serving canned responses keyed by site. The first fail_first requests for every site
+       return a 503, and every request is delayed by latency seconds, so retry behavior and throughput can be measured offline"""
+    def __init__(self, responses: dict, fail_first: int=0, latency: float=0.0):
+        self.responses = responses
+        self.fail_first = fail_first
+        self.latency = latency
+        self.attempts = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site = parse_qs(urlparse(self.path).query).get('sites', [''])[0]
+                with server.lock:
+                    server.attempts[site] = server.attempts.get(site, 0) + 1
+                    attempt = server.attempts[site]
+                time.sleep(server.latency)
+                if attempt <= server.fail_first:
+                    status, body = 503, b'Service Unavailable'
+                elif site in server.responses:
+                    status, body = 200, server.responses[site].encode()
+                else:
+                    status, body = 404, b'No sites found'
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def benchmark(num_sites: int=50, workers: int=MAX_WORKERS, rate: float=50.0, fail_first: int=1, latency: float=0.25):
+    """Times serial and pooled fetching of canned records from the stand-in server and checks results come back in input order"""
+    sites = [f'{i:08d}' for i in range(num_sites)]
+    responses = {site: synthetic_rdb(site, start='1990-10-01', seed=i) for i, site in enumerate(sites)}
+
+    for label, n_workers in [('serial', 1), ('pooled', workers)]:
+        with StandInServer(responses, fail_first=fail_first, latency=latency) as server:
+            fetch = lambda site: fetch_rdb(site, fn.SERVICE, [fn.PARAM_CODE], '1990-10-01', fn.DEFAULT_END, base_url=server.url)
+            start = time.perf_counter()
+            results = list(iter_records(sites, fetch=fetch, workers=n_workers, rate=rate, backoff=0.05))
+            elapsed = time.perf_counter() - start
+            in_order = [site for site, _ in results] == sites and all(df['site_no'].iloc[0] == site for site, df in results)
+            print(f'{label}: {num_sites} sites in {elapsed:.2f}s ({num_sites / elapsed:.1f} sites/s), '
+                  f'{sum(server.attempts.values())} requests, in order: {in_order}')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 3:
+        print('Usage: python -m Src.fetch_pool <num_sites> [workers] [rate]')
+        sys.exit(1)
+    benchmark(int(args[0]) if args else 50, int(args[1]) if len(args) > 1 else MAX_WORKERS, float(args[2]) if len(args) > 2 else 50.0)
@@ -4,16 +4,32 @@ import pandas as pd
 import numpy as np
 import warnings
 import calendar
-import pymannkendall as mk
-import matplotlib.pyplot as plt
-import geopandas as gpd
-import contextily as cx
-from shapely.geometry import Point
-import matplotlib.colors as mcolors
+import importlib
 
 from datetime import datetime, timedelta
 from itertools import chain
 
+import Src.classes as cl
+import Src.tracing as tr
+import Src.reference as rf
+
+# Plotting and geospatial helpers live in Src/plotting.py and Src/geo.py so that importing the analysis functions (i.e. in process pool
+# workers or on every reload(fn)) does not load matplotlib, geopandas or contextily. They are still reached as fn.<name>, and their
+# module is imported the first time one of them is used
+LAZY_ATTRS = {
+    **dict.fromkeys(['plot_lower_48', 'plot_stream_network', 'plot_basemap', 'scale_colorbar', 'plot_rateb_aquifers', 'plot_aquifers',
+                     'plot_huc2', 'plot_huc4', 'set_plot_bounds', 'save_plot_as_image', 'aquifer_map',
+                     'multi_aquifer_map'], 'Src.plotting'),
+    **dict.fromkeys(['REGION_COLS', 'region_labels', 'assign_regions', 'convert_geometry'], 'Src.geo'),
+}
+
+def __getattr__(name: str):
+    if name in LAZY_ATTRS:
+        value = getattr(importlib.import_module(LAZY_ATTRS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 #--------------------------#
 #-------# CONSTANTS #------#
 #--------------------------#
@@ -192,10 +208,18 @@ WATER_QUALITY_PCODES = {
 # For use in pd.read_excel() to enforce leading 0's
 DATASET_DTYPES = {'site_no': str, 'huc2_code': str, 'huc4_code': str, 'within_aq': str}
 
+# Dataset output. Every dataset is written as one columnar file per sheet, 'parquet' or 'feather', and optionally as an .xlsx workbook
+OUTPUT_FORMAT = 'parquet'
+EXPORT_EXCEL = False
+SHEET_NAMES = ['site_metrics', 'mk_magnitude', 'mk_duration', 'mk_intra_annual', 'mk_event_mag', 'mk_event_dur', 'mk_timing']
+# Columns read_excel() returns as datetimes, so columnar datasets are loaded the same way
+DATASET_DATE_COLS = ['analyze_start', 'analyze_end', 'data_start', 'data_end']
+
 #-----------------------------------#
 #-------# ANALYSIS FUNCTIONS #------#
 #-----------------------------------#
 
+@tr.traced('merge_tidal')
 def merge_tidal(df_combined):
     """This function merges, if necessary, tidal data with streamflow data returning a dataframe
        with only the necessary columns for analysis. If no data is present, an empty dataframe is returned."""
@@ -230,11 +254,12 @@ def validate(df: pd.DataFrame, start: datetime, end: datetime):
 
 def calc_threshold(df: pd.DataFrame, value: float):
     """Returns a threshold above which flow is considered HMF given flow values and a threshold 0 < t < 1""" 
-    df = pd.DataFrame(df['00060_Mean'])
+    df = pd.DataFrame(as_frame(df)['00060_Mean'])
     return df.quantile(q=value, axis=0).iloc[0]
 
 def filter_hmf(df: pd.DataFrame, threshold: float):
     """Returns a dataframe with only flow values above a given threshold present, and a second with non-HMF years zero deflated"""
+    df = as_frame(df)
     hmf_series_cont = df.copy()
     hmf_series_defl = df[df['00060_Mean'] > threshold]    
     hmf_series_cont['00060_Mean'] = hmf_series_cont['00060_Mean'].apply(lambda x: x if x >= threshold else 0) 
@@ -242,12 +267,13 @@ def filter_hmf(df: pd.DataFrame, threshold: float):
 
 def convert_hmf(df: pd.DataFrame, threshold: float):
     """Converts flow values from ft^3/s to ft^3/day and returns the difference in flow above the threshold"""
+    df = as_frame(df)
     df['00060_Mean'] = df['00060_Mean'].apply(lambda x: (x - threshold) * SEC_PER_DAY if x > 0 else 0)
     return df
 
 def monthly_hmf(df: pd.DataFrame, data_range: int, quantile: float):
     """Returns the average HMF value per month over the analyzed data period"""
-    df = df.reset_index()
+    df = as_frame(df).reset_index()
     # Aggregate hmf by month
     df['00060_Mean'] = df['00060_Mean'] * CUBIC_FT_KM_FACTOR
     df['datetime'] = pd.to_datetime(df['datetime'])
@@ -309,7 +335,7 @@ def monthly_hmf(df: pd.DataFrame, data_range: int, quantile: float):
     return df_pivot
 
 def num_hmf_years(df: pd.DataFrame):
-    df_temp = df.copy()
+    df_temp = as_frame(df).copy()
     """Returns the integer number of HMF years"""
     '''df.loc[:, 'datetime'] = pd.to_datetime(df['datetime'])
     df.set_index('datetime', inplace=True)    
@@ -319,7 +345,7 @@ def num_hmf_years(df: pd.DataFrame):
 
 def three_six_range(df: pd.DataFrame, three_start: int, three_end: int, six_start: int, six_end: int):
     """Returns two dataframes, one with a six month period, and one with a three month period, based on given start and end months for both"""
-    df_temp = df.reset_index()
+    df_temp = as_frame(df).reset_index()
     df_temp.loc[:, 'datetime'] = pd.to_datetime(df_temp['datetime'])    
     six_month_mask = (df_temp['datetime'].dt.month >= six_start) | (df_temp['datetime'].dt.month <= six_end)
     three_month_mask = (df_temp['datetime'].dt.month >= three_start) | (df_temp['datetime'].dt.month <= three_end)
@@ -330,7 +356,7 @@ def calc_inter_annual(df: pd.DataFrame, hmf_years: int):
     # TODO: Discuss w/KO on how we want to handle partial years. If a partial year at start/end has HMF, we can count it as a full year, however if it doesn't,
     # this current method will still count it as a full year in delta, when we don't know if there was or was not flow in the missing portions. This potentially
     # skews the frequency by 1/30th or 1/50th and so may not be worth worrying about. Solutions would involve checking the first/last year for HMF and adjusting delta
-    df_inter = df.reset_index()
+    df_inter = as_frame(df).reset_index()
     df_inter['datetime'] = df_inter['datetime'] + pd.DateOffset(months=-9)
     delta = df_inter['datetime'].dt.year.nunique()
     inter_annual = hmf_years / delta
@@ -340,7 +366,7 @@ def calc_inter_annual(df: pd.DataFrame, hmf_years: int):
 def calc_duration_intra_annual(df: pd.DataFrame, hmf_years: int):
     """Calculates the average duration of HMF events per year and the intra-annual frequency of events
        per year. Also returns a results dataframe for use in the duration and intra-annual MK tests"""
-    df_d = df.reset_index()
+    df_d = as_frame(df).reset_index()
     df_results = pd.DataFrame()
     df_d['datetime'] = df_d['datetime'] + pd.DateOffset(months=-9)
 
@@ -434,7 +460,7 @@ def calc_oneday_peaks(df: pd.DataFrame):
 
 def calc_timing(df: pd.DataFrame):
     """Calculates the average numerical day per hydrologic year that HMF reaches the center of mass threshold"""
-    df = df.reset_index()
+    df = as_frame(df).reset_index()
     
     df['datetime'] = df['datetime'] + pd.DateOffset(months=-9)    
     df['year'] = df['datetime'].dt.year
@@ -452,14 +478,644 @@ def convert_cubic_ft_hm(value: float):
     """Convert ft^3 to km^3"""
     return value * CUBIC_FT_KM_FACTOR
 
+# Columns of a mann_kendall() result, the zero-deflated test followed by the continuous test
+MK_COLS = ['trend_zd', 'h_zd', 'p_zd', 'z_zd', 'tau_zd', 's_zd', 'var_s_zd', 'slope_zd', 'int_zd', 
+           'trend', 'h', 'p', 'z', 'tau', 's', 'var_s', 'slope', 'int']
+
+def mann_kendall_row(defl_data: pd.Series, cont_data: pd.Series, alpha: float):
+    """Returns the mann_kendall() results as a plain tuple in MK_COLS order"""
+    return mann_kendall_rows([(defl_data, cont_data)], alpha)[0]
+
 def mann_kendall(defl_data: pd.Series, cont_data: pd.Series, alpha: float):
     """Perform a Mann-Kendall Trend test on a continuous series of data and a zero-deflated series"""
-    data = mk.original_test(defl_data, alpha=alpha) + mk.original_test(cont_data, alpha=alpha)
-    mk_trend = pd.DataFrame([data], columns=['trend_zd', 'h_zd', 'p_zd', 'z_zd', 'tau_zd', 's_zd', 'var_s_zd', 'slope_zd', 'int_zd', 
-                                           'trend', 'h', 'p', 'z', 'tau', 's', 'var_s', 'slope', 'int'])  
+    data = mann_kendall_row(defl_data, cont_data, alpha)
+    mk_trend = pd.DataFrame([data], columns=MK_COLS)  
 
     return mk_trend
 
+#------------------------------------------#
+#-------# BATCHED MANN-KENDALL TEST #------#
+#------------------------------------------#
+
+# Pairs sampled per series to bracket the median slope in sens_slope_batch()
+SEN_SAMPLE_SIZE = 256
+
+def _pad_series(series_list: list):
+    """Packs series into a (k, N) matrix with NaNs dropped and each row left-justified, padded with +inf up to a power of two N.
+       Returns the matrix and the number of real values per row"""
+    rows = [np.asarray(x, dtype=float).ravel() for x in series_list]
+    rows = [x[~np.isnan(x)] for x in rows]
+    n = np.array([len(x) for x in rows], dtype=np.int64)
+    width = 1 << max(int(n.max(initial=1)) - 1, 0).bit_length()
+    values = np.full((len(rows), width), np.inf)
+    for i, x in enumerate(rows):
+        values[i, :len(x)] = x
+    return values, n
+
+def _dense_ranks(values: np.ndarray):
+    """Returns per row dense ranks (ties share a rank) and the row-wise sorted values"""
+    order = np.argsort(values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    dense = np.zeros(values.shape, dtype=np.int64)
+    dense[:, 1:] = np.cumsum(sorted_values[:, 1:] != sorted_values[:, :-1], axis=1)
+    ranks = np.empty_like(dense)
+    np.put_along_axis(ranks, order, dense, axis=1)
+    return ranks, dense
+
+def mk_score_batch(series_list: list):
+    """Returns the Mann-Kendall S score (concordant minus discordant pairs, NaNs skipped) of every series in O(n log^2 n) using a
+       bottom-up merge sort. At each level every element of a right block is counted against the sorted left block with a single
+       searchsorted() across all rows, so a batch of series costs about the same number of numpy calls as one"""
+    values, n = _pad_series(series_list)
+    ranks, _ = _dense_ranks(values)
+    k, width = ranks.shape
+    s = np.zeros(k, dtype=np.int64)
+
+    blocks = ranks
+    size = 1
+    while size < width:
+        pairs = blocks.reshape(k, width // (2 * size), 2, size)
+        # Offset every left/right block pair so all left blocks form one globally sorted array
+        offset = (np.arange(k * (width // (2 * size)), dtype=np.int64) * (width + 1)).reshape(k, -1, 1)
+        left = (pairs[:, :, 0, :] + offset).ravel()
+        right = pairs[:, :, 1, :] + offset
+        start = (np.arange(k * (width // (2 * size)), dtype=np.int64) * size).reshape(k, -1, 1)
+        less = np.searchsorted(left, right.ravel(), side='left').reshape(right.shape) - start
+        greater = size - (np.searchsorted(left, right.ravel(), side='right').reshape(right.shape) - start)
+        s += (less - greater).reshape(k, -1).sum(axis=1)
+        blocks = np.sort(pairs.reshape(k, -1, 2 * size), axis=-1).reshape(k, width)
+        size *= 2
+
+    # Padding sits after every real value and is larger than all of them, so each pad adds one concordant pair per real value
+    return s - (width - n) * n, n
+
+def mk_variance_batch(series_list: list):
+    """Returns the tie-corrected variance of S for every series (NaNs skipped)"""
+    values, n = _pad_series(series_list)
+    _, dense = _dense_ranks(values)
+    k, width = dense.shape
+    real = np.arange(width) < n[:, None]
+    group = (np.arange(k)[:, None] * width + dense)[real]
+    tp = np.bincount(group, minlength=k * width).reshape(k, width).astype(np.float64)
+    ties = (tp * (tp - 1) * (2 * tp + 5)).sum(axis=1)
+    return (n * (n - 1) * (2 * n + 5) - ties) / 18
+
+def _slope_bracket_pass(values: np.ndarray, lo: np.ndarray, hi: np.ndarray):
+    """Walks the pairwise slopes one lag at a time, (x[i + lag] - x[i]) / lag for every row, counting the slopes below lo and collecting
+       those within [lo, hi]. Only one lag's slopes exist at a time so memory stays O(k x n)"""
+    k, width = values.shape
+    below = np.zeros(k, dtype=np.int64)
+    cand_rows, cand_values = [], []
+    for lag in range(1, width):
+        slopes = (values[:, lag:] - values[:, :-lag]) / lag
+        below += (slopes < lo[:, None]).sum(axis=1)
+        inside = (slopes >= lo[:, None]) & (slopes <= hi[:, None])
+        cand_rows.append(np.nonzero(inside)[0])
+        cand_values.append(slopes[inside])
+    rows = np.concatenate(cand_rows) if cand_rows else np.zeros(0, dtype=np.int64)
+    vals = np.concatenate(cand_values) if cand_values else np.zeros(0)
+    return below, rows, vals
+
+def sens_slope_batch(series_list: list, sample_size: int=SEN_SAMPLE_SIZE, seed: int=0):
+    """Theil-Sen slope and Conover intercept for a batch of series, identical to pymannkendall.sens_slope() (NaNs keep their positions
+       and NaN slopes are ignored). The median slope is found by selection rather than by sorting all n(n-1)/2 slopes: a random sample
+       of pairs brackets the middle ranks, one pass over the slopes counts those below the bracket and keeps those inside it, and the
+       median is picked from the kept slopes. Rows whose median falls outside the bracket are redone with an unbounded one"""
+    rows = [np.asarray(x, dtype=float).ravel() for x in series_list]
+    slope, intercept = np.full(len(rows), np.nan), np.full(len(rows), np.nan)
+
+    # Series are grouped by power of two length so a few long records do not pad every short one out to their length
+    buckets = {}
+    for i, x in enumerate(rows):
+        buckets.setdefault(max(len(x) - 1, 0).bit_length(), []).append(i)
+    for bucket, idx in buckets.items():
+        values = np.full((len(idx), max(1 << bucket, 1)), np.nan)
+        for row, i in enumerate(idx):
+            values[row, :len(rows[i])] = rows[i]
+        slope[idx], intercept[idx] = _sens_slope_rows(values, sample_size, seed)
+    return slope, intercept
+
+def _sens_slope_rows(values: np.ndarray, sample_size: int, seed: int):
+    """sens_slope_batch() for a NaN padded (k, n) matrix"""
+    k, width = values.shape
+    valid = ~np.isnan(values)
+
+    # Number of non-NaN slopes per row and the 0-based ranks of the middle one (odd) or two (even)
+    n_valid = valid.sum(axis=1)
+    count = n_valid * (n_valid - 1) // 2
+    lo_rank, hi_rank = (count - 1) // 2, count // 2
+
+    # Bracket the middle ranks from a random sample of pairs, widened by a few standard errors of the sample quantile
+    rng = np.random.default_rng(seed)
+    first, second = rng.integers(0, width, (2, k, sample_size))
+    first, second = np.minimum(first, second), np.maximum(first, second)
+    row_idx = np.arange(k)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sample = np.where(first < second, (values[row_idx, second] - values[row_idx, first]) / (second - first), np.nan)
+    sample = np.sort(sample, axis=1)
+    n_sample = (~np.isnan(sample)).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.where(count > 0, (lo_rank + 0.5) / count, 0.5)
+    margin = 3 / np.sqrt(np.maximum(n_sample, 1))
+    lo_idx = np.floor((q - margin) * n_sample).astype(np.int64)
+    hi_idx = np.ceil((q + margin) * n_sample).astype(np.int64)
+    lo = np.where(lo_idx >= 0, sample[row_idx[:, 0], np.clip(lo_idx, 0, sample_size - 1)], -np.inf)
+    hi = np.where(hi_idx < n_sample, sample[row_idx[:, 0], np.clip(hi_idx, 0, sample_size - 1)], np.inf)
+    lo[n_sample == 0], hi[n_sample == 0] = -np.inf, np.inf
+
+    below, cand_rows, cand_values = _slope_bracket_pass(values, lo, hi)
+    inside = np.bincount(cand_rows, minlength=k)
+    missed = (count > 0) & ((lo_rank < below) | (hi_rank >= below + inside))
+    if missed.any():
+        # Unbounded bracket for the unlucky rows, every slope is kept
+        retry = np.nonzero(missed)[0]
+        _, retry_rows, retry_values = _slope_bracket_pass(values[retry], np.full(len(retry), -np.inf), np.full(len(retry), np.inf))
+        keep = ~missed[cand_rows]
+        cand_rows = np.concatenate([cand_rows[keep], retry[retry_rows]])
+        cand_values = np.concatenate([cand_values[keep], retry_values])
+        below[retry] = 0
+        inside = np.bincount(cand_rows, minlength=k)
+
+    # Select the middle slopes from each row's sorted candidates
+    order = np.lexsort((cand_values, cand_rows))
+    cand_values = cand_values[order]
+    start = np.concatenate([[0], np.cumsum(inside)[:-1]])
+    slope = np.full(k, np.nan)
+    has_slope = count > 0
+    low = cand_values[(start + lo_rank - below)[has_slope]]
+    high = cand_values[(start + hi_rank - below)[has_slope]]
+    slope[has_slope] = (low + high) / 2
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        positions = np.where(valid, np.arange(width, dtype=float), np.nan)
+        intercept = np.nanmedian(values, axis=1) - np.nanmedian(positions, axis=1) * slope
+    return slope, intercept
+
+def mk_test_batch(series_list: list, alpha: float):
+    """Mann-Kendall original test (as in pymannkendall.original_test()) for a batch of series. Returns a list of
+       (trend, h, p, z, tau, s, var_s, slope, intercept) tuples, with NaN statistics for series with fewer than 2 values"""
+    s, n = mk_score_batch(series_list)
+    s = s.astype(np.float64)
+    var_s = mk_variance_batch(series_list)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau = np.where(n > 1, s / (.5 * n * (n - 1)), np.nan)
+        z = np.where(s > 0, (s - 1) / np.sqrt(var_s), np.where(s < 0, (s + 1) / np.sqrt(var_s), 0.0))
+    # scipy.special (rather than scipy.stats, which takes several times longer to import) holds the normal CDF and its inverse which
+    # norm.cdf() and norm.ppf() call, imported here so it is only loaded once a test is run
+    from scipy.special import ndtr, ndtri
+    p = 2 * (1 - ndtr(np.abs(z)))
+    h = np.abs(z) > ndtri(1 - alpha / 2)
+    trend = np.where(h & (z < 0), 'decreasing', np.where(h & (z > 0), 'increasing', 'no trend'))
+
+    slope, intercept = sens_slope_batch(series_list)
+
+    results = []
+    for i in range(len(series_list)):
+        results.append((str(trend[i]), bool(h[i]), float(p[i]), float(z[i]) if s[i] != 0 else 0, float(tau[i]), float(s[i]), float(var_s[i]),
+                        slope[i], intercept[i]))
+    return results
+
+@tr.traced('mann_kendall')
+def mann_kendall_rows(pairs: list, alpha: float):
+    """Runs every (zero-deflated, continuous) series pair through a single mk_test_batch() call, returning one MK_COLS tuple per pair.
+       Like pymannkendall, a series with fewer than 2 values raises ZeroDivisionError"""
+    series_list = [x for pair in pairs for x in pair]
+    results = mk_test_batch(series_list, alpha)
+    if any(np.isnan(r[4]) for r in results):
+        raise ZeroDivisionError('Mann-Kendall test needs at least 2 values')
+    return [results[2 * i] + results[2 * i + 1] for i in range(len(pairs))]
+
+#---------------------------------#
+#-------# ARRAY HMF KERNEL #------#
+#---------------------------------#
+
+# Site metric columns produced by single_site_data() in the order they are saved
+SITE_METRIC_COLS = ['dataset_ID', 'site_no', 'analyze_start', 'analyze_end', 'analyze_range', 'quantile', 'valid', 'missing_data%', 'threshold', 'hmf_years',
+                    'annual_hmf', 'six_mo_hmf', 'three_mo_hmf', 'annual_duration', 'event_duration', 'event_hmf', 'inter_annual%', 'intra_annual', 'timing']
+MONTHLY_HMF_COLS = [(calendar.month_name[i][:3] + '_hmf').lower() for i in range(1, 13)]
+
+# Annual series used for each Mann-Kendall test, keyed the same as the mk_* sheets (minus the prefix)
+MK_SERIES = ['magnitude', 'duration', 'intra_annual', 'event_mag', 'event_dur', 'timing']
+
+def water_year_calendar(dates: np.ndarray):
+    """Returns the water year and day of water year for an array of dates. This reproduces the pd.DateOffset(months=-9) shift
+       used by the pandas helpers exactly, including day-of-month clipping (i.e. Nov 30 -> Feb 28)"""
+    days = np.asarray(dates).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    day_of_month = (days - months.astype('datetime64[D]')).astype(np.int64)
+
+    # Shift back 9 months, clipping the day to the length of the shifted month
+    shifted_months = months - 9
+    month_length = ((shifted_months + 1).astype('datetime64[D]') - shifted_months.astype('datetime64[D]')).astype(np.int64)
+    shifted = shifted_months.astype('datetime64[D]') + np.minimum(day_of_month, month_length - 1)
+
+    years = shifted_months.astype('datetime64[Y]')
+    water_year = years.astype(np.int64) + 1970
+    dohy = (shifted - years.astype('datetime64[D]')).astype(np.int64) + 1
+    return water_year, dohy
+
+def group_sum(values: np.ndarray, group_idx: np.ndarray, n_groups: int):
+    """Sums values per group with pandas' groupby sum(), the Kahan compensated reduction resample(HYDRO_YEAR).sum() also uses, so sums
+       match the pandas helpers to the bit and ties between them are kept. Groups without values sum to 0"""
+    sums = pd.Series(values).groupby(group_idx, sort=False).sum()
+    total = np.zeros(n_groups)
+    total[sums.index] = sums.to_numpy()
+    return total
+
+def as_flow_record(df):
+    """Returns a cl.FlowRecord for a merge_tidal() frame, records are passed through"""
+    return df if isinstance(df, cl.FlowRecord) else cl.FlowRecord.from_frame(df)
+
+def as_frame(record):
+    """Returns a merge_tidal() style frame for a cl.FlowRecord (see FlowRecord.to_frame()) so the pandas helpers take either, frames are
+       passed through"""
+    return record.to_frame() if isinstance(record, cl.FlowRecord) else record
+
+@tr.traced('events')
+def hmf_events(excess: np.ndarray, year_idx: np.ndarray=None):
+    """O(n) run-length encoding of the HMF rows (excess > 0) into events. Returns the first and last row, duration (rows) and volume (summed
+       excess) of every event. Events are runs of consecutive HMF rows which, given year_idx, restart at each new water year"""
+    hmf = excess > 0
+    continues = hmf[1:] & hmf[:-1]
+    if year_idx is not None:
+        continues &= year_idx[1:] == year_idx[:-1]
+    starts = np.flatnonzero(hmf & ~np.r_[False, continues])
+    ends = np.flatnonzero(hmf & ~np.r_[continues, False])
+    # Rows between events have no excess, so summing from each start up to the next one sums the event alone
+    volume = np.add.reduceat(excess, starts) if len(starts) else np.zeros(0)
+    return starts, ends, ends - starts + 1, volume
+
+# Columns of events_table(), one row per HMF event
+EVENTS_TABLE_COLS = ['site_no', 'event', 'start', 'end', 'hmf', 'duration', 'water_year']
+
+def hmf_excess(flow: np.ndarray, threshold: float):
+    """Returns the HMF days (flow above threshold) and the daily excess over the threshold in ft^3, as filter_hmf() + convert_hmf()
+       compute them. NaN flow is never HMF"""
+    above = flow > threshold
+    cont = np.where(flow >= threshold, flow, 0.0)
+    excess = np.where(cont > 0, (cont - threshold) * SEC_PER_DAY, 0.0)
+    return above, excess
+
+def events_table(record, quantile: float, threshold: float=None, split_years: bool=False):
+    """Returns a site's HMF events (site_no, event, start, end, hmf, duration, water_year) as a DataFrame, with HMF volume in km^3 and the
+       water year the event started in. With split_years set events restart at each water year, which are the events the site metrics
+       and their MK series count (site_records() builds this once per scenario and passes it to hmf_kernel()). Otherwise events run
+       across water years, as the events sub-DFs record them"""
+    record = as_flow_record(record)
+    flow = record.flow.astype(np.float64, copy=False)
+    if threshold is None:
+        threshold = np.nanquantile(flow, quantile)
+    excess = hmf_excess(flow, threshold)[1] * CUBIC_FT_KM_FACTOR
+    starts, ends, duration, volume = hmf_events(excess, record.year_idx if split_years else None)
+    day = record.day.astype('datetime64[D]')
+    return pd.DataFrame({
+        'site_no': record.site_no, 'event': np.arange(1, len(starts) + 1), 'start': day[starts].astype(object), 'end': day[ends].astype(object),
+        'hmf': volume, 'duration': duration, 'water_year': record.years[record.year_idx[starts]].astype(np.int64),
+    })
+
+@tr.traced('hmf_kernel')
+def hmf_kernel(record, quantile: float, threshold: float=None, events: pd.DataFrame=None):
+    """Single pass replacement for the filter_hmf -> convert_hmf -> num_hmf_years -> calc_inter_annual -> calc_duration_intra_annual ->
+       calc_timing -> monthly_hmf chain. Takes a site's cl.FlowRecord (or merge_tidal() frame) for the analyzed range and its
+       events_table(..., split_years=True), which is built here if not given, and returns a dict of site metrics and a dict of
+       (zero-deflated, continuous) annual series for the Mann-Kendall tests"""
+    record = as_flow_record(record)
+    flow = record.flow.astype(np.float64, copy=False)
+    dohy = record.dohy
+    if threshold is None:
+        threshold = np.nanquantile(flow, quantile)
+    if events is None:
+        events = events_table(record, quantile, threshold, split_years=True)
+
+    above, excess = hmf_excess(flow, threshold)
+    excess_km = excess * CUBIC_FT_KM_FACTOR
+
+    # Water years present in the analyzed range, and water years with at least one HMF day
+    years, year_idx = record.years, record.year_idx
+    n_years = len(years)
+    hmf_years = len(np.unique(year_idx[above]))
+    delta = n_years
+    inter_annual = min((round(hmf_years / delta, 5) * 100), 100)
+
+    # Annual HMF, days and events. The scenario's events table gives both the annual event counts and the HMF days
+    annual_hmf = np.bincount(year_idx, weights=excess, minlength=n_years) * CUBIC_FT_KM_FACTOR
+    event_year = np.searchsorted(years, events['water_year'].to_numpy())
+    total_days = np.bincount(event_year, weights=events['duration'].to_numpy(), minlength=n_years)
+    total_events = np.bincount(event_year, minlength=n_years).astype(np.float64)
+    has_events = total_events > 0
+    event_hmf = np.divide(annual_hmf, total_events, out=np.zeros(n_years), where=has_events)
+    duration = np.divide(total_days, total_events, out=np.zeros(n_years), where=has_events)
+
+    # Daily HMF over HMF days only, including the 3 (Dec-Feb) and 6 (Nov-Apr) month windows
+    month_num = record.day[above].astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    defl_km = excess_km[above]
+    defl_month = month_num % 12 + 1
+    six_month = (defl_month >= 11) | (defl_month <= 4)
+    three_month = (defl_month >= 12) | (defl_month <= 2)
+
+    # Average HMF per month, averaged over the (year, month) periods which saw HMF
+    month_sum = np.bincount(defl_month - 1, weights=defl_km, minlength=12)
+    month_count = np.bincount(np.unique(month_num) % 12, minlength=12)
+    hmf_per_month = np.divide(month_sum, month_count, out=np.zeros(12), where=month_count > 0)
+
+    # Timing, the first day of water year at which cumulative HMF reaches half of that year's total
+    defl_year_idx = year_idx[above]
+    defl_excess = excess[above]
+    new_year = np.ones(len(defl_year_idx), dtype=bool)
+    new_year[1:] = defl_year_idx[1:] != defl_year_idx[:-1]
+    group = np.cumsum(new_year) - 1
+    cumsum = np.cumsum(defl_excess)
+    base = np.r_[0.0, cumsum[:-1]][new_year]
+    group_total = np.r_[base[1:], cumsum[-1:]] - base
+    reached = np.flatnonzero(cumsum - base[group] >= group_total[group] / 2)
+    _, first_reached = np.unique(group[reached], return_index=True)
+    com_series = dohy[above][reached[first_reached]]
+
+    # Annual HMF over every water year from the first to the last of the analyzed range (as resample(HYDRO_YEAR).sum() does). Summed
+    # exactly as pandas does, as the MK test ranks these and a 1 ulp difference breaks ties between equal annual volumes
+    span = years.astype(np.int64) - years[0]
+    mag_series = np.zeros(span[-1] + 1)
+    mag_series[span] = group_sum(excess_km, year_idx, n_years)
+
+    # Medians of empty selections (i.e. no HMF in the 3 month window) are NaN, same as pandas
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        metrics = {
+            'analyze_range': delta, 'threshold': threshold, 'hmf_years': hmf_years, 'annual_hmf': np.median(defl_km),
+            'six_mo_hmf': np.median(defl_km[six_month]), 'three_mo_hmf': np.median(defl_km[three_month]),
+            'annual_duration': np.median(total_days), 'event_duration': np.median(duration), 'event_hmf': np.median(event_hmf),
+            'inter_annual%': inter_annual, 'intra_annual': np.median(total_events), 'timing': np.median(com_series),
+        }
+    metrics.update(zip(MONTHLY_HMF_COLS, hmf_per_month))
+
+    series = {
+        'magnitude': (mag_series[mag_series > 0], mag_series),
+        'duration': (total_days[total_days > 0], total_days),
+        'intra_annual': (total_events[total_events > 0], total_events),
+        'event_mag': (event_hmf[event_hmf > 0], event_hmf),
+        'event_dur': (duration[duration > 0], duration),
+        'timing': (com_series, com_series),
+    }
+    return metrics, series
+
+def plan_scenarios(dates: np.ndarray, data_ranges_list: list=DATA_RANGE_LIST, crop: bool=True):
+    """Returns (data_range, date_threshold, start) for every data range, where the range's window is the sorted record from row start
+       onwards. With crop False every window is the full record"""
+    plan = []
+    for data_range in data_ranges_list:
+        date_threshold = pd.to_datetime(DEFAULT_END).date() - timedelta(days=365.25 * data_range)
+        start = int(np.searchsorted(dates, np.datetime64(date_threshold), side='left')) if crop else 0
+        plan.append((data_range, date_threshold, start))
+    return plan
+
+def site_records(df: pd.DataFrame, quantiles_list: list=QUANTILE_LIST, data_ranges_list: list=DATA_RANGE_LIST, *args, crop: bool=True):
+    """Computes the site metrics and Mann-Kendall results for every data range and quantile using hmf_kernel(), returned as plain row dicts
+       (site metric rows, and a list of MK rows per MK_SERIES name) which are cheap to pickle between processes. Takes a merge_tidal() frame
+       or a cl.FlowRecord. If a second record is passed the threshold is calculated across its full record (Kocis 2017 verification), and
+       setting crop to False analyzes the full record rather than cropping to each data range (the notebook's testing mode)"""
+    # Sorted with its water year calendar once, every scenario below works on views of the record
+    with tr.stage('flow_record'):
+        record = as_flow_record(df)
+    site_no = record.site_no
+
+    # With a second record the thresholds come from its full record (Kocis 2017 verification) and are the same for every data range
+    full_record = args[0] if args and isinstance(args[0], (pd.DataFrame, cl.FlowRecord)) and len(args[0]) else None
+    with tr.stage('threshold'):
+        full_thresholds = None
+        if full_record is not None:
+            full_thresholds = np.nanquantile(as_flow_record(full_record).flow.astype(np.float64, copy=False), quantiles_list)
+
+    site_rows = []
+    mk_pairs = []
+    for data_range, date_threshold, start in plan_scenarios(record.dates, data_ranges_list, crop):
+        window = record.window(start)
+        window_flow, window_dates = window.flow.astype(np.float64, copy=False), window.dates
+
+        with tr.stage('threshold'):
+            # Validate that site is not missing > 10% of data over the cropped range
+            missing = validate(window_flow, date_threshold, DEFAULT_END)
+            valid = missing < MAX_MISSING_THRESHOLD
+            missing = round(missing, 5) * 100
+
+            # Every quantile threshold of the window in one call
+            thresholds = full_thresholds if full_thresholds is not None else np.nanquantile(window_flow, quantiles_list)
+        for quantile, threshold in zip(quantiles_list, thresholds):
+            # Events are encoded once per scenario, every event based metric and MK series is taken from this table
+            events = events_table(window, quantile, threshold, split_years=True)
+            metrics, series = hmf_kernel(window, quantile, threshold, events)
+
+            data = {'dataset_ID': (data_range * quantile), 'site_no': site_no, 'analyze_start': window_dates.min().astype(object),
+                    'analyze_end': window_dates.max().astype(object), 'quantile': quantile, 'valid': valid, 'missing_data%': missing}
+            data.update(metrics)
+            site_rows.append({col: data[col] for col in SITE_METRIC_COLS + MONTHLY_HMF_COLS})
+
+            mk_pairs.extend(series[name] for name in MK_SERIES)
+
+    # Every MK series of every scenario is tested in a single batch
+    mk_rows = {name: [] for name in MK_SERIES}
+    mk_results = iter(mann_kendall_rows(mk_pairs, MK_TREND_ALPHA))
+    for row in site_rows:
+        for name in MK_SERIES:
+            mk_rows[name].append({'dataset_ID': row['dataset_ID'], 'site_no': site_no, **dict(zip(MK_COLS, next(mk_results)))})
+
+    return site_rows, mk_rows
+
+def single_site_data(df: pd.DataFrame, quantiles_list: list=QUANTILE_LIST, data_ranges_list: list=DATA_RANGE_LIST, *args, crop: bool=True):
+    """Returns the same 7 frames as the notebook version (site metrics, then the magnitude, duration, intra-annual, event magnitude, event
+       duration and timing MK results) built from site_records()"""
+    site_rows, mk_rows = site_records(df, quantiles_list, data_ranges_list, *args, crop=crop)
+    df_site_data = pd.DataFrame(site_rows, columns=SITE_METRIC_COLS + MONTHLY_HMF_COLS)
+    df_mk = [pd.DataFrame(mk_rows[name], columns=['dataset_ID', 'site_no'] + MK_COLS) for name in MK_SERIES]
+    return (df_site_data, *df_mk)
+
+#-------------------------------------#
+#-------# BATCHED SITE METRICS #------#
+#-------------------------------------#
+
+def build_flow_matrix(site_frames: list, start: str=None, end: str=DEFAULT_END):
+    """Packs merge_tidal() frames (or cl.FlowRecords) into a dense, NaN-padded sites x days matrix on a shared daily calendar. Returns the
+       site numbers, the flow matrix, a presence mask (True where the site has a row, even if its flow is NaN) and the calendar dates"""
+    site_frames = [as_flow_record(df) if len(df) else df for df in site_frames]
+    # Empty frames (i.e. failed fetches, which may not even have a datetime column) have no dates and leave their row empty
+    site_dates = [df.dates if len(df) else np.array([], dtype='datetime64[D]') for df in site_frames]
+    dated = [dates for dates in site_dates if len(dates)]
+    last = np.datetime64(end, 'D') if end else max((dates.max() for dates in dated), default=np.datetime64(DEFAULT_END, 'D'))
+    first = np.datetime64(start, 'D') if start else min((dates.min() for dates in dated), default=last)
+    dates = np.arange(first, last + 1, dtype='datetime64[D]')
+
+    site_nos = []
+    flow = np.full((len(site_frames), len(dates)), np.nan)
+    present = np.zeros(flow.shape, dtype=bool)
+    for i, (df, day) in enumerate(zip(site_frames, site_dates)):
+        if not len(df):
+            site_nos.append(None)
+            continue
+        site_nos.append(df.site_no)
+        cols = (day - first).astype(np.int64)
+        keep = (cols >= 0) & (cols < len(dates))
+        flow[i, cols[keep]] = df.flow.astype(np.float64)[keep]
+        present[i, cols[keep]] = True
+
+    return site_nos, flow, present, dates
+
+def _row_quantile(values: np.ndarray, quantile: float):
+    """Per-row NaN-skipping linear quantile, computed identically to np.nanquantile (and so pd.DataFrame.quantile) but for all rows at once"""
+    if values.shape[1] == 0:
+        return np.full(len(values), np.nan)
+    ordered = np.sort(values, axis=1)
+    count = np.sum(~np.isnan(values), axis=1)
+    virtual = (count - 1) * quantile
+    previous = np.floor(virtual)
+    gamma = virtual - previous
+    previous_idx = np.clip(previous.astype(np.int64), 0, np.maximum(count - 1, 0))
+    next_idx = np.minimum(previous_idx + 1, np.maximum(count - 1, 0))
+    a = np.take_along_axis(ordered, previous_idx[:, None], axis=1)[:, 0]
+    b = np.take_along_axis(ordered, next_idx[:, None], axis=1)[:, 0]
+    # Same interpolation as numpy's _lerp(), which switches form at gamma >= 0.5 for accuracy
+    diff = b - a
+    result = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    return np.where(count > 0, result, np.nan)
+
+def _row_median(values: np.ndarray):
+    """Per-row NaN-skipping median, NaN for rows without any values"""
+    if values.shape[1] == 0:
+        return np.full(len(values), np.nan)
+    ordered = np.sort(values, axis=1)
+    count = np.sum(~np.isnan(values), axis=1)
+    lo = np.maximum((count - 1) // 2, 0)
+    hi = np.maximum(count // 2, 0)
+    a = np.take_along_axis(ordered, lo[:, None], axis=1)[:, 0]
+    b = np.take_along_axis(ordered, hi[:, None], axis=1)[:, 0]
+    return np.where(count > 0, (a + b) / 2, np.nan)
+
+def batch_site_metrics(site_nos: list, flow: np.ndarray, dates: np.ndarray, data_range: int, quantile: float, present: np.ndarray=None, crop: bool=True):
+    """Computes the site_metrics rows of single_site_data() for many sites at once from a sites x days matrix (see build_flow_matrix()).
+       Thresholds, exceedance masks, annual sums, event counts and timing are all broadcast across sites. Sites without data in the
+       analyzed range are dropped, as they are in the per-site loop. Also returns the per site/water year series used by the MK tests"""
+    if present is None:
+        present = ~np.isnan(flow)
+
+    # Crop to the analyzed range, these are column views rather than copies
+    date_threshold = pd.to_datetime(DEFAULT_END).date() - timedelta(days=365.25 * data_range)
+    cols = slice(np.searchsorted(dates, np.datetime64(date_threshold)), None) if crop else slice(None)
+    flow, present, dates = flow[:, cols], present[:, cols], dates[cols]
+    n_sites, n_days = flow.shape
+    water_year, dohy = water_year_calendar(dates)
+
+    # Shared water year and month boundaries of the calendar
+    new_year = np.r_[True, water_year[1:] != water_year[:-1]]
+    year_starts = np.flatnonzero(new_year)
+    year_of_col = np.cumsum(new_year) - 1
+    month_num = dates.astype('datetime64[M]').astype(np.int64)
+    month_starts = np.flatnonzero(np.r_[True, month_num[1:] != month_num[:-1]])
+    month = month_num % 12 + 1
+
+    # Validation against the full analyzed range
+    t_delta = pd.to_datetime(DEFAULT_END) - pd.to_datetime(date_threshold)
+    rows = present.sum(axis=1)
+    missing = np.maximum(1.0 - rows / t_delta.days, 0)
+
+    # Thresholds and exceedance masks
+    threshold = _row_quantile(flow, quantile)
+    with np.errstate(invalid='ignore'):
+        above = flow > threshold[:, None]
+        cont = np.where(flow >= threshold[:, None], flow, 0.0)
+    excess = np.where(cont > 0, (cont - threshold[:, None]) * SEC_PER_DAY, 0.0)
+    excess_km = excess * CUBIC_FT_KM_FACTOR
+    flow_bool = excess > 0
+
+    # Per site water year aggregates
+    year_present = np.logical_or.reduceat(present, year_starts, axis=1)
+    delta = year_present.sum(axis=1)
+    hmf_years = np.logical_or.reduceat(above, year_starts, axis=1).sum(axis=1)
+    annual_hmf = np.add.reduceat(excess, year_starts, axis=1) * CUBIC_FT_KM_FACTOR
+    annual_mag = np.add.reduceat(excess_km, year_starts, axis=1)
+    total_days = np.add.reduceat(flow_bool, year_starts, axis=1, dtype=np.int64).astype(np.float64)
+
+    # Event starts, comparing each row to the previous row the site actually has (gaps do not split events)
+    col_idx = np.arange(n_days)
+    last_row = np.maximum.accumulate(np.where(present, col_idx, -1), axis=1)
+    prev_row = np.concatenate([np.full((n_sites, 1), -1), last_row[:, :-1]], axis=1)
+    prev_bool = np.take_along_axis(flow_bool, np.maximum(prev_row, 0), axis=1) & (prev_row >= 0)
+    prev_year = year_of_col[np.maximum(prev_row, 0)]
+    starts = flow_bool & (~prev_bool | (prev_year != year_of_col))
+    total_events = np.add.reduceat(starts, year_starts, axis=1, dtype=np.int64).astype(np.float64)
+    has_events = total_events > 0
+    event_hmf = np.divide(annual_hmf, total_events, out=np.zeros(annual_hmf.shape), where=has_events)
+    duration = np.divide(total_days, total_events, out=np.zeros(total_days.shape), where=has_events)
+
+    # Timing, first column per site/year at which cumulative HMF reaches half of the year's total
+    defl_excess = np.where(above, excess, 0.0)
+    cumsum = np.cumsum(defl_excess, axis=1)
+    base = np.concatenate([np.zeros((n_sites, 1)), cumsum[:, year_starts[1:] - 1]], axis=1)
+    year_total = np.concatenate([base[:, 1:], cumsum[:, -1:]], axis=1) - base
+    reached = above & (cumsum - base[:, year_of_col] >= year_total[:, year_of_col] / 2)
+    first_reached = np.minimum.reduceat(np.where(reached, col_idx, n_days), year_starts, axis=1)
+    timing = np.where(first_reached < n_days, dohy[np.minimum(first_reached, n_days - 1)], np.nan)
+
+    # Monthly HMF, summed per (year, month) period and then per calendar month
+    defl_km = np.where(above, excess_km, np.nan)
+    period_sum = np.add.reduceat(np.where(above, excess_km, 0.0), month_starts, axis=1)
+    period_any = np.logical_or.reduceat(above, month_starts, axis=1)
+    period_month = month[month_starts]
+    hmf_per_month = np.zeros((n_sites, 12))
+    for m in range(12):
+        in_month = period_month == m + 1
+        month_sum = period_sum[:, in_month].sum(axis=1)
+        month_count = period_any[:, in_month].sum(axis=1)
+        hmf_per_month[:, m] = np.divide(month_sum, month_count, out=np.zeros(n_sites), where=month_count > 0)
+
+    # Medians over years present (or years with HMF for timing) and over HMF days
+    def year_median(values):
+        return _row_median(np.where(year_present, values, np.nan))
+    six_month = (month >= 11) | (month <= 4)
+    three_month = (month >= 12) | (month <= 2)
+
+    site_metrics = {
+        'analyze_range': delta, 'threshold': threshold, 'hmf_years': hmf_years, 'annual_hmf': _row_median(defl_km),
+        'six_mo_hmf': _row_median(defl_km[:, six_month]), 'three_mo_hmf': _row_median(defl_km[:, three_month]),
+        'annual_duration': year_median(total_days), 'event_duration': year_median(duration), 'event_hmf': year_median(event_hmf),
+        'intra_annual': year_median(total_events), 'timing': _row_median(timing),
+    }
+
+    first_col = np.argmax(present, axis=1)
+    last_col = n_days - 1 - np.argmax(present[:, ::-1], axis=1)
+    keep = delta > 0
+    df_metrics = pd.DataFrame({
+        'dataset_ID': data_range * quantile,
+        'site_no': site_nos,
+        'analyze_start': dates[first_col].astype(object),
+        'analyze_end': dates[last_col].astype(object),
+        'quantile': quantile,
+        'valid': missing < MAX_MISSING_THRESHOLD,
+        'missing_data%': [round(float(m), 5) * 100 for m in missing],
+        'inter_annual%': [min((round(int(h) / int(d), 5) * 100), 100) if d else np.nan for h, d in zip(hmf_years, delta)],
+        **site_metrics,
+    })
+    df_metrics[MONTHLY_HMF_COLS] = hmf_per_month
+    df_metrics = df_metrics[SITE_METRIC_COLS + MONTHLY_HMF_COLS][keep].reset_index(drop=True)
+
+    annual = {'water_year': water_year[year_starts], 'present': year_present[keep], 'magnitude': annual_mag[keep], 'duration': total_days[keep],
+              'intra_annual': total_events[keep], 'event_mag': event_hmf[keep], 'event_dur': duration[keep], 'timing': timing[keep]}
+    return df_metrics, annual
+
+def batch_site_data(site_frames: list, quantiles_list: list=QUANTILE_LIST, data_ranges_list: list=DATA_RANGE_LIST):
+    """Batched equivalent of running single_site_data() over a list of merge_tidal() frames (i.e. one HUC2), returning the site_metrics
+       rows in the same site-major order. The flow matrix is built once and shared by every data range and quantile"""
+    site_nos, flow, present, dates = build_flow_matrix(site_frames)
+    site_order = {site_no: i for i, site_no in enumerate(site_nos)}
+
+    df_list = []
+    for data_range in data_ranges_list:
+        for quantile in quantiles_list:
+            df_metrics, _ = batch_site_metrics(site_nos, flow, dates, data_range, quantile, present)
+            df_list.append(df_metrics)
+
+    df_site_data = pd.concat(df_list, ignore_index=True)
+    df_site_data = df_site_data.iloc[np.argsort(df_site_data['site_no'].map(site_order).values, kind='stable')]
+    return df_site_data.reset_index(drop=True)
+
 def create_state_uri(state: str, param: str):
     """Creates the URL on a per state from which a list of site_id's to be processed and analzyed is scraped"""
     return f'https://waterdata.usgs.gov/{state}/nwis/current?index_pmcode_STATION_NM=1&index_pmcode_DATETIME=2&index_pmcode_{PARAM_CODE}=3&group_key=NONE&format=sitefile_output&sitefile_output_format=rdb&column_name=site_no&column_name=station_nm&column_name=dec_lat_va&column_name=dec_long_va&column_name=sv_begin_date&column_name=sv_end_date&sort_key_2=site_no&html_table_group_key=NONE&rdb_compression=file&list_of_search_criteria=realtime_parameter_selection'
@@ -473,9 +1129,7 @@ def filter_by_valid(df: pd.DataFrame):
 
 def gages_2_filtering(df: pd.DataFrame):
     """Adds a column to the site dataframe indicating presence in the HCDN-2009 Gages-II Network"""
-    path = 'GagesII/g2_list.csv'
-    df_g2 = pd.read_csv(path)        
-    df['HCDN_2009'] = df['site_no'].isin(df_g2['STAID'].astype(str)) 
+    df['HCDN_2009'] = df['site_no'].isin(rf.gages_2_sites())
     return df
 
 #-------------------------------#
@@ -488,75 +1142,53 @@ def merge_mk_results(df_mk_complete: pd.DataFrame, df_mk_metric: pd.DataFrame, s
     df_mk_metric.insert(1, 'site_no', site_no)    
     return pd.concat([df_mk_complete.reset_index(drop=True), df_mk_metric.reset_index(drop=True)], axis=0)
 
+def write_dataset(frames: dict, path: str, output_format: str=OUTPUT_FORMAT, excel: bool=EXPORT_EXCEL):
+    """Writes a dataset's {sheet_name: df} frames as <path>/<sheet_name>.<output_format>, and as <path>.xlsx in a single writer session"""
+    os.makedirs(path, exist_ok=True)
+    for sheet, df in frames.items():
+        df = df.reset_index(drop=True)
+        if output_format == 'feather':
+            df.to_feather(f'{path}/{sheet}.feather')
+        else:
+            df.to_parquet(f'{path}/{sheet}.parquet', index=False)
+
+    if excel:
+        with pd.ExcelWriter(f'{path}.xlsx') as writer:
+            for sheet, df in frames.items():
+                df.to_excel(writer, sheet_name=sheet, index=False)
+
+def load_data(path: str, sheet: str=SHEET_NAMES[0]):
+    """Loads a single sheet of a dataset given its path without extension (i.e. 'Prelim_Data/_National_Metrics/National_Metrics_30_90').
+       Columnar files are preferred, otherwise <path>.xlsx is read. 'NA' and date columns come back the same way read_excel() returns them"""
+    for ext, read in [('parquet', pd.read_parquet), ('feather', pd.read_feather)]:
+        if os.path.exists(f'{path}/{sheet}.{ext}'):
+            df = read(f'{path}/{sheet}.{ext}')
+            break
+    else:
+        return pd.read_excel(f'{path}.xlsx', sheet_name=sheet, dtype=DATASET_DTYPES)
+
+    region_cols = [col for col in DATASET_DTYPES if col != 'site_no' and col in df.columns]
+    df[region_cols] = df[region_cols].replace('NA', np.nan)
+    for col in DATASET_DATE_COLS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+@tr.traced('save_data')
 def save_data(df_site_metrics: pd.DataFrame, df_mk_magnitude: pd.DataFrame, df_mk_duration: pd.DataFrame, df_mk_intra_annual: pd.DataFrame,
-              df_mk_event_mag: pd.DataFrame, df_mk_event_dur: pd.DataFrame, df_mk_timing: pd.DataFrame, aq_name: str):
-    """Splits the resulting 'aquifer_sites' dataframe into individual frames and saves them as CSV's into Prelim_Data"""
-    
+              df_mk_event_mag: pd.DataFrame, df_mk_event_dur: pd.DataFrame, df_mk_timing: pd.DataFrame, aq_name: str,
+              output_format: str=OUTPUT_FORMAT, excel: bool=EXPORT_EXCEL):
+    """Splits the site metric and MK frames by dataset_ID and writes one dataset per data range and quantile to
+       Prelim_Data/<aq_name>_<data_range>_<quantile> (see write_dataset())"""
     dataframes = [df_site_metrics, df_mk_magnitude, df_mk_duration, df_mk_intra_annual, df_mk_event_mag, df_mk_event_dur, df_mk_timing]
-    sheet_names = ['site_metrics', 'mk_magnitude', 'mk_duration', 'mk_intra_annual', 'mk_event_mag', 'mk_event_dur', 'mk_timing']
-    step = len(dataframes)
-    passes = len(QUANTILE_LIST) * len(DATA_RANGE_LIST)
-    
-    # Creating lists of each of the 4 (2 date range x 2 quantile) dataframes based on ID     
-    df_master_list = []
-    # 0 = site_metrics, 1 = magnitude, 2 = duration, 3 = intra_annual
-    for df in dataframes:
-        df_list = [group for _, group in df.groupby('dataset_ID')]
-        for df_l in df_list:
-            df_l = df_l.drop('dataset_ID', axis=1)
-            df_l = df_l.drop_duplicates(subset=['site_no'])
-            df_l = df_l.reset_index(drop=True)
-            df_master_list.append(df_l)
-            
-    # Reordering df_master_list so that dataframes are grouped by spreadsheet they're a member of
-    order_key = [i + j for j in range(passes) for i in range(0, len(df_master_list), passes)]
-    df_master_list = [df_master_list[i] for i in order_key]        
-    
-    # Step through the master list, adding the first 4 dataframes to the first spreadsheet, the second four to the second, and so on        
-    for i, df in enumerate(df_master_list):
-        if i // step == 0: # First 7 dataframes
-            path = f'Prelim_Data/{aq_name}_{DATA_RANGE_LIST[0]}_{int(QUANTILE_LIST[0] * 100)}.xlsx'
-            if os.path.exists(path):               
-                with pd.ExcelWriter(path, mode='a') as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)                  
-            else:
-                with pd.ExcelWriter(path) as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)
-                                        
-        elif i // step == 1:
-            path = f'Prelim_Data/{aq_name}_{DATA_RANGE_LIST[0]}_{int(QUANTILE_LIST[1] * 100)}.xlsx'
-            if os.path.exists(path):               
-                with pd.ExcelWriter(path, mode='a') as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)                  
-            else:
-                with pd.ExcelWriter(path) as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)  
-                    
-        elif i // step == 2:
-            path = f'Prelim_Data/{aq_name}_{DATA_RANGE_LIST[1]}_{int(QUANTILE_LIST[0] * 100)}.xlsx'
-            if os.path.exists(path):               
-                with pd.ExcelWriter(path, mode='a') as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)                  
-            else:
-                with pd.ExcelWriter(path) as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)  
-                    
-        else: # 13-16
-            path = f'Prelim_Data/{aq_name}_{DATA_RANGE_LIST[1]}_{int(QUANTILE_LIST[1] * 100)}.xlsx'
-            if os.path.exists(path):               
-                with pd.ExcelWriter(path, mode='a') as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)                  
-            else:
-                with pd.ExcelWriter(path) as writer:
-                    df.to_excel(writer, sheet_name=sheet_names[i % step], index=False)    
-
-
-def save_plot_as_image(img_path: str, overwrite: bool=False):
-    """Saves a generated plot as an image to the specified img_path"""    
-    if os.path.exists(img_path) and overwrite:
-        plt.savefig(img_path)
-    elif not os.path.exists(img_path):
-        plt.savefig(img_path)        
+
+    for data_range in DATA_RANGE_LIST:
+        for quantile in QUANTILE_LIST:
+            frames = {}
+            for sheet, df in zip(SHEET_NAMES, dataframes):
+                df = df[df['dataset_ID'] == data_range * quantile].drop('dataset_ID', axis=1)
+                frames[sheet] = df.drop_duplicates(subset=['site_no']).reset_index(drop=True)
+            write_dataset(frames, f'Prelim_Data/{aq_name}_{data_range}_{int(quantile * 100)}', output_format, excel)
 
 def single_site_report(df_single_site: pd.DataFrame):
     """Produces console report for single_site_data()"""
@@ -576,80 +1208,3 @@ def single_site_report(df_single_site: pd.DataFrame):
     print(f'Center of Mass: {df_single_site["timing"].to_string(index=False)}')
     print(f'6 Month HMF in km^3/year: {df_single_site["six_mo_hmf"].to_string(index=False)}')
     print(f'3 Month HMF in km^3/year: {df_single_site["three_mo_hmf"].to_string(index=False)}')
-    
-#-----------------------------------#
-#-------# PLOTTING FUNCTIONS #------#
-#-----------------------------------#
-
-def plot_lower_48(ax: plt.Axes, crs: int=4269, facecolor: str='grey', edgecolor: str='darkgrey', linewidth: float=0.75, alpha: float=1.0, zorder: int=1):
-    """Plots a simple basemap of the lower 48 with state boundaries"""
-    lower48 = gpd.read_file('ShapeFiles/Lower48/lower48.shp')        
-    lower48 = lower48.to_crs(crs)
-    lower48.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, linewidth=linewidth, alpha=alpha, zorder=zorder) 
-    
-def plot_stream_network(stream_network_shapefile, ax: plt.Axes, crs: int=4269, color: str='blue', linewidth: float=0.75, alpha: float=0.30, zorder: int=1):
-    """Plots a nationwide stream network"""
-    stream_network = stream_network_shapefile.to_crs(crs)
-    stream_network.plot(ax=ax, color=color, linewidth=linewidth, alpha=alpha, zorder=zorder)     
-    
-def plot_basemap(ax: plt.Axes, crs: int=4269, source: cx.providers=cx.providers.OpenStreetMap.Mapnik, zoom: int=7):
-    """Plots a contexily basemap"""
-    ax.margins(0, tight=True)
-    ax.set_axis_off()
-    cx.add_basemap(ax, crs=crs, source=source, zoom=zoom)
-    
-def convert_geometry(df: pd.DataFrame):
-    """Converts 'dec_lat/long_va' columns to geopandas dataframe"""
-    lat = df['dec_lat_va']
-    long = df['dec_long_va']
-    geometry = [Point(xy) for xy in zip(long, lat)]
-    geo_df = gpd.GeoDataFrame(geometry=geometry)
-    return geo_df
-
-def scale_colorbar(df: pd.DataFrame, metric: str):
-    """Set colorbar scale format based on min/max of metric being plotted"""
-    vmin = df[metric].min()
-    vmax = df[metric].max()        
-    norm = mcolors.Normalize(vmin, vmax)
-    cmap = 'plasma'
-    mappable = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-    mappable.set_array(df[metric])    
-    return cmap, mappable
-
-def plot_rateb_aquifers(ax, crs: int=4269, edgecolor: str='orange', facecolor: str='none', alpha: float=0.75, linewidth: float=1.00):
-    """Plots the aquifer outlines as used by Rateb et al. 2020"""
-    rateb_aqs = gpd.read_file('ShapeFiles/Lower48/POWELL_AQs_2020.shp')
-    rateb_aqs = rateb_aqs.to_crs(crs)
-    rateb_aqs.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)
-    
-def plot_huc2(ax, shapefile, codes: list=[], crs: int=4269, edgecolor: str='royalblue', facecolor: str='cornflowerblue', alpha: float=0.30, linewidth: float=1.00):
-    """Plots HUC2 shapefiles either by a list of codes or all HUC2's if no list is provided"""
-    if codes == [-1]: return
-    # If no list is provided, plot all HUC2's
-    shapefile = shapefile.to_crs(crs)
-    if not codes:        
-        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)       
-    else:
-        shapefile = shapefile[shapefile['huc2_code'].isin(codes)]
-        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth) 
-                        
-def plot_huc4(ax, shapefile, codes: list=[], crs: int=4269, edgecolor: str='royalblue', facecolor: str='cornflowerblue', alpha: float=0.30, linewidth: float=1.00):
-    """Plots HUC4 shapefiles either by a list of codes or all HUC2's if no list is provided"""
-    if codes == [-1]: return
-    # If no list is provided, plot all HUC4's
-    shapefile = shapefile.to_crs(crs)
-    if not codes:        
-        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)       
-    else:
-        shapefile = shapefile[shapefile['huc4_code'].isin(codes)]
-        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)
-        
-def set_plot_bounds(shapefile, padding: float=3.0):
-    """Sets the plot bounds for single aquifer plotting"""
-    xmin, ymin, xmax, ymax = shapefile.total_bounds
-    padding = padding
-    xmin -= padding
-    ymin -= padding
-    xmax += padding
-    ymax += padding
-    return xmin, xmax, ymin, ymax 
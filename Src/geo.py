@@ -0,0 +1,36 @@
+# Geospatial helpers for labelling gauges with their HUC2, HUC4 and aquifer. Kept apart from the analysis functions in Src/func.py so
+# geopandas and shapely are only imported when they are used (also available as fn.<name>).
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from shapely.geometry import Point
+
+# Output column and the shapefile column it is labelled from, in the order of the huc2, huc4 and aquifer layers passed to assign_regions()
+REGION_COLS = [('huc2_code', 'huc2_code'), ('huc4_code', 'huc4_code'), ('within_aq', 'aq_name')]
+
+def region_labels(lons: np.ndarray, lats: np.ndarray, gdf: gpd.GeoDataFrame, column: str, fill: str='NA'):
+    """Labels every point with the column value of the polygon containing it using the layer's STRtree spatial index. Where polygons
+       overlap the last containing row wins, matching the iterrows() loops this replaces (their 'continue' never ended the scan)"""
+    points = gpd.points_from_xy(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+    point_idx, poly_idx = gdf.sindex.query(points, predicate='within')
+    labels = np.full(len(points), fill, dtype=object)
+    if len(point_idx):
+        order = np.lexsort((poly_idx, point_idx))
+        point_idx, poly_idx = point_idx[order], poly_idx[order]
+        last = np.append(point_idx[1:] != point_idx[:-1], True)
+        labels[point_idx[last]] = gdf[column].to_numpy()[poly_idx[last]]
+    return labels
+
+def assign_regions(lons: np.ndarray, lats: np.ndarray, huc2_gdf: gpd.GeoDataFrame, huc4_gdf: gpd.GeoDataFrame, aq_gdf: gpd.GeoDataFrame):
+    """Returns the huc2_code, huc4_code and within_aq labels ('NA' outside every polygon) for arrays of gauge coordinates"""
+    layers = [huc2_gdf, huc4_gdf, aq_gdf]
+    return pd.DataFrame({col: region_labels(lons, lats, gdf, gdf_col) for (col, gdf_col), gdf in zip(REGION_COLS, layers)})
+
+def convert_geometry(df: pd.DataFrame):
+    """Converts 'dec_lat/long_va' columns to geopandas dataframe"""
+    lat = df['dec_lat_va']
+    long = df['dec_long_va']
+    geometry = [Point(xy) for xy in zip(long, lat)]
+    geo_df = gpd.GeoDataFrame(geometry=geometry)
+    return geo_df
@@ -1,117 +1,334 @@
 # This script is a one-time use script to download ALL HUC2/4 shapefiles from: https://apps.nationalmap.gov/downloader/#/
-# as it's easier to sort through them locally rather than on the website. All necessary HUC4's for this study should be 
+# as it's easier to sort through them locally rather than on the website. All necessary HUC4's for this study should be
 # available on my GitHub (https://github.com/AlekWithK) making this tool redundant for future use.
+#
+# Archives are streamed to disk in chunks by a small thread pool. An interrupted download is kept as a .part file and resumed with an
+# HTTP Range request, and every finished archive is checked against its Content-Length (and its MD5 when the ETag is one). Each archive's
+# outcome (complete, missing or failed, with size and SHA-256) is recorded in a manifest.json next to the downloads, so a rerun only
+# requests what is still outstanding. Codes the server does not have are remembered as missing rather than requested again.
+#
+# Usage: python -m Src.huc_downloader <huc4 | huc2> [target_folder] [workers]
+# Usage for an offline benchmark against a local stand-in server: python -m Src.huc_downloader benchmark [num_archives] [workers]
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import zipfile
+import tempfile
+import threading
+import requests
 
-def huc4_downloader():
-    target_folder = 'D:/HUC4/'
-    test_limit = math.inf
-
-    # HUC4's I've already downloaded -- Make empty if starting from scratch
-    blacklist = set([])
-
-    # Where 0101 is the smallest HUC4 code and 2204 is the largest on the USGS website
-    with open(f'{target_folder}logfile.txt', 'a') as file:
-        sys.stdout = file
-        
-        count = 0
-        for code in range(int('0101'), 2205):
-            count += 1
-        
-            # Handle HUC4 codes with leading zeros
-            if len(str(code)) == 3:
-                code = '0' + str(code)            
-                            
-            if code in blacklist:
-                print(f'NHD_H_{code} previously downloaded')
-                continue
-            
-            if os.path.exists(target_folder + f'NHD_H_{code}_HU4_Shape.zip'):
-                print(f'NHD_H_{code} already in folder')
-                continue
-
-            try:
-                download_url = f'https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography/NHD/HU4/Shape/NHD_H_{str(code)}_HU4_Shape.zip'
-                response = requests.get(download_url, stream=True)
-                if response.status_code == 200:
-                    with open(target_folder + f'NHD_H_{code}_HU4_Shape.zip', 'wb') as f:
-                        print(f'Downloading NHD_H_{code}...')
-                        f.write(response.content)
-                            
-                else:
-                    print(f'Invalid response for NHD_H_{code}: {response.status_code}')
-                    print(f'URL: {download_url}')
-                    continue
-                            
-            except Exception as e:
-                print(f'Error downloading NHD_H_{code}: {e}')
-                continue
-            
-            # Testing breakout
-            if count > test_limit:
-                break
-        
-        sys.stdout = sys.__stdout__
-        
-def huc2_downloader():
-    target_folder = 'D:/HUC2/'
-    test_limit = math.inf
-    
-    with open(f'{target_folder}logfile.txt', 'a') as file:
-        sys.stdout = file
-        count = 0
-        for code in range(int('01'), 19):
-            if len(str(code)) == 1:
-                code = '0' + str(code)
-                
-            if os.path.exists(target_folder + f'WBD_{code}_HU2_Shape.zip'):
-                print(f'WBD_{code} already in folder')
-                continue
-            
-            try:
-                download_url = f'https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography/WBD/HU2/Shape/WBD_{str(code)}_HU2_Shape.zip'
-                response = requests.get(download_url, stream=True)
-                if response.status_code == 200:
-                    with open(target_folder + f'WBD_{code}_HU2_Shape.zip', 'wb') as f:
-                        print(f'Downloading WBD_{code}...')
-                        f.write(response.content)
-                        
-                else:
-                    print(f'Invalid response for WBD_{code}: {response.status_code}')
-                    print(f'URL: {download_url}')
-                    continue
-                
-            except Exception as e:
-                print(f'Error downloading WBD_{code}: {e}')
-                continue
-            
-                        # Testing breakout
-            if count > test_limit:
-                break
-        
-        sys.stdout = sys.__stdout__
-    
-
-if __name__ == '__main__':    
-    import requests
-    import os
-    import math
-    import sys
-    
-    if len(sys.argv) < 2:
-        print('Usage: python huc4_downloader.py <huc4 | huc2>')
-        sys.exit(1)
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import Src.fetch_pool as fp
+import Src.atomic as at
+
+BASE_URL = 'https://prd-tnm.s3.amazonaws.com/StagedProducts/Hydrography'
+# Server folder, archive name and default local folder for each HUC level
+ARCHIVES = {'huc4': ('NHD/HU4/Shape', 'NHD_H_{code}_HU4_Shape.zip', 'D:/HUC4/'),
+            'huc2': ('WBD/HU2/Shape', 'WBD_{code}_HU2_Shape.zip', 'D:/HUC2/')}
+MANIFEST_NAME = 'manifest.json'
+PART_SUFFIX = '.part'
+CHUNK_SIZE = 2 ** 20
+# The archives are hundreds of MB each, so a few concurrent streams saturate most connections
+MAX_WORKERS = 4
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 1.0
+TIMEOUT_SECONDS = 60
+# Statuses recorded in the manifest. Complete and missing archives are not requested again (missing ones unless retry_missing is set)
+COMPLETE, MISSING, FAILED, PARTIAL = 'complete', 'missing', 'failed', 'partial'
+
+def huc_codes(level: str):
+    """Returns every possible HUC code for a level, where 0101 is the smallest HUC4 code and 2204 the largest on the USGS website"""
+    if level == 'huc2':
+        return [f'{region:02d}' for region in range(1, 19)]
+    return [f'{region:02d}{subregion:02d}' for region in range(1, 23) for subregion in range(1, 100) if region * 100 + subregion <= 2204]
+
+def archive_name(level: str, code: str):
+    return ARCHIVES[level][1].format(code=code)
+
+def archive_url(level: str, code: str, base_url: str=BASE_URL):
+    return f'{base_url}/{ARCHIVES[level][0]}/{archive_name(level, code)}'
+
+def etag_md5(etag: str):
+    """Returns the MD5 hex digest an S3 style ETag holds, or None for multipart ETags (i.e. '"<md5>-12"') and other servers' ETags"""
+    etag = (etag or '').strip('"')
+    return etag if re.fullmatch(r'[0-9a-f]{32}', etag) else None
+
+def file_digests(path: str):
+    """Returns the (MD5, SHA-256) hashers of a file's contents, read in chunks"""
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5, sha256
+
+class IntegrityError(IOError):
+    """A finished download whose size or checksum does not match what the server reported"""
+
+class Manifest:
+    """The JSON record of every archive's download outcome, shared by the download threads and rewritten atomically after each update"""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, name: str):
+        with self.lock:
+            return dict(self.entries.get(name, {}))
+
+    def update(self, name: str, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(name, {})
+            entry.update(fields, updated=datetime.now().isoformat(timespec='seconds'))
+            at.write_json(self.path, self.entries, indent=1, sort_keys=True)
+
+    def summary(self):
+        with self.lock:
+            counts = {}
+            for entry in self.entries.values():
+                counts[entry['status']] = counts.get(entry['status'], 0) + 1
+            return counts
+
+def stream_archive(url: str, path: str, etag: str=None, started=None, timeout: float=TIMEOUT_SECONDS):
+    """Streams url to path + '.part' in chunks, resuming from an existing partial file with a Range request (guarded by If-Range so a
+       changed archive restarts from scratch). started(etag) is called once the response headers arrive. The finished file is size and MD5
+       checked before being renamed to path. Returns (bytes, sha256, etag, resumed_bytes), or None if the server does not have the archive"""
+    part = path + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        if etag:
+            headers['If-Range'] = etag
+
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 404:
+            return None
+        # The part file already holds the whole archive (or no longer matches it), start over
+        if response.status_code == 416:
+            os.remove(part)
+            raise ConnectionError(f'Range not satisfiable for {url}, restarting')
+        response.raise_for_status()
+        # A 200 to a Range request means the server sent the whole archive again
+        if response.status_code != 206:
+            offset = 0
+        etag = response.headers.get('ETag', etag)
+        total = offset + int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+        if started is not None:
+            started(etag)
+
+        if offset:
+            md5, sha256 = file_digests(part)
+        else:
+            md5, sha256 = hashlib.md5(), hashlib.sha256()
+        with open(part, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                md5.update(chunk)
+                sha256.update(chunk)
+
+    size = os.path.getsize(part)
+    if total is not None and size < total:
+        # Dropped connection, the part file is kept and the retry resumes from it
+        raise ConnectionError(f'Incomplete download of {url}: {size}/{total} bytes')
+    expected_md5 = etag_md5(etag)
+    if (total is not None and size != total) or (expected_md5 and md5.hexdigest() != expected_md5):
+        os.remove(part)
+        raise IntegrityError(f'Checksum or size mismatch for {url}')
+    os.replace(part, path)
+    return size, sha256.hexdigest(), etag, offset
+
+def download_archive(level: str, code: str, target_folder: str, manifest: Manifest, limiter: fp.RateLimiter, base_url: str=BASE_URL,
+                     retry_missing: bool=False, max_retries: int=MAX_RETRIES, backoff: float=BACKOFF_SECONDS):
+    """Downloads a single archive unless the manifest already has it (or knows the server does not), retrying transient errors with
+       backoff and resuming from the partial file on every attempt. Returns the archive's manifest entry"""
+    name = archive_name(level, code)
+    path = os.path.join(target_folder, name)
+    entry = manifest.get(name)
+    status = entry.get('status')
+
+    if status == COMPLETE and os.path.exists(path) and os.path.getsize(path) == entry['bytes']:
+        return entry
+    if status == MISSING and not retry_missing:
+        return entry
+    # Archives downloaded before there was a manifest are adopted as they are
+    if status is None and os.path.exists(path):
+        manifest.update(name, code=code, status=COMPLETE, bytes=os.path.getsize(path), sha256=file_digests(path)[1].hexdigest(), resumed=0)
+        print(f'{name} already in folder')
+        return manifest.get(name)
+
+    url = archive_url(level, code, base_url)
+    # The ETag is recorded as soon as a download starts, so a partial file left by an interrupted run is only resumed against the same archive
+    started = lambda etag: manifest.update(name, code=code, url=url, status=PARTIAL, etag=etag)
+    fetch = lambda url: stream_archive(url, path, etag=manifest.get(name).get('etag'), started=started)
+    try:
+        result = fp.fetch_with_retry(fetch, url, limiter, max_retries, backoff)
+    except Exception as e:
+        print(f'Error downloading {name}: {e}')
+        manifest.update(name, code=code, url=url, status=FAILED, error=str(e))
+        return manifest.get(name)
+
+    if result is None:
+        print(f'No archive for {name} (404)')
+        manifest.update(name, code=code, url=url, status=MISSING, error=None)
     else:
-        arg = sys.argv[1]
-        
-    if arg.lower() == 'huc4':
-        huc4_downloader()
-        print('Downloads complete!')
-    elif arg.lower() == 'huc2':
-        huc2_downloader()
-        print('Downloads complete!')        
+        size, sha256, etag, resumed = result
+        print(f'Downloaded {name} ({size / 2 ** 20:.1f} MB{f", resumed at {resumed / 2 ** 20:.1f} MB" if resumed else ""})')
+        manifest.update(name, code=code, url=url, status=COMPLETE, bytes=size, sha256=sha256, etag=etag, resumed=resumed, error=None)
+    return manifest.get(name)
+
+def download_archives(level: str, target_folder: str=None, codes: list=None, workers: int=MAX_WORKERS, base_url: str=BASE_URL,
+                      retry_missing: bool=False, rate: float=None, max_retries: int=MAX_RETRIES, backoff: float=BACKOFF_SECONDS):
+    """Downloads every archive of a HUC level (or only the given codes) into target_folder with up to workers concurrent streams, and
+       returns the manifest. Each archive's outcome is in the manifest as soon as it finishes, so an interrupted run can simply be rerun"""
+    target_folder = target_folder or ARCHIVES[level][2]
+    os.makedirs(target_folder, exist_ok=True)
+    manifest = Manifest(os.path.join(target_folder, MANIFEST_NAME))
+    limiter = fp.RateLimiter(rate)
+    codes = huc_codes(level) if codes is None else codes
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda code: download_archive(level, code, target_folder, manifest, limiter, base_url, retry_missing, max_retries,
+                                                        backoff), codes))
+    return manifest
+
+def huc4_downloader(target_folder: str='D:/HUC4/', workers: int=MAX_WORKERS):
+    return download_archives('huc4', target_folder, workers=workers)
+
+def huc2_downloader(target_folder: str='D:/HUC2/', workers: int=MAX_WORKERS):
+    return download_archives('huc2', target_folder, workers=workers)
+
+#--------------------------------------#
+#-------# LOCAL STAND-IN SERVER #------#
+#--------------------------------------#
+
+def fake_archive(name: str, size: int, seed: int=0):
+    """Creates an incompressible zip archive of roughly size bytes, laid out like the USGS archives (members under Shape/)"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr(f'Shape/{name[:-4]}.bin', random.Random(seed).randbytes(size))
+    return buffer.getvalue()
+
+class ArchiveServer:
+    """A local HTTP stand-in for the USGS staged products bucket serving archives keyed by file name, with S3 style MD5 ETags and Range
+       support. The first drop_first requests for every archive are cut off halfway through the body and the first fail_first return a 503,
+       so resuming and retrying can be exercised offline"""
+    def __init__(self, archives: dict, fail_first: int=0, drop_first: int=0, latency: float=0.0):
+        self.archives = archives
+        self.etags = {name: f'"{hashlib.md5(body).hexdigest()}"' for name, body in archives.items()}
+        self.fail_first = fail_first
+        self.drop_first = drop_first
+        self.latency = latency
+        self.attempts = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                name = self.path.rsplit('/', 1)[-1]
+                with server.lock:
+                    server.attempts[name] = server.attempts.get(name, 0) + 1
+                    attempt = server.attempts[name]
+                time.sleep(server.latency)
+                if name not in server.archives:
+                    return self.reply(404, b'NoSuchKey')
+                if attempt <= server.fail_first:
+                    return self.reply(503, b'Slow Down')
+
+                body, etag = server.archives[name], server.etags[name]
+                offset = 0
+                match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+                if match and self.headers.get('If-Range', etag) == etag:
+                    offset = int(match.group(1))
+                    if offset >= len(body):
+                        return self.reply(416, b'')
+                self.send_response(206 if offset else 200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body) - offset))
+                if offset:
+                    self.send_header('Content-Range', f'bytes {offset}-{len(body) - 1}/{len(body)}')
+                self.end_headers()
+                payload = body[offset:]
+                if attempt <= server.fail_first + server.drop_first:
+                    payload = payload[:len(payload) // 2]
+                    self.close_connection = True
+                self.wfile.write(payload)
+                with server.lock:
+                    server.bytes_sent += len(payload)
+
+            def reply(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def benchmark(num_archives: int=12, workers: int=MAX_WORKERS, size_mb: float=4, drop_first: int=1, latency: float=0.2):
+    """Times serial and pooled downloads of fake archives from the stand-in server (every archive's first response is cut off halfway, and
+       one code is missing), checks every file against its manifest SHA-256, then reruns to check nothing is requested twice. Raises
+       AssertionError if an archive is not verified, the missing code is not recorded as missing or the rerun requests anything"""
+    codes = [f'{i + 1:04d}' for i in range(num_archives)]
+    archives = {archive_name('huc4', code): fake_archive(archive_name('huc4', code), int(size_mb * 2 ** 20), seed=i)
+                for i, code in enumerate(codes)}
+    total_mb = sum(len(body) for body in archives.values()) / 2 ** 20
+
+    for label, n_workers in [('serial', 1), ('pooled', workers)]:
+        with tempfile.TemporaryDirectory() as folder, ArchiveServer(archives, drop_first=drop_first, latency=latency) as server:
+            start = time.perf_counter()
+            manifest = download_archives('huc4', folder, codes + ['9999'], workers=n_workers, base_url=server.url, backoff=0.05)
+            elapsed = time.perf_counter() - start
+            unverified = [name for name, body in archives.items() if not os.path.exists(os.path.join(folder, name))
+                          or not file_digests(os.path.join(folder, name))[1].hexdigest() == manifest.get(name).get('sha256') == hashlib.sha256(body).hexdigest()]
+            sent_mb = server.bytes_sent / 2 ** 20
+            requests_made = sum(server.attempts.values())
+            download_archives('huc4', folder, codes + ['9999'], workers=n_workers, base_url=server.url)
+            rerun_requests = sum(server.attempts.values()) - requests_made
+            print(f'{label}: {num_archives} archives ({total_mb:.0f} MB) in {elapsed:.2f}s, {requests_made} requests, {sent_mb:.0f} MB sent, '
+                  f'{manifest.summary()}, verified: {not unverified}, rerun requests: {rerun_requests}')
+            if unverified:
+                raise AssertionError(f'{label}: {len(unverified)} archives do not match their manifest SHA-256: {unverified}')
+            if manifest.summary() != {COMPLETE: num_archives, MISSING: 1}:
+                raise AssertionError(f'{label}: expected {num_archives} complete and 1 missing archive, got {manifest.summary()}')
+            if rerun_requests:
+                raise AssertionError(f'{label}: the rerun made {rerun_requests} requests, expected none')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0].lower() == 'benchmark' and len(args) <= 3:
+        benchmark(int(args[1]) if len(args) > 1 else 12, int(args[2]) if len(args) > 2 else MAX_WORKERS)
+    elif args and args[0].lower() in ARCHIVES and len(args) <= 3:
+        manifest = download_archives(args[0].lower(), args[1] if len(args) > 1 else None, workers=int(args[2]) if len(args) > 2 else MAX_WORKERS)
+        print(f'Downloads complete! {manifest.summary()}')
     else:
-        print('Usage: python huc4_downloader.py <huc4 | huc2>')
+        print('Usage: python -m Src.huc_downloader <huc4 | huc2> [target_folder] [workers]')
         sys.exit(1)
-        
-
-    
\ No newline at end of file
@@ -1,96 +1,168 @@
-# A quick one-time use script to process all downloaded HUC4 zipfiles, extracting the 4 required WBDHU4 files
-# to a new folder.
-
-
-def huc4_processor():    
-    test_limit = math.inf
-    count = 0
-    target_files = ['WBDHU4.dbf', 'WBDHU4.prj', 'WBDHU4.shp', 'WBDHU4.shx']
-    target_folder = 'D:/HUC4/'
-    dest_folder = 'D:/HUC4/_processed/'    
-
-    for zipfile_name in os.listdir('D:/HUC4/'):
-        if zipfile_name.endswith('.zip'):
-            count += 1
-            print(f'Processing {zipfile_name}...')
-            zipfile_path = os.path.join(target_folder, zipfile_name)
-            
-            dest_path = f'{dest_folder}{zipfile_name[:-14]}/'
-            if not os.path.exists(dest_path):
-                os.makedirs(dest_path)
-            
-            temp = f'{target_folder}_temp/'
-            if not os.path.exists(temp):
-                os.makedirs(temp)
-                
-            with zipfile.ZipFile(zipfile_path, 'r') as zip_ref:
-                subfolder = 'Shape/'
-                for file in target_files:
-                    path_in_zip = os.path.join(subfolder, file)
-                    zip_ref.extract(path_in_zip, temp)
-                    
-                    extract_file_path = os.path.join(temp, path_in_zip)
-                    output_file_path = os.path.join(dest_path, file)
-                    shutil.move(extract_file_path, output_file_path)
-                    
-            shutil.rmtree(temp)
-            
-            if count > test_limit:
-                break   
-            
-def huc2_processor():    
-    test_limit = math.inf
-    count = 0
-    target_files = ['WBDHU2.dbf', 'WBDHU2.prj', 'WBDHU2.shp', 'WBDHU2.shx']
-    target_folder = 'D:/HUC2/'
-    dest_folder = 'D:/HUC2/_processed/'    
-
-    for zipfile_name in os.listdir('D:/HUC2/'):
-        if zipfile_name.endswith('.zip'):
-            count += 1
-            print(f'Processing {zipfile_name}...')
-            zipfile_path = os.path.join(target_folder, zipfile_name)
-            
-            dest_path = f'{dest_folder}{zipfile_name[:-14]}/'
-            if not os.path.exists(dest_path):
-                os.makedirs(dest_path)
-            
-            temp = f'{target_folder}_temp/'
-            if not os.path.exists(temp):
-                os.makedirs(temp)
-                
-            with zipfile.ZipFile(zipfile_path, 'r') as zip_ref:
-                subfolder = 'Shape/'
-                for file in target_files:
-                    path_in_zip = os.path.join(subfolder, file)
-                    zip_ref.extract(path_in_zip, temp)
-                    
-                    extract_file_path = os.path.join(temp, path_in_zip)
-                    output_file_path = os.path.join(dest_path, file)
-                    shutil.move(extract_file_path, output_file_path)
-                    
-            shutil.rmtree(temp)
-            
-            if count > test_limit:
-                break   
+# A quick one-time use script to process all downloaded HUC2/4 zipfiles (see Src/huc_downloader.py) into a single master layer per
+# HUC level. The WBDHU2/WBDHU4 layer is read straight out of every archive (no extraction to a temp folder), archives are read by a
+# process pool, and the combined layer is written once as GeoParquet in EPSG:4269 with a bounding box covering column, so loading
+# master_huc4 is a single columnar read rather than a shapefile parse, and bbox reads only touch the row groups they need.
+#
+# Usage: python -m Src.huc_processor <huc4 | huc2> [archive_folder] [workers]
+# Usage for an offline benchmark on synthetic archives: python -m Src.huc_processor benchmark [num_archives] [workers]
+import os
+import re
+import sys
+import time
+import shutil
+import zipfile
+import tempfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
 
-if __name__ == '__main__':
-    import os
-    import sys
-    import zipfile
-    import shutil
-    import math
-    
-    if len(sys.argv) < 2:
-        print('Usage: python huc_processor.py <huc4 | huc2>')
-        sys.exit(1)
+from concurrent.futures import ProcessPoolExecutor
+
+import Src.reference as rf
+import Src.atomic as at
+
+MASTER_CRS = 4269
+# Layer inside each archive's Shape/ folder, code column added to every row, default archive folder and master layer path per HUC level
+LEVELS = {'huc4': ('WBDHU4', 'huc4_code', 'D:/HUC4/', rf.LAYERS['huc4']),
+          'huc2': ('WBDHU2', 'huc2_code', 'D:/HUC2/', rf.LAYERS['huc2'])}
+# Rows are written in archive (and so HUC code) order, which keeps neighbouring polygons in the same row groups for bbox reads
+ROW_GROUP_SIZE = 16
+MAX_WORKERS = os.cpu_count() or 1
+
+def archive_code(zipfile_name: str):
+    """Returns the HUC code in an archive name, i.e. '0101' for NHD_H_0101_HU4_Shape.zip or '01' for WBD_01_HU2_Shape.zip"""
+    return re.search(r'_(\d+)_HU\d_Shape\.zip$', zipfile_name).group(1)
+
+def list_archives(archive_folder: str):
+    """Returns the HUC archives in a folder sorted by name, the order the master layers have always been built in"""
+    return sorted(os.path.join(archive_folder, name) for name in os.listdir(archive_folder) if re.search(r'_HU\d_Shape\.zip$', name))
+
+def read_archive(zipfile_path: str, level: str):
+    """Reads a HUC level's layer directly from a downloaded archive, labelled with the archive's HUC code and in MASTER_CRS"""
+    layer, code_col = LEVELS[level][:2]
+    gdf = gpd.read_file(f'zip://{os.path.abspath(zipfile_path)}!Shape/{layer}.shp')
+    gdf[code_col] = archive_code(os.path.basename(zipfile_path))
+    return gdf.to_crs(MASTER_CRS)
+
+def write_master(gdf: gpd.GeoDataFrame, path: str):
+    """Writes a master layer as GeoParquet with a bbox covering column"""
+    with at.atomic_path(path) as temp:
+        gdf.to_parquet(temp, index=False, write_covering_bbox=True, row_group_size=ROW_GROUP_SIZE)
+
+def build_master(level: str, archive_folder: str=None, path: str=None, workers: int=MAX_WORKERS):
+    """Reads every archive of a HUC level (up to workers at a time, workers <= 1 runs serially) and writes the combined master layer.
+       Returns the master layer"""
+    archive_folder = archive_folder or LEVELS[level][2]
+    path = path or LEVELS[level][3]
+    archives = list_archives(archive_folder)
+    if workers <= 1:
+        frames = [read_archive(archive, level) for archive in archives]
     else:
-        arg = sys.argv[1]
-        
-    if arg.lower() == 'huc4':
-        huc4_processor()
-    elif arg.lower() == 'huc2':
-        huc2_processor()       
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(read_archive, archives, [level] * len(archives)))
+    for archive, gdf in zip(archives, frames):
+        print(f'Processed {os.path.basename(archive)} ({len(gdf)} polygons)')
+
+    gdf = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=MASTER_CRS)
+    write_master(gdf, path)
+    return gdf
+
+def load_master(level: str, bbox: tuple=None, path: str=None):
+    """Returns a HUC level's master layer, optionally only the polygons intersecting bbox (minx, miny, maxx, maxy in EPSG:4269). A master
+       shapefile from before the GeoParquet layers is converted once on first use"""
+    path = path or LEVELS[level][3]
+    if not os.path.exists(path):
+        shapefile_path = path.replace('.parquet', '.shp')
+        write_master(gpd.read_file(shapefile_path).to_crs(MASTER_CRS), path)
+    return gpd.read_parquet(path, bbox=bbox)
+
+#---------------------------------#
+#-------# OFFLINE BENCHMARK #-----#
+#---------------------------------#
+
+def synthetic_archive(archive_folder: str, level: str, code: str, num_vertices: int=20000, seed: int=0):
+    """Writes a fake HUC archive laid out like the USGS ones (Shape/<layer>.shp/.shx/.dbf/.prj), holding one detailed polygon in
+       EPSG:4326 so reading it also exercises the reprojection"""
+    layer, code_col = LEVELS[level][:2]
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    radius = 1 + 0.05 * rng.standard_normal(num_vertices).cumsum() / np.sqrt(num_vertices)
+    x0, y0 = -120 + (seed % 12) * 4.5, 30 + (seed // 12 % 4) * 4.5
+    polygon = shapely.Polygon(np.column_stack([x0 + radius * np.cos(angles), y0 + radius * np.sin(angles)])).buffer(0)
+    gdf = gpd.GeoDataFrame({code_col[:4]: [code], 'name': [f'Synthetic {code}'], 'areasqkm': [polygon.area * 1e4]},
+                           geometry=[polygon], crs=4326)
+    name = f'NHD_H_{code}_HU4_Shape.zip' if level == 'huc4' else f'WBD_{code}_HU2_Shape.zip'
+    with tempfile.TemporaryDirectory() as temp:
+        gdf.to_file(os.path.join(temp, f'{layer}.shp'))
+        with zipfile.ZipFile(os.path.join(archive_folder, name), 'w', zipfile.ZIP_DEFLATED) as zf:
+            for file in sorted(os.listdir(temp)):
+                zf.write(os.path.join(temp, file), f'Shape/{file}')
+
+def legacy_master(archive_folder: str, level: str, path: str):
+    """The previous pipeline, kept for comparison: extract the layer's 4 files per archive into a folder, then read every folder's
+       shapefile, concat, reproject and write the master shapefile"""
+    layer, code_col = LEVELS[level][:2]
+    dest_folder = os.path.join(archive_folder, '_processed')
+    for zipfile_path in list_archives(archive_folder):
+        dest_path = os.path.join(dest_folder, os.path.basename(zipfile_path)[:-14])
+        os.makedirs(dest_path, exist_ok=True)
+        temp = os.path.join(archive_folder, '_temp')
+        with zipfile.ZipFile(zipfile_path, 'r') as zip_ref:
+            for ext in ['dbf', 'prj', 'shp', 'shx']:
+                zip_ref.extract(f'Shape/{layer}.{ext}', temp)
+                shutil.move(os.path.join(temp, 'Shape', f'{layer}.{ext}'), os.path.join(dest_path, f'{layer}.{ext}'))
+        shutil.rmtree(temp)
+
+    gdf = gpd.GeoDataFrame()
+    for folder in sorted(os.listdir(dest_folder)):
+        shape = gpd.read_file(os.path.join(dest_folder, folder, f'{layer}.shp'))
+        shape[code_col] = folder.rsplit('_', 1)[-1]
+        gdf = pd.concat([gdf, shape], ignore_index=True)
+    gdf.to_crs(MASTER_CRS).to_file(path)
+
+def benchmark(num_archives: int=48, workers: int=MAX_WORKERS):
+    """Times building and loading a HUC4 master layer from synthetic archives with the previous extract/shapefile pipeline and with
+       build_master()/load_master(), and checks both hold the same polygons"""
+    codes = [f'{1 + i // 8:02d}{1 + i % 8:02d}' for i in range(num_archives)]
+    with tempfile.TemporaryDirectory() as folder:
+        for i, code in enumerate(codes):
+            synthetic_archive(folder, 'huc4', code, seed=i)
+
+        shapefile_path = os.path.join(folder, '_master', 'master_huc4.shp')
+        os.makedirs(os.path.dirname(shapefile_path))
+        start = time.perf_counter()
+        legacy_master(folder, 'huc4', shapefile_path)
+        legacy_build = time.perf_counter() - start
+
+        parquet_path = os.path.join(folder, '_master', 'master_huc4.parquet')
+        timings = {}
+        for label, n_workers in [('serial', 1), ('pooled', workers)]:
+            start = time.perf_counter()
+            build_master('huc4', folder, parquet_path, workers=n_workers)
+            timings[label] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gdf_shp = gpd.read_file(shapefile_path)
+        shp_load = time.perf_counter() - start
+        start = time.perf_counter()
+        gdf_pq = load_master('huc4', path=parquet_path)
+        pq_load = time.perf_counter() - start
+        bbox_rows = len(load_master('huc4', bbox=(-121, 29, -116, 34), path=parquet_path))
+
+    same = (list(gdf_shp['huc4_code']) == list(gdf_pq['huc4_code']) and gdf_pq.crs.to_epsg() == MASTER_CRS
+            and bool(gdf_shp.geometry.geom_equals_exact(gdf_pq.geometry, 1e-9).all()))
+    print(f'build: legacy {legacy_build:.2f}s, serial {timings["serial"]:.2f}s, {workers} workers {timings["pooled"]:.2f}s')
+    print(f'load: shapefile {shp_load:.3f}s, GeoParquet {pq_load:.3f}s ({shp_load / pq_load:.1f}x), bbox read {bbox_rows}/{num_archives} rows, '
+          f'same polygons: {same}')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0].lower() == 'benchmark' and len(args) <= 3:
+        benchmark(int(args[1]) if len(args) > 1 else 48, int(args[2]) if len(args) > 2 else MAX_WORKERS)
+    elif args and args[0].lower() in LEVELS and len(args) <= 3:
+        gdf = build_master(args[0].lower(), args[1] if len(args) > 1 else None, workers=int(args[2]) if len(args) > 2 else MAX_WORKERS)
+        print(f'Wrote {len(gdf)} polygons to {LEVELS[args[0].lower()][3]}')
     else:
-        print('Usage: python huc_processor.py <huc4 | huc2>')
-        sys.exit(1)    
\ No newline at end of file
+        print('Usage: python -m Src.huc_processor <huc4 | huc2> [archive_folder] [workers]')
+        sys.exit(1)
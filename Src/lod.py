@@ -0,0 +1,89 @@
+# Precomputed level-of-detail (LOD) versions of the reference map layers (see Src/reference.py). National maps used to draw every
+# vertex of the aquifer, state and HUC outlines, most of which land on the same pixel. Each layer is simplified once per tolerance in
+# LOD_TOLERANCES (degrees, in rf.MAP_CRS) and stored as GeoParquet in an _LOD folder next to the original, and the plotting helpers draw
+# the coarsest level that is still accurate to a pixel at the axes' current extent (see fn.set_plot_bounds()).
+#
+# Layers which tile the plane without overlaps (states, HUC2/4) are simplified as a coverage so neighbouring polygons keep sharing their
+# edges, overlapping layers (aquifers) are simplified polygon by polygon with their topology preserved.
+#
+# Usage to (re)build every level of the given layers, all by default: python -m Src.lod [layer ...]
+import os
+import sys
+import time
+import shapely
+import pyproj
+import geopandas as gpd
+
+import Src.reference as rf
+import Src.atomic as at
+
+LOD_TOLERANCES = [0.002, 0.005, 0.02, 0.05]
+# A level is used while its tolerance is at most this many pixels at the plotted extent
+PIXEL_TOLERANCE = 1.0
+LOD_FOLDER = '_LOD'
+
+def lod_path(name: str, tolerance: float):
+    """Returns where a layer's simplified level is stored, i.e. ShapeFiles/Lower48/_LOD/lower48_0.02.parquet"""
+    folder, file = os.path.split(rf.LAYERS[name])
+    return os.path.join(folder, LOD_FOLDER, f'{os.path.splitext(file)[0]}_{tolerance:g}.parquet')
+
+def simplify_layer(gdf: gpd.GeoDataFrame, tolerance: float):
+    """Returns a copy of gdf with its geometries simplified to within tolerance, keeping shared edges shared for coverages"""
+    geometry = gdf.geometry.values
+    if shapely.coverage_is_valid(geometry):
+        simplified = shapely.coverage_simplify(geometry, tolerance)
+    else:
+        simplified = shapely.simplify(geometry, tolerance, preserve_topology=True)
+        # Parts of a multipolygon can still be simplified into each other
+        invalid = ~shapely.is_valid(simplified)
+        simplified[invalid] = shapely.make_valid(simplified[invalid])
+    return gdf.set_geometry(gpd.GeoSeries(simplified, index=gdf.index, crs=gdf.crs))
+
+def build_lod(name: str, tolerances: list=LOD_TOLERANCES):
+    """Simplifies a layer (in rf.MAP_CRS) at every tolerance and writes the levels next to it"""
+    source = rf.layer(name)
+    for tolerance in tolerances:
+        path = lod_path(name, tolerance)
+        with at.atomic_path(path) as temp:
+            simplify_layer(source, tolerance).to_parquet(temp, index=False)
+
+def load_lod(name: str, tolerance: float):
+    """Returns a simplified level of a layer, (re)building the layer's levels if they are missing or older than the layer itself"""
+    path = lod_path(name, tolerance)
+    if rf.file_mtime(path) is None or rf.file_mtime(path) < rf.file_mtime(rf.LAYERS[name]):
+        build_lod(name)
+    return gpd.read_parquet(path)
+
+def pick_tolerance(width: float, pixels: float, tolerances: list=LOD_TOLERANCES):
+    """Returns the coarsest tolerance that is at most PIXEL_TOLERANCE pixels when width degrees span pixels pixels, or None when even
+       the finest level is too coarse and the full resolution layer should be drawn"""
+    fitting = [tolerance for tolerance in tolerances if tolerance <= PIXEL_TOLERANCE * width / pixels]
+    return max(fitting) if fitting else None
+
+def axes_tolerance(ax, crs: int=rf.MAP_CRS, default_bounds: tuple=None):
+    """Returns the tolerance to draw a layer at on ax. The extent is the axes' limits once they have been set (i.e. by
+       fn.set_plot_bounds(..., ax=ax)), otherwise default_bounds (minx, miny, maxx, maxy in crs), usually the layer's own bounds"""
+    if ax.get_autoscalex_on():
+        if default_bounds is None:
+            return None
+        xmin, ymin, xmax, ymax = default_bounds
+    else:
+        (xmin, xmax), (ymin, ymax) = ax.get_xlim(), ax.get_ylim()
+    if pyproj.CRS.from_user_input(crs) != pyproj.CRS.from_user_input(rf.MAP_CRS):
+        xmin, ymin, xmax, ymax = pyproj.Transformer.from_crs(crs, rf.MAP_CRS, always_xy=True).transform_bounds(xmin, ymin, xmax, ymax)
+    pixels = ax.get_window_extent().width
+    return pick_tolerance(abs(xmax - xmin), pixels) if pixels > 0 else None
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [name for name in rf.LAYERS if os.path.exists(rf.LAYERS[name]) or name in ('huc2', 'huc4')]
+    for name in names:
+        start = time.perf_counter()
+        try:
+            build_lod(name)
+        except Exception as e:
+            print(f'Error building {name} levels: {e}')
+            continue
+        vertices = [shapely.get_num_coordinates(load_lod(name, tolerance).geometry.values).sum() for tolerance in LOD_TOLERANCES]
+        full = shapely.get_num_coordinates(rf.layer(name).geometry.values).sum()
+        print(f'{name}: {full} vertices -> ' + ', '.join(f'{tolerance:g}: {count}' for tolerance, count in zip(LOD_TOLERANCES, vertices))
+              + f' ({time.perf_counter() - start:.1f}s)')
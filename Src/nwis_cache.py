@@ -0,0 +1,114 @@
+# A local Parquet cache in front of nwis.get_record(). Every notebook re-downloads the same daily value records for the national,
+# validity, outlet and sub-DF runs, so records are stored once per site and parameter code and only the missing date range is
+# requested on later runs. Set NWIS_OFFLINE=1 (or OFFLINE = True) to run entirely from the cache without any network access.
+import os
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datetime import timedelta
+
+import Src.func as fn
+import Src.atomic as at
+import Src.tracing as tr
+
+CACHE_DIR = 'Prelim_Data/_Record_Cache'
+OFFLINE = os.environ.get('NWIS_OFFLINE', '0') == '1'
+# Key under which the requested (covered) date range is stored in each Parquet file's schema metadata
+COVERAGE_KEY = b'nwis_cache'
+
+def cache_path(site: str, param_code: str, cache_dir: str=None):
+    """Returns the Parquet path for a single site and parameter code"""
+    return os.path.join(cache_dir or CACHE_DIR, f'{site}_{param_code}.parquet')
+
+def read_cached(site: str, param_code: str, cache_dir: str=None):
+    """Returns the cached record and its covered (start, end) dates, or no record and (None, None) if it has never been fetched"""
+    path = cache_path(site, param_code, cache_dir)
+    if not os.path.exists(path):
+        return None, (None, None)
+    table = pq.read_table(path)
+    coverage = json.loads(table.schema.metadata[COVERAGE_KEY])
+    return table.to_pandas(), (pd.to_datetime(coverage['start']).date(), pd.to_datetime(coverage['end']).date())
+
+def write_cached(df: pd.DataFrame, site: str, param_code: str, start, end, cache_dir: str=None):
+    """Writes a single site/parameter record along with the date range it covers"""
+    path = cache_path(site, param_code, cache_dir)
+    table = pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[COVERAGE_KEY] = json.dumps({'start': str(start), 'end': str(end)}).encode()
+    table = table.replace_schema_metadata(metadata)
+    with at.atomic_path(path) as temp:
+        pq.write_table(table, temp, compression='snappy')
+
+def missing_ranges(coverage: tuple, start, end):
+    """Returns the (start, end) date ranges of a request that are not already covered by the cache"""
+    if coverage[0] is None:
+        return [(start, end)]
+    ranges = []
+    if start < coverage[0]:
+        ranges.append((start, coverage[0] - timedelta(days=1)))
+    if end > coverage[1]:
+        ranges.append((coverage[1] + timedelta(days=1), end))
+    return ranges
+
+def split_by_param(df: pd.DataFrame, param_codes: list):
+    """Splits a multi-parameter get_record() frame into one frame per parameter code (i.e. '00060_Mean', '00060_Mean_cd')"""
+    frames = {}
+    for code in param_codes:
+        cols = [col for col in df.columns if col.startswith(code)]
+        frame = df[['site_no'] + cols] if cols and 'site_no' in df.columns else df[cols]
+        frames[code] = frame.dropna(subset=cols, how='all') if cols else frame.iloc[0:0]
+    return frames
+
+def fetch_record(site: str, service: str, param_codes: list, start, end):
+    """Requests a single site's record from NWIS. Kept separate so the fetch can be swapped out (i.e. by the fetch pool)"""
+    from dataretrieval import nwis
+    return nwis.get_record(sites=site, service=service, parameterCD=param_codes, start=str(start), end=str(end))
+
+@tr.traced('fetch', site_arg='sites')
+def get_record(sites: str, service: str=fn.SERVICE, parameterCD: list=[fn.PARAM_CODE, fn.TIDAL_CODE], start: str=fn.DEFAULT_START,
+               end: str=fn.DEFAULT_END, offline: bool=None, refresh: bool=False, cache_dir: str=None, fetch=fetch_record):
+    """Drop-in replacement for nwis.get_record() for a single site. Cached records are returned as-is, only date ranges which have not been
+       fetched before are requested, and nothing is requested in offline mode. refresh=True discards the cache for this site"""
+    offline = OFFLINE if offline is None else offline
+    param_codes = [parameterCD] if isinstance(parameterCD, str) else list(parameterCD)
+    start, end = pd.to_datetime(start).date(), pd.to_datetime(end).date()
+
+    cached = {}
+    pending = {}
+    for code in param_codes:
+        df_code, coverage = (None, (None, None)) if refresh else read_cached(sites, code, cache_dir)
+        cached[code] = (df_code, coverage)
+        # Group parameter codes by the date range they are missing so each range is requested once
+        for missing in missing_ranges(coverage, start, end):
+            pending.setdefault(missing, []).append(code)
+
+    if pending and not offline:
+        for (range_start, range_end), codes in pending.items():
+            df_new = fetch(sites, service, codes, range_start, range_end)
+            for code, df_code_new in split_by_param(df_new, codes).items():
+                df_code, coverage = cached[code]
+                if df_code is not None and not df_code.empty:
+                    df_code_new = pd.concat([df_code, df_code_new])
+                    df_code_new = df_code_new[~df_code_new.index.duplicated(keep='last')].sort_index()
+                new_start = min(range_start, coverage[0]) if coverage[0] else range_start
+                new_end = max(range_end, coverage[1]) if coverage[1] else range_end
+                write_cached(df_code_new, sites, code, new_start, new_end, cache_dir)
+                cached[code] = (df_code_new, (new_start, new_end))
+
+    # Reassemble the requested range in the same shape get_record() returns (datetime index, one column set per parameter)
+    frames = []
+    for code in param_codes:
+        df_code = cached[code][0]
+        if df_code is None or df_code.empty:
+            continue
+        dates = df_code.index.tz_localize(None) if df_code.index.tz is not None else df_code.index
+        df_code = df_code[(dates >= pd.Timestamp(start)) & (dates <= pd.Timestamp(end))]
+        frames.append(df_code.drop(columns='site_no', errors='ignore'))
+
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, axis=1).sort_index()
+    df.insert(0, 'site_no', sites)
+    return df
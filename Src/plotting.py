@@ -0,0 +1,188 @@
+# Plotting helpers for the national and aquifer maps. Kept apart from the analysis functions in Src/func.py so that importing those (i.e.
+# in process pool workers) does not load matplotlib, geopandas or contextily, they remain available as fn.<name> and this module is
+# imported the first time one of them is used.
+import os
+import pandas as pd
+import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+import contextily as cx
+
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+import Src.func as fn
+import Src.classes as cl
+import Src.geo as geo
+import Src.reference as rf
+import Src.lod as lod
+import Src.tile_cache as tc
+
+#-----------------------------------#
+#-------# PLOTTING FUNCTIONS #------#
+#-----------------------------------#
+
+def layer_at_extent(name: str, ax: plt.Axes, crs: int=4269):
+    """Returns the coarsest level of detail of a reference layer that is accurate to a pixel at the axes' extent (see Src/lod.py). Set
+       the extent with set_plot_bounds(..., ax=ax) before plotting, otherwise the layer's full extent is assumed"""
+    return rf.lod_layer(name, crs, lod.axes_tolerance(ax, crs, rf.layer(name, crs).total_bounds))
+
+def plot_lower_48(ax: plt.Axes, crs: int=4269, facecolor: str='grey', edgecolor: str='darkgrey', linewidth: float=0.75, alpha: float=1.0, zorder: int=1):
+    """Plots a simple basemap of the lower 48 with state boundaries"""
+    lower48 = layer_at_extent('lower48', ax, crs)
+    lower48.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, linewidth=linewidth, alpha=alpha, zorder=zorder) 
+    
+def plot_stream_network(stream_network_shapefile, ax: plt.Axes, crs: int=4269, color: str='blue', linewidth: float=0.75, alpha: float=0.30, zorder: int=1):
+    """Plots a nationwide stream network"""
+    stream_network = stream_network_shapefile.to_crs(crs)
+    stream_network.plot(ax=ax, color=color, linewidth=linewidth, alpha=alpha, zorder=zorder)     
+    
+def plot_basemap(ax: plt.Axes, crs: int=4269, source: cx.providers=cx.providers.OpenStreetMap.Mapnik, zoom: int=7, store: tc.TileStore=None):
+    """Plots a contexily basemap, with tiles read through the local tile store (see Src/tile_cache.py) so they are only ever downloaded
+       once"""
+    ax.margins(0, tight=True)
+    ax.set_axis_off()
+    tc.add_basemap(ax, crs=crs, source=source, zoom=zoom, store=store)
+    
+def scale_colorbar(df: pd.DataFrame, metric: str):
+    """Set colorbar scale format based on min/max of metric being plotted"""
+    vmin = df[metric].min()
+    vmax = df[metric].max()        
+    norm = mcolors.Normalize(vmin, vmax)
+    cmap = 'plasma'
+    mappable = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
+    mappable.set_array(df[metric])    
+    return cmap, mappable
+
+def plot_rateb_aquifers(ax, crs: int=4269, edgecolor: str='orange', facecolor: str='none', alpha: float=0.75, linewidth: float=1.00):
+    """Plots the aquifer outlines as used by Rateb et al. 2020"""
+    rateb_aqs = layer_at_extent('rateb_aquifers', ax, crs)
+    rateb_aqs.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)
+    
+def plot_aquifers(ax, aquifers: list=None, crs: int=4269, edgecolor: str='red', facecolor: str='none', alpha: float=1.0, linewidth: float=1.25):
+    """Plots the master aquifer outlines, either of a list of aquifers (cl.Aquifer objects, see rf.aquifer_outline()) or all aquifers if
+       no list is provided"""
+    if not aquifers:
+        layer_at_extent('aquifers', ax, crs).plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)
+        return
+    tolerance = lod.axes_tolerance(ax, crs, rf.layer('aquifers', crs).total_bounds)
+    for aquifer in aquifers:
+        outline = rf.aquifer_outline(aquifer, crs, tolerance)
+        outline.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)
+
+def plot_huc2(ax, shapefile=None, codes: list=[], crs: int=4269, edgecolor: str='royalblue', facecolor: str='cornflowerblue', alpha: float=0.30, linewidth: float=1.00):
+    """Plots HUC2 shapefiles either by a list of codes or all HUC2's if no list is provided. The master HUC2 layer is used if no
+       shapefile is given"""
+    if codes == [-1]: return
+    # If no list is provided, plot all HUC2's
+    shapefile = layer_at_extent('huc2', ax, crs) if shapefile is None else rf.project(shapefile, crs)
+    if not codes:        
+        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)       
+    else:
+        shapefile = shapefile[shapefile['huc2_code'].isin(codes)]
+        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth) 
+                        
+def plot_huc4(ax, shapefile=None, codes: list=[], crs: int=4269, edgecolor: str='royalblue', facecolor: str='cornflowerblue', alpha: float=0.30, linewidth: float=1.00):
+    """Plots HUC4 shapefiles either by a list of codes or all HUC2's if no list is provided. The master HUC4 layer is used if no
+       shapefile is given"""
+    if codes == [-1]: return
+    # If no list is provided, plot all HUC4's
+    shapefile = layer_at_extent('huc4', ax, crs) if shapefile is None else rf.project(shapefile, crs)
+    if not codes:        
+        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)       
+    else:
+        shapefile = shapefile[shapefile['huc4_code'].isin(codes)]
+        shapefile.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, alpha=alpha, linewidth=linewidth)
+        
+def set_plot_bounds(shapefile, padding: float=3.0, ax: plt.Axes=None):
+    """Sets the plot bounds for single aquifer plotting, applied to ax if given so the layers plotted afterwards are drawn at a matching
+       level of detail"""
+    xmin, ymin, xmax, ymax = shapefile.total_bounds
+    padding = padding
+    xmin -= padding
+    ymin -= padding
+    xmax += padding
+    ymax += padding
+    if ax is not None:
+        ax.set_xlim(xmin, xmax)
+        ax.set_ylim(ymin, ymax)
+    return xmin, xmax, ymin, ymax
+
+def save_plot_as_image(img_path: str, overwrite: bool=False):
+    """Saves a generated plot as an image to the specified img_path"""    
+    if os.path.exists(img_path) and overwrite:
+        plt.savefig(img_path)
+    elif not os.path.exists(img_path):
+        plt.savefig(img_path)
+
+#---------------------------------#
+#-------# AQUIFER FIGURES #-------#
+#---------------------------------#
+
+def aquifer_map(df_valid: pd.DataFrame, aquifer: cl.Aquifer, metric: str, title: str, basemap: bool=False, figsize: tuple=(15, 15)):
+    """Plots a single aquifer's valid water gauges coloured by metric, with the aquifer outline in red over the lower 48. Returns the
+       figure and axes"""
+    fig, ax = plt.subplots(figsize=figsize)
+    plt.title(title, loc='center')
+    plt.style.use('classic')
+
+    # Plot bounds are set first so every layer below is drawn at a level of detail matching the aquifer's extent
+    set_plot_bounds(rf.aquifer_outline(aquifer), padding=3.0, ax=ax)
+
+    if not basemap:
+        plot_lower_48(ax)
+    plot_aquifers(ax, [aquifer], edgecolor='red', facecolor='none', linewidth=1.25)
+
+    if not df_valid.empty:
+        # Convert decimal lat/long to geo points
+        geo_df = geo.convert_geometry(df_valid).set_crs(4269)
+        geo_df = geo_df.merge(df_valid, how='left', left_index=True, right_index=True)
+
+        # Set colorbar limits and theme using undivided dataset so that scale is static
+        cmap, mappable = scale_colorbar(df_valid, metric)
+        div = make_axes_locatable(ax)
+        cax = div.append_axes("bottom", size="5%", pad=0.05)
+
+        geo_df.plot(ax=ax, column=metric, markersize=300, marker='.', cmap=cmap, edgecolor='black', linewidth=1, alpha=0.75)
+        cbx = plt.colorbar(mappable, cax=cax, pad=0.05, aspect=25, orientation='horizontal', alpha=1.0)
+        cbx.set_label(fn.FLOW_METRIC_UNITS[metric])
+
+    ax.set_yticks([])
+    ax.set_xticks([])
+    if basemap:
+        plot_basemap(ax)
+    return fig, ax
+
+def multi_aquifer_map(df: pd.DataFrame, aquifers: list, metric: str, title: str, show_huc4: bool=False, show_gauges: bool=True,
+                      basemap: bool=False, figsize: tuple=(35, 35)):
+    """Plots every aquifer in aquifers (cl.Aquifer objects) on a national map, with the valid gauges in their HUC4s coloured by metric on
+       a single colorbar scale. Returns the figure and axes"""
+    fig, ax = plt.subplots(figsize=figsize)
+    plt.title(title, loc='center', fontsize=24)
+
+    if not basemap:
+        plot_lower_48(ax)
+    plot_aquifers(ax, aquifers, edgecolor='red', facecolor='none', linewidth=1.25)
+
+    if show_huc4:
+        for aq in aquifers:
+            plot_huc4(ax, codes=aq.huc4s)
+
+    # Only plotting points in HUC4s overlapping aquifers
+    if not df.empty and show_gauges:
+        # L/B/W/H
+        cax = fig.add_axes([0.17, 0.35, 0.22, 0.015])
+
+        huc_codes = set(huc4 for aq in aquifers for huc4 in aq.huc4s)
+        df_all_aq = df[df['huc4_code'].isin(huc_codes)].reset_index(drop=True)
+        cmap, mappable = scale_colorbar(df_all_aq, metric)
+        geo_df = geo.convert_geometry(df_all_aq)
+        geo_df.plot(ax=ax, column=df_all_aq[metric], markersize=200, marker='.', cmap='plasma', edgecolor='black', linewidth=1, alpha=0.75)
+
+        cbx = plt.colorbar(mappable, cax=cax, pad=1.0, shrink=0.5, orientation='horizontal', alpha=1.0)
+        cbx.set_label(fn.FLOW_METRIC_UNITS[metric], size=18)
+        cbx.ax.tick_params(labelsize=16)
+        ax.set_yticks([])
+        ax.set_xticks([])
+
+    if basemap:
+        plot_basemap(ax)
+    return fig, ax
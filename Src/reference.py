@@ -0,0 +1,142 @@
+# Memoized reference data. The map layers (lower 48 states, aquifer outlines, HUC2/4 master layers), the GAGES-II list, the outlet
+# gauge list and dataset sheets are each read once per process, and layers are kept per target CRS, so a grid of aquifer maps pays the
+# file read and reprojection once rather than once per subplot. Every lookup compares the file's modification time with the one it was
+# loaded at and reloads it when the file has changed.
+#
+# Layers and tables are shared between callers, so treat them as read-only (.copy() before adding columns). dataset() returns a copy
+# as the notebooks add columns to the sheets they load. Only pandas is imported here, geopandas is imported the first time a layer is read.
+import os
+import threading
+import pandas as pd
+
+MAP_CRS = 4269
+LAYERS = {
+    'lower48': 'ShapeFiles/Lower48/lower48.shp',
+    'rateb_aquifers': 'ShapeFiles/Lower48/POWELL_AQs_2020.shp',
+    'aquifers': 'ShapeFiles/Aquifers/_Master_Aquifer/master_aquifer.shp',
+    'huc2': 'ShapeFiles/HUC2/_Master_HUC2/master_huc2.parquet',
+    'huc4': 'ShapeFiles/HUC4/_Master_HUC4/master_huc4.parquet',
+}
+TABLES = {
+    'gages_2': 'GagesII/g2_list.csv',
+    'outlet_gauges': 'Prelim_Data/_Outlet_Gauges/outlet_gauges.xlsx',
+}
+
+def file_mtime(path: str):
+    """Returns a file's modification time in ns, or None if it does not exist"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+class Registry:
+    """Loaded reference data keyed by name (and CRS, dataset sheet, ...), each stored with the modification time of its source file"""
+    def __init__(self):
+        self.cache = {}
+        # Reentrant, as a reprojected layer loads its source layer through the registry
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, path: str, load):
+        """Returns the cached value for key, calling load() on first use or when path has been modified since it was loaded"""
+        mtime = file_mtime(path)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and mtime is not None and cached[0] == mtime:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            value = load()
+            # Read again, loading may have created the file (i.e. a master layer converted from its shapefile)
+            self.cache[key] = (file_mtime(path), value)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {'entries': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+_registry = Registry()
+
+def clear():
+    """Drops every cached dataset, i.e. after editing a shapefile in place within the same second"""
+    _registry.clear()
+
+def info():
+    """Returns the number of cached entries and the cache hits and misses so far"""
+    return _registry.info()
+
+def read_layer(name: str):
+    import geopandas as gpd
+    if name in ('huc2', 'huc4'):
+        import Src.huc_processor as hp
+        return hp.load_master(name, path=LAYERS[name])
+    return gpd.read_file(LAYERS[name])
+
+def project(gdf, crs: int=MAP_CRS):
+    """Returns gdf in crs, without reprojecting (or copying) a layer that is already in it"""
+    if crs is None or gdf.crs == crs:
+        return gdf
+    return gdf.to_crs(crs)
+
+def layer(name: str, crs: int=MAP_CRS):
+    """Returns a reference layer (see LAYERS) in crs, or in the CRS it is stored in if crs is None"""
+    path = LAYERS[name]
+    source = _registry.get((name, None), path, lambda: read_layer(name))
+    if crs is None:
+        return source
+    return _registry.get((name, crs), path, lambda: project(source, crs))
+
+def lod_layer(name: str, crs: int=MAP_CRS, tolerance: float=None):
+    """Returns a layer simplified to tolerance (see Src/lod.py) in crs, or the full resolution layer if tolerance is None"""
+    if tolerance is None:
+        return layer(name, crs)
+    import Src.lod as lod
+    path = lod.lod_path(name, tolerance)
+    # Levels older than their layer are rebuilt, which in turn invalidates the cached level
+    if file_mtime(path) is None or file_mtime(path) < file_mtime(LAYERS[name]):
+        lod.build_lod(name)
+    source = _registry.get((name, None, tolerance), path, lambda: lod.load_lod(name, tolerance))
+    return _registry.get((name, crs, tolerance), path, lambda: project(source, crs))
+
+def aquifer_outline(aquifer, crs: int=MAP_CRS, tolerance: float=None):
+    """Returns an aquifer's (cl.Aquifer) outlines from the master aquifer layer, matched by its name or aq_names, or its HUC4s if none of
+       them are in the layer. tolerance picks the level of detail as in lod_layer()"""
+    outlines = lod_layer('aquifers', crs, tolerance)
+    outline = outlines[outlines['aq_name'].isin([aquifer.name, *aquifer.aq_names])]
+    if outline.empty:
+        huc4 = lod_layer('huc4', crs, tolerance)
+        outline = huc4[huc4['huc4_code'].isin(aquifer.huc4s)]
+    return outline
+
+def table(name: str):
+    """Returns a reference table (see TABLES), with site numbers kept as strings"""
+    path = TABLES[name]
+    if path.endswith('.csv'):
+        load = lambda: pd.read_csv(path)
+    else:
+        load = lambda: pd.read_excel(path, dtype={'site_no': str})
+    return _registry.get((name,), path, load)
+
+def gages_2_sites():
+    """Returns the GAGES-II station IDs as strings, as gages_2_filtering() matches them against site_no"""
+    path = TABLES['gages_2']
+    return _registry.get(('gages_2_sites',), path, lambda: pd.Index(table('gages_2')['STAID'].astype(str)).unique())
+
+def dataset_file(path: str, sheet: str):
+    """Returns the file fn.load_data() reads a dataset sheet from"""
+    for ext in ['parquet', 'feather']:
+        if os.path.exists(f'{path}/{sheet}.{ext}'):
+            return f'{path}/{sheet}.{ext}'
+    return f'{path}.xlsx'
+
+def dataset(path: str, sheet: str='site_metrics'):
+    """Returns a copy of a dataset sheet loaded with fn.load_data() (DATASET_DTYPES typed), read from disk only once"""
+    import Src.func as fn
+    df = _registry.get(('dataset', path, sheet), dataset_file(path, sheet), lambda: fn.load_data(path, sheet))
+    return df.copy()
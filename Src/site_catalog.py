@@ -0,0 +1,104 @@
+# A persistent national catalog of the sites with daily streamflow data. Each state's site list is an RDB file served from the URL built
+# by fn.create_state_uri(), and used to be downloaded, split and re-joined in memory for every state on every run. The lists are now
+# streamed line by line (skipping comment and format lines as they arrive) into a single Parquet catalog of site_no, station_nm,
+# coordinates and sv_begin/end dates, so building the national work list is a local lookup. The catalog is only re-downloaded on request.
+import os
+import json
+import requests
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import Src.func as fn
+import Src.atomic as at
+import Src.fetch_pool as fp
+
+CATALOG_PATH = 'Prelim_Data/_Site_Catalog/site_catalog.parquet'
+# Key under which the parameter code and download time are stored in the catalog's schema metadata
+CATALOG_KEY = b'site_catalog'
+FLOAT_COLS = ['dec_lat_va', 'dec_long_va']
+DATE_COLS = ['sv_begin_date', 'sv_end_date']
+# States are downloaded a few at a time, well within the request rate NWIS asks automated clients to keep to
+MAX_WORKERS = 4
+
+def iter_rdb_rows(lines):
+    """Yields the header and then every data row of an RDB file as lists of fields, from any iterable of lines (i.e. a streamed response).
+       Comment lines are skipped as they are read, and so is the column format line (i.e. 5s, 15s, 16s) which follows the header"""
+    header = None
+    skip_format = True
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if header is None:
+            header = fields
+            yield header
+        elif skip_format:
+            skip_format = False
+        else:
+            yield fields
+
+def read_rdb_stream(lines):
+    """Returns an RDB file (as an iterable of lines) as a frame of strings, with the site list's coordinate and date columns typed"""
+    rows = iter_rdb_rows(lines)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    df = pd.DataFrame(list(rows), columns=header, dtype=str)
+    for col in FLOAT_COLS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in DATE_COLS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+def fetch_state_sites(state: str, param: str=fn.PARAM_CODE, timeout: float=60):
+    """Streams a single state's site list for a parameter code into a frame"""
+    with requests.get(fn.create_state_uri(state, param), stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        return read_rdb_stream(response.iter_lines())
+
+def build_catalog(states: list=fn.STATE_LIST, param: str=fn.PARAM_CODE, workers: int=MAX_WORKERS, fetch=None):
+    """Downloads every state's site list (with retries, see fp.fetch_with_retry()) and returns them as one frame in state order, with a
+       'state' column added. fetch (state -> frame) replaces fetch_state_sites()"""
+    fetch = fetch or (lambda state: fetch_state_sites(state, param))
+    limiter = fp.RateLimiter(fp.REQUESTS_PER_SECOND)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(lambda state: fp.fetch_with_retry(fetch, state, limiter).assign(state=state), states))
+    return pd.concat(frames, ignore_index=True)
+
+def write_catalog(df: pd.DataFrame, param: str=fn.PARAM_CODE, path: str=CATALOG_PATH):
+    """Writes the catalog along with its parameter code and download time"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CATALOG_KEY] = json.dumps({'param_code': param, 'retrieved': datetime.now().isoformat(timespec='seconds')}).encode()
+    with at.atomic_path(path) as temp:
+        pq.write_table(table.replace_schema_metadata(metadata), temp, compression='snappy')
+
+def catalog_info(path: str=CATALOG_PATH):
+    """Returns the parameter code and download time the catalog was built with, or None if there is no catalog"""
+    if not os.path.exists(path):
+        return None
+    return json.loads(pq.read_schema(path).metadata[CATALOG_KEY])
+
+def load_catalog(refresh: bool=False, param: str=fn.PARAM_CODE, path: str=CATALOG_PATH, **build_kwargs):
+    """Returns the national site catalog, downloading it only if there is none yet (or it was built for another parameter code) or
+       refresh is set"""
+    info = catalog_info(path)
+    if refresh or info is None or info['param_code'] != param:
+        df = build_catalog(param=param, **build_kwargs)
+        write_catalog(df, param, path)
+        return df
+    return pd.read_parquet(path)
+
+def state_sites(state: str, catalog: pd.DataFrame=None):
+    """Returns a single state's sites from the catalog, in the order the state's site list gave them"""
+    catalog = load_catalog() if catalog is None else catalog
+    return catalog[catalog['state'] == state].reset_index(drop=True)
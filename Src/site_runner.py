@@ -0,0 +1,61 @@
+# Process-pool execution of the per-site analysis. Each site's metrics and Mann-Kendall tests are independent of every other site, so
+# sites are fanned out to worker processes which send back plain row dicts (see fn.site_records()) rather than DataFrames. Results are
+# consumed in the order the jobs were given so the merged frames match a serial run row for row.
+#
+# Functions here are module level so they can be pickled by spawn-based platforms (Windows, macOS notebooks).
+import os
+
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import Src.func as fn
+import Src.classes as cl
+import Src.tracing as tr
+
+MAX_WORKERS = os.cpu_count() or 1
+
+def analyze_site(job: tuple, quantiles_list: list=fn.QUANTILE_LIST, data_ranges_list: list=fn.DATA_RANGE_LIST, crop: bool=True):
+    """Runs fn.site_records() for a single (site_no, df or cl.FlowRecord, add_data) job. Errors are returned rather than raised so one
+       broken site (i.e. '03592000' with almost no data) does not stop the pool"""
+    site_no, df, add_data = job
+    try:
+        with tr.stage('site', site_no):
+            site_rows, mk_rows = fn.site_records(df, quantiles_list, data_ranges_list, crop=crop)
+        return {'site_no': site_no, 'add_data': add_data, 'site_metrics': site_rows, 'mk': mk_rows, 'error': None}
+    except Exception as e:
+        return {'site_no': site_no, 'add_data': add_data, 'site_metrics': [], 'mk': {}, 'error': str(e)}
+
+def iter_site_results(jobs, quantiles_list: list=fn.QUANTILE_LIST, data_ranges_list: list=fn.DATA_RANGE_LIST, crop: bool=True,
+                      workers: int=MAX_WORKERS):
+    """Yields analyze_site() results in job order. Jobs are pulled lazily from the iterable, with at most 2 x workers sites in flight,
+       so records are not all held in memory at once. workers <= 1 runs serially in this process"""
+    run = partial(analyze_site, quantiles_list=quantiles_list, data_ranges_list=data_ranges_list, crop=crop)
+    if workers <= 1:
+        for job in jobs:
+            yield run(job)
+        return
+
+    job_iter = iter(jobs)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def submit_next():
+            job = next(job_iter, None)
+            if job is not None:
+                pending.append(executor.submit(run, job))
+
+        for _ in range(2 * workers):
+            submit_next()
+
+        while pending:
+            future = pending.popleft()
+            submit_next()
+            yield future.result()
+
+def results_to_frames(results: list):
+    """Merges analyze_site() results into the national site metric frame and the 6 MK frames (same order as fn.single_site_data()),
+       with each site's add_data columns appended to its rows. Failed sites are skipped"""
+    collector = cl.ResultCollector()
+    for result in results:
+        collector.add_result(result)
+    return collector.frames()
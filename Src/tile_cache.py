@@ -0,0 +1,388 @@
+# A local store of basemap tiles in front of contextily. fn.plot_basemap() used to let cx.add_basemap() download every tile of the
+# map extent on every render, which is slow for the grid of aquifer maps and fails outright on the offline analysis nodes. Tiles are
+# now read through a TileStore (one file per provider/zoom/x/y), only tiles which have never been stored are requested, and the store
+# keeps its total size under a limit by evicting the least recently used tiles. seed() downloads the tiles of every aquifer extent in
+# Src/classes.py (and the lower 48) ahead of time, after which the maps render with TILES_OFFLINE=1 (or OFFLINE = True) without any
+# network access.
+#
+# Usage to seed the store: python -m Src.tile_cache seed [zoom ...]
+# Usage for an offline benchmark against a local stand-in tile server: python -m Src.tile_cache benchmark
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import requests
+import mercantile
+import numpy as np
+import pyproj
+import contextily as cx
+
+from collections import OrderedDict
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+from xyzservices import TileProvider
+
+import Src.classes as cl
+import Src.atomic as at
+import Src.fetch_pool as fp
+import Src.reference as rf
+
+TILE_DIR = 'ShapeFiles/_Tile_Cache'
+INDEX_NAME = '_index.json'
+OFFLINE = os.environ.get('TILES_OFFLINE', '0') == '1'
+# Least recently used tiles are evicted once the store holds more than this
+MAX_BYTES = 512 * 2 ** 20
+DEFAULT_PROVIDER = cx.providers.OpenStreetMap.Mapnik
+DEFAULT_ZOOM = 7
+# Matches the padding fn.set_plot_bounds() adds around an aquifer
+SEED_PADDING = 3.0
+# The OpenStreetMap tile usage policy asks bulk downloads to stay at a couple of requests at a time
+REQUESTS_PER_SECOND = 2.0
+TIMEOUT = 30
+# Web mercator tiles stop at +-85.0511 degrees latitude
+MAX_LATITUDE = 85.0511
+
+class TileNotCached(Exception):
+    """Raised for a tile which is not in the store while running offline"""
+
+def provider_key(provider: TileProvider):
+    """Returns the folder a provider's tiles are stored under, its name (i.e. OpenStreetMap.Mapnik) or a hash of its URL"""
+    name = provider.get('name') or ''
+    if name and name != 'url':
+        return name.replace('/', '_')
+    return 'url_' + hashlib.sha1(provider['url'].encode()).hexdigest()[:12]
+
+def as_provider(source):
+    """Returns source as an xyzservices TileProvider, accepting a URL template with {x}, {y} and {z} as cx.add_basemap() does"""
+    if isinstance(source, str):
+        return TileProvider(url=source, attribution='', name='url')
+    return source
+
+def fetch_tile(url: str, timeout: float=TIMEOUT):
+    """Requests a single tile, returning the image bytes"""
+    response = requests.get(url, headers={'user-agent': cx.tile.USER_AGENT}, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+class TileStore:
+    """Tiles stored as <folder>/<provider>/<z>/<x>/<y>.<ext>, with an index of their sizes in least to most recently used order. hits,
+       misses, fetched and evicted count tile lookups since the store was opened"""
+    def __init__(self, folder: str=TILE_DIR, max_bytes: int=MAX_BYTES, offline: bool=None, rate: float=REQUESTS_PER_SECOND, fetch=fetch_tile):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.offline = OFFLINE if offline is None else offline
+        self.fetch = fetch
+        self.limiter = fp.RateLimiter(rate)
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.fetched = self.evicted = 0
+        self.index = OrderedDict()
+        path = os.path.join(folder, INDEX_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                self.index.update((key, size) for key, size in json.load(f)['tiles'])
+        self.total_bytes = sum(self.index.values())
+
+    def tile_key(self, provider: TileProvider, tile: mercantile.Tile):
+        ext = os.path.splitext(urlparse(provider['url']).path)[1] or '.png'
+        return f'{provider_key(provider)}/{tile.z}/{tile.x}/{tile.y}{ext}'
+
+    def get(self, provider: TileProvider, tile: mercantile.Tile):
+        """Returns a tile's image bytes, from the store if it holds the tile, otherwise requested (unless offline) and stored"""
+        key = self.tile_key(provider, tile)
+        path = os.path.join(self.folder, key)
+        with self.lock:
+            if os.path.exists(path):
+                self.hits += 1
+                # Tiles stored by another process are adopted into this index
+                if key not in self.index:
+                    self.index[key] = os.path.getsize(path)
+                    self.total_bytes += self.index[key]
+                self.index.move_to_end(key)
+                with open(path, 'rb') as f:
+                    return f.read()
+            self.misses += 1
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)
+        if self.offline:
+            raise TileNotCached(f'{key} is not in {self.folder}, run python -m Src.tile_cache seed while online')
+
+        url = provider.build_url(x=tile.x, y=tile.y, z=tile.z)
+        body = fp.fetch_with_retry(self.fetch, url, self.limiter)
+        self.put(key, body)
+        return body
+
+    def put(self, key: str, body: bytes):
+        """Stores a tile, evicting the least recently used tiles if the store is over max_bytes"""
+        at.write_bytes(os.path.join(self.folder, key), body)
+        with self.lock:
+            self.fetched += 1
+            self.total_bytes += len(body) - self.index.pop(key, 0)
+            self.index[key] = len(body)
+            self.evict()
+
+    def evict(self):
+        """Removes least recently used tiles until the store is within max_bytes, the most recent tile is always kept"""
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            self.total_bytes -= size
+            self.evicted += 1
+            try:
+                os.remove(os.path.join(self.folder, key))
+            except FileNotFoundError:
+                pass
+
+    def save(self):
+        """Writes the index, called after every basemap so the recency order survives between sessions"""
+        with self.lock:
+            tiles = list(self.index.items())
+        at.write_json(os.path.join(self.folder, INDEX_NAME), {'tiles': tiles})
+
+    def info(self):
+        with self.lock:
+            return {'tiles': len(self.index), 'mb': round(self.total_bytes / 2 ** 20, 1), 'hits': self.hits, 'misses': self.misses,
+                    'fetched': self.fetched, 'evicted': self.evicted}
+
+_store = None
+
+def default_store():
+    """Returns the process-wide store in TILE_DIR, opened on first use"""
+    global _store
+    if _store is None:
+        _store = TileStore()
+    return _store
+
+def set_default_store(store: TileStore):
+    """Replaces the store fn.plot_basemap() reads from, i.e. TileStore(offline=True) on a node without network access"""
+    global _store
+    _store = store
+
+#-----------------------------------#
+#-------# BASEMAP ADAPTER #---------#
+#-----------------------------------#
+
+def lonlat_bounds(bounds: tuple, crs: int):
+    """Returns (west, south, east, north) in degrees of bounds (minx, miny, maxx, maxy in crs), clipped to the web mercator latitudes"""
+    west, south, east, north = pyproj.Transformer.from_crs(crs, 4326, always_xy=True).transform_bounds(*bounds)
+    return west, max(south, -MAX_LATITUDE), east, min(north, MAX_LATITUDE)
+
+def extent_tiles(bounds: tuple, crs: int, zoom: int):
+    """Returns the tiles covering bounds (minx, miny, maxx, maxy in crs) at zoom"""
+    return list(mercantile.tiles(*lonlat_bounds(bounds, crs), [zoom]))
+
+def basemap_image(bounds: tuple, crs: int=rf.MAP_CRS, provider: TileProvider=DEFAULT_PROVIDER, zoom: int=DEFAULT_ZOOM, store: TileStore=None):
+    """Returns the RGBA image of the tiles covering bounds (minx, miny, maxx, maxy in crs) read through store, and its extent (left,
+       right, bottom, top) warped into crs, as cx.bounds2img() and cx.warp_tiles() would"""
+    store = store or default_store()
+    provider = as_provider(provider)
+    tiles = extent_tiles(bounds, crs, zoom)
+    try:
+        arrays = {(tile.x, tile.y): np.asarray(Image.open(io.BytesIO(store.get(provider, tile))).convert('RGBA')) for tile in tiles}
+    finally:
+        store.save()
+
+    # The tiles form a full grid, stitched row by row from the north west corner
+    xs, ys = sorted({tile.x for tile in tiles}), sorted({tile.y for tile in tiles})
+    height, width = next(iter(arrays.values())).shape[:2]
+    image = np.zeros((len(ys) * height, len(xs) * width, 4), dtype=np.uint8)
+    for (x, y), array in arrays.items():
+        row, col = (y - ys[0]) * height, (x - xs[0]) * width
+        image[row:row + height, col:col + width] = array
+
+    north_west = mercantile.xy_bounds(xs[0], ys[0], zoom)
+    south_east = mercantile.xy_bounds(xs[-1], ys[-1], zoom)
+    extent = (north_west.left, south_east.right, south_east.bottom, north_west.top)
+    if pyproj.CRS.from_user_input(crs) != pyproj.CRS.from_epsg(3857):
+        image, extent = cx.warp_tiles(image, extent, t_crs=pyproj.CRS.from_user_input(crs).to_string())
+    return image, extent
+
+def add_basemap(ax, crs: int=rf.MAP_CRS, source=DEFAULT_PROVIDER, zoom: int=DEFAULT_ZOOM, store: TileStore=None):
+    """Drop-in for cx.add_basemap(ax, crs=crs, source=source, zoom=zoom) which reads its tiles through a TileStore"""
+    xmin, xmax, ymin, ymax = ax.axis()
+    provider = as_provider(source)
+    image, extent = basemap_image((xmin, ymin, xmax, ymax), crs, provider, zoom, store)
+    ax.imshow(image, extent=extent, interpolation='bilinear', aspect=ax.get_aspect())
+    ax.axis((xmin, xmax, ymin, ymax))
+    if provider.get('attribution'):
+        cx.add_attribution(ax, provider['attribution'])
+
+#-----------------------------#
+#-------# SEEDING #-----------#
+#-----------------------------#
+
+def aquifer_bounds(aquifer: cl.Aquifer, padding: float=SEED_PADDING):
+    """Returns an aquifer's map extent (minx, miny, maxx, maxy in rf.MAP_CRS), the bounds of its outline (see rf.aquifer_outline()) plus
+       padding as in fn.aquifer_map()"""
+    xmin, ymin, xmax, ymax = rf.aquifer_outline(aquifer).total_bounds
+    return xmin - padding, ymin - padding, xmax + padding, ymax + padding
+
+def seed_extents(extents: list, zooms: list=[DEFAULT_ZOOM], provider: TileProvider=DEFAULT_PROVIDER, store: TileStore=None):
+    """Stores every tile of the extents (minx, miny, maxx, maxy in rf.MAP_CRS) at each zoom. Returns the number of tiles covered and the
+       number that had to be requested"""
+    store = store or default_store()
+    provider = as_provider(provider)
+    tiles = list(dict.fromkeys(tile for bounds in extents for zoom in zooms for tile in extent_tiles(bounds, rf.MAP_CRS, zoom)))
+    fetched = store.fetched
+    try:
+        for tile in tiles:
+            store.get(provider, tile)
+    finally:
+        store.save()
+    return len(tiles), store.fetched - fetched
+
+def seed(aquifers: list=cl.ALL_AQUIFERS, zooms: list=[DEFAULT_ZOOM], provider: TileProvider=DEFAULT_PROVIDER, national: bool=True,
+         store: TileStore=None):
+    """Stores the tiles of the aquifers' map extents, and the lower 48 (the multi-aquifer maps) if national is set, at each zoom"""
+    extents = [aquifer_bounds(aq) for aq in aquifers]
+    if national:
+        extents.append(tuple(rf.layer('lower48').total_bounds))
+    return seed_extents(extents, zooms, provider, store)
+
+#-----------------------------------#
+#-------# OFFLINE BENCHMARK #-------#
+#-----------------------------------#
+
+def synthetic_tile(tile: mercantile.Tile, size: int=256):
+    """Returns a PNG tile shaded by its position, so a stitched image shows any misplaced tile"""
+    shade = np.full((size, size, 3), [(tile.x * 37) % 256, (tile.y * 59) % 256, (tile.z * 20) % 256], dtype=np.uint8)
+    shade[:2, :] = shade[:, :2] = 0
+    buffer = io.BytesIO()
+    Image.fromarray(shade).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+class TileServer:
+    """A local HTTP stand-in for a tile provider serving synthetic_tile() images at /<z>/<x>/<y>.png, counting requests per tile and
+       delaying each one by latency seconds"""
+    def __init__(self, latency: float=0.0):
+        self.latency = latency
+        self.attempts = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.provider = TileProvider(url=self.url + '/{z}/{x}/{y}.png', name='StandIn', attribution='Stand-in tiles', max_zoom=19)
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.attempts[self.path] = server.attempts.get(self.path, 0) + 1
+                time.sleep(server.latency)
+                try:
+                    z, x, y = (int(part) for part in self.path.strip('/').removesuffix('.png').split('/'))
+                    status, body = 200, synthetic_tile(mercantile.Tile(x, y, z))
+                except ValueError:
+                    status, body = 404, b'Tile not found'
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def requests(self):
+        with self.lock:
+            return sum(self.attempts.values())
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def benchmark(zoom: int=6, latency: float=0.05, renders: int=3):
+    """Seeds a temporary store from the stand-in server with the extent of every outline in the master aquifer layer, renders each
+       extent's basemap renders times and checks no render requested a tile, that an offline store draws the same images and raises
+       TileNotCached for an unseeded tile, and that a store capped at half the seed size evicts down to it. Raises AssertionError on the
+       first failed check"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    outlines = rf.layer('aquifers')
+    extents = [tuple(bounds + np.array([-1, -1, 1, 1]) * SEED_PADDING) for bounds in outlines.geometry.bounds.to_numpy()]
+
+    def render(bounds, tile_store):
+        fig, ax = plt.subplots(figsize=(6, 6))
+        ax.axis((bounds[0], bounds[2], bounds[1], bounds[3]))
+        add_basemap(ax, source=server.provider, zoom=zoom, store=tile_store)
+        fig.canvas.draw()
+        image = np.asarray(fig.canvas.buffer_rgba()).copy()
+        plt.close(fig)
+        return image
+
+    def check(passed: bool, message: str):
+        if not passed:
+            raise AssertionError(message)
+
+    with tempfile.TemporaryDirectory() as folder, TileServer(latency=latency) as server:
+        store = TileStore(folder, rate=0)
+        start = time.perf_counter()
+        cold = render(extents[0], store)
+        print(f'cold render: {time.perf_counter() - start:.2f}s, {server.requests()} requests')
+        check(store.hits == 0 and store.misses == store.fetched == server.requests() > 0,
+              f'cold render should request every tile once: {store.info()}, {server.requests()} requests')
+
+        cold_tiles = store.fetched
+        start = time.perf_counter()
+        num_tiles, fetched = seed_extents(extents, [zoom], server.provider, store)
+        print(f'seed: {len(extents)} extents, {num_tiles} tiles, {fetched} requested in {time.perf_counter() - start:.2f}s, '
+              f'{store.info()["mb"]} MB')
+        check(fetched == num_tiles - cold_tiles and server.requests() == store.fetched == store.misses,
+              f'seed should request only the tiles the cold render did not store: {num_tiles} tiles, {fetched} requested, '
+              f'{store.info()}, {server.requests()} requests')
+
+        requests_before, hits_before, misses_before = server.requests(), store.hits, store.misses
+        start = time.perf_counter()
+        images = [render(bounds, store) for _ in range(renders) for bounds in extents]
+        elapsed = time.perf_counter() - start
+        print(f'render: {len(images)} basemaps in {elapsed:.2f}s ({elapsed / len(images) * 1000:.0f} ms each), '
+              f'{server.requests() - requests_before} requests, {store.info()}')
+        check(server.requests() == requests_before, f'{server.requests() - requests_before} tiles requested after seeding')
+        check(store.misses == misses_before and store.hits >= hits_before + len(images),
+              f'renders after seeding should only hit the store: {store.info()}')
+        check(np.array_equal(images[0], cold), 'seeded render differs from the cold render')
+        check(all(np.array_equal(image, images[i % len(extents)]) for i, image in enumerate(images)), 'repeated renders differ')
+
+        offline = TileStore(folder, offline=True)
+        for bounds, image in zip(extents, images):
+            check(np.array_equal(render(bounds, offline), image), f'offline render of {bounds} differs from the online one')
+        check(offline.misses == offline.fetched == 0 and offline.hits > 0, f'offline renders should only hit the store: {offline.info()}')
+        try:
+            offline.get(server.provider, mercantile.Tile(0, 0, zoom + 1))
+            raise AssertionError('offline store returned a tile that was never seeded')
+        except TileNotCached:
+            pass
+        check(offline.misses == 1 and server.requests() == requests_before, f'offline miss should not request a tile: {offline.info()}')
+        print(f'offline: {offline.info()}')
+
+        capped = TileStore(folder, max_bytes=store.total_bytes // 2, rate=0)
+        capped.put('StandIn/evict/0/0.png', synthetic_tile(mercantile.Tile(0, 0, 0)))
+        files = sum(len(names) for _, _, names in os.walk(os.path.join(folder, 'StandIn')))
+        print(f'eviction: {capped.info()}, {files} files on disk')
+        check(capped.evicted > 0 and capped.total_bytes <= capped.max_bytes, f'store over its cap: {capped.info()}')
+        check(files == len(capped.index) and 'StandIn/evict/0/0.png' in capped.index,
+              f'{files} files on disk for {len(capped.index)} indexed tiles, or the newest tile was evicted')
+        print('all checks passed')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'seed':
+        zooms = [int(zoom) for zoom in args[1:]] or [DEFAULT_ZOOM]
+        num_tiles, fetched = seed(zooms=zooms)
+        print(f'{num_tiles} tiles at zoom {zooms} in {TILE_DIR}, {fetched} requested, {default_store().info()}')
+    elif args and args[0] == 'benchmark' and len(args) <= 2:
+        benchmark(int(args[1]) if len(args) > 1 else 6)
+    else:
+        print('Usage: python -m Src.tile_cache <seed [zoom ...] | benchmark [zoom]>')
+        sys.exit(1)
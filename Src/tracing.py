@@ -0,0 +1,214 @@
+# Optional stage-level tracing for the per-site analysis. Fetching, merge_tidal(), thresholding, event detection, Mann-Kendall tests,
+# checkpoints and save_data() are wrapped in named stages which, when tracing is on, record wall time, CPU time (of the calling thread)
+# and optionally traced allocations for every stage of every site. With tracing off a stage is a shared no-op context manager, so the
+# hooks cost well under a microsecond per call.
+#
+# Turn it on for a whole notebook or process with environment variables set before Src is imported (worker processes inherit them):
+#   HMF_TRACE=trace.jsonl        one JSON object per stage
+#   HMF_TRACE=trace.json         Chrome trace format, open in chrome://tracing or ui.perfetto.dev
+#   HMF_TRACE_MEMORY=1           also record allocated bytes with tracemalloc (slows pandas heavy stages down noticeably)
+# or around a block of code with: with tr.tracing('trace.jsonl'): ...
+#
+# Usage for a per-stage summary of a trace file: python -m Src.tracing <trace file>
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import threading
+import functools
+import tracemalloc
+import pandas as pd
+
+from contextlib import contextmanager, nullcontext
+
+TRACE_ENV = 'HMF_TRACE'
+MEMORY_ENV = 'HMF_TRACE_MEMORY'
+# Set by the process which created the trace file, so worker processes inheriting the environment append to it rather than truncate it
+OWNER_ENV = 'HMF_TRACE_OWNER'
+CATEGORY = 'hmf'
+
+_NULL_STAGE = nullcontext()
+_tracer = None
+
+class Tracer:
+    """Buffers finished stages per thread and appends them to the trace file whenever a thread's outermost stage ends, so worker
+       processes (which exit without running atexit handlers) never hold on to unwritten events"""
+    def __init__(self, path: str, memory: bool=False):
+        self.path = path
+        self.chrome = path.endswith('.json')
+        self.memory = memory
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+            self.local.events = []
+        return stack
+
+    def add(self, event: dict, flush: bool):
+        self.local.events.append(event)
+        if flush:
+            self.flush()
+
+    def flush(self):
+        events, self.local.events = getattr(self.local, 'events', []), []
+        if not events:
+            return
+        if self.chrome:
+            text = ''.join(json.dumps(chrome_event(event)) + ',\n' for event in events)
+        else:
+            text = ''.join(json.dumps(event) + '\n' for event in events)
+        with self.lock, open(self.path, 'a') as f:
+            f.write(text)
+
+class Stage:
+    """A single traced stage, the site number is inherited from the enclosing stage when not given"""
+    __slots__ = ('tracer', 'name', 'site_no', 'ts', 'wall', 'cpu', 'mem', 'peak')
+
+    def __init__(self, tracer: Tracer, name: str, site_no: str=None):
+        self.tracer = tracer
+        self.name = name
+        self.site_no = site_no
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        if self.site_no is None and stack:
+            self.site_no = stack[-1].site_no
+        if self.tracer.memory:
+            # The peak counter is reset for this stage, the enclosing stage keeps the peak reached so far
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.mem = self.peak = current
+        stack.append(self)
+        self.ts = time.time_ns()
+        self.cpu = time.thread_time_ns()
+        self.wall = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter_ns() - self.wall
+        cpu = time.thread_time_ns() - self.cpu
+        stack = self.tracer.stack()
+        stack.pop()
+        event = {'stage': self.name, 'site_no': self.site_no, 'ts_us': self.ts // 1000, 'wall_ms': wall / 1e6, 'cpu_ms': cpu / 1e6,
+                 'depth': len(stack), 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if self.tracer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self.peak, peak)
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            event['alloc_bytes'] = peak - self.mem
+            event['net_bytes'] = current - self.mem
+        if exc[0] is not None:
+            event['error'] = exc[0].__name__
+        self.tracer.add(event, flush=not stack)
+        return False
+
+def chrome_event(event: dict):
+    """Converts a JSON lines event to a Chrome trace complete ('X') event"""
+    args = {key: value for key, value in event.items() if key not in ('stage', 'ts_us', 'wall_ms', 'pid', 'tid')}
+    return {'name': event['stage'], 'cat': CATEGORY, 'ph': 'X', 'ts': event['ts_us'], 'dur': event['wall_ms'] * 1000,
+            'pid': event['pid'], 'tid': event['tid'], 'args': args}
+
+def enabled():
+    return _tracer is not None
+
+def stage(name: str, site_no: str=None):
+    """Returns a context manager timing the enclosed block as a stage (a no-op when tracing is off)"""
+    if _tracer is None:
+        return _NULL_STAGE
+    return Stage(_tracer, name, site_no)
+
+def traced(name: str, site_arg: str=None):
+    """Decorator tracing every call of a function as a stage, with the site number taken from the site_arg argument if given"""
+    def decorator(func):
+        position = list(inspect.signature(func).parameters).index(site_arg) if site_arg else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            site_no = None
+            if site_arg:
+                site_no = kwargs[site_arg] if site_arg in kwargs else args[position] if position < len(args) else None
+            with Stage(_tracer, name, site_no):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start(path: str, memory: bool=False, append: bool=False):
+    """Starts tracing to path (Chrome trace format for .json, JSON lines otherwise). The environment is updated so process pool workers
+       started afterwards trace to the same file"""
+    global _tracer
+    stop()
+    if not append:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            # Chrome's JSON array format allows the closing bracket to be left off, so every process can simply append
+            f.write('[\n' if path.endswith('.json') else '')
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    os.environ[TRACE_ENV] = path
+    os.environ[MEMORY_ENV] = '1' if memory else '0'
+    os.environ[OWNER_ENV] = str(os.getpid())
+    _tracer = Tracer(path, memory)
+
+def stop():
+    """Stops tracing, writing out any buffered stages"""
+    global _tracer
+    if _tracer is None:
+        return
+    _tracer.flush()
+    if _tracer.memory:
+        tracemalloc.stop()
+    _tracer = None
+    for key in (TRACE_ENV, MEMORY_ENV, OWNER_ENV):
+        os.environ.pop(key, None)
+
+@contextmanager
+def tracing(path: str, memory: bool=False):
+    """Traces the enclosed block to path, see start()"""
+    start(path, memory)
+    try:
+        yield
+    finally:
+        stop()
+
+def read_trace(path: str):
+    """Returns a trace file (either format) as a DataFrame with one row per stage"""
+    with open(path) as f:
+        text = f.read()
+    if path.endswith('.json'):
+        events = json.loads(text.rstrip().rstrip(',') + ']')
+        return pd.DataFrame([{'stage': e['name'], 'ts_us': e['ts'], 'wall_ms': e['dur'] / 1000, 'pid': e['pid'], 'tid': e['tid'], **e['args']}
+                             for e in events])
+    return pd.DataFrame([json.loads(line) for line in text.splitlines() if line])
+
+def summarize(path: str):
+    """Returns the total and per-call wall/CPU time (and allocations, if traced) of every stage, slowest stage first"""
+    df = read_trace(path)
+    agg = {'calls': ('wall_ms', 'size'), 'sites': ('site_no', 'nunique'), 'wall_ms': ('wall_ms', 'sum'), 'cpu_ms': ('cpu_ms', 'sum')}
+    if 'alloc_bytes' in df.columns:
+        agg['alloc_mb'] = ('alloc_bytes', lambda x: x.max() / 2 ** 20)
+    df_summary = df.groupby('stage').agg(**agg).sort_values('wall_ms', ascending=False)
+    df_summary['wall_ms_per_call'] = df_summary['wall_ms'] / df_summary['calls']
+    return df_summary
+
+# Environment driven tracing, the owning process creates the file and worker processes append to it
+if os.environ.get(TRACE_ENV):
+    _owner = os.environ.get(OWNER_ENV)
+    start(os.environ[TRACE_ENV], os.environ.get(MEMORY_ENV, '0') == '1', append=_owner is not None and _owner != str(os.getpid()))
+    atexit.register(stop)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: python -m Src.tracing <trace file>')
+        sys.exit(1)
+    with pd.option_context('display.width', 200):
+        print(summarize(sys.argv[1]))
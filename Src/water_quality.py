@@ -0,0 +1,229 @@
+# Matching water-quality samples to the HMF events they were taken during. The water quality notebook used to test every sample against
+# every event of a single site (Series.apply over samples, comparing with all events each time). Samples and events are now joined for
+# any number of sites at once: both sides are keyed by (site, time) into sortable integers, events are sorted by start, and every
+# sample finds its candidate events with a binary search, with an optional +-window days around each event. The qwdata records of every
+# site are kept in a single Parquet file, so the overlap analysis of every within_aq site runs from local files.
+#
+# Usage for an offline benchmark against the per-sample apply: python -m Src.water_quality [num_sites] [window]
+import os
+import sys
+import json
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import Src.func as fn
+import Src.atomic as at
+import Src.fetch_pool as fp
+
+EVENTS_PATH = 'Prelim_Data/_Sub_DFs/events_subdf_{data_range}_{quantile}.parquet'
+SAMPLES_PATH = 'Prelim_Data/_Water_Quality/qwdata.parquet'
+# Key under which the sites (including those without any samples) and date range fetched are stored in the samples' schema metadata
+SAMPLES_KEY = b'qwdata'
+WQ_START = '1990-10-01'
+WQ_END = '2020-09-30'
+# qwdata only allows a handful of requests at a time
+MAX_WORKERS = 4
+# Times are keyed as seconds since KEY_EPOCH in the low TIME_BITS bits (up to the year 2344), with the site's code above them
+KEY_EPOCH = np.datetime64('1800-01-01T00:00:00', 's')
+TIME_BITS = 34
+
+#------------------------------#
+#-------# LOADING DATA #-------#
+#------------------------------#
+
+def load_events(data_range: int=30, quantile: int=90, sites: list=None, path: str=None):
+    """Returns the HMF events of the events sub-DF (see subdf_generation.ipynb), of the given sites only if sites is given, with start and
+       end as datetimes"""
+    path = path or EVENTS_PATH.format(data_range=data_range, quantile=quantile)
+    filters = [('site_no', 'in', list(sites))] if sites is not None else None
+    df = pq.read_table(path, filters=filters).to_pandas()
+    df['start'] = pd.to_datetime(df['start'])
+    df['end'] = pd.to_datetime(df['end'])
+    return df
+
+def fetch_qwdata(site: str, start: str=WQ_START, end: str=WQ_END):
+    """Requests a single site's water-quality samples, with the sample time as a datetime column"""
+    from dataretrieval import nwis
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        df, _ = nwis.get_qwdata(sites=site, start=start, end=end)
+    return df.reset_index()
+
+def write_samples(df: pd.DataFrame, sites: list, start: str, end: str, path: str=SAMPLES_PATH):
+    """Writes the samples of every site along with the sites and date range fetched. Text columns (remark codes, i.e. '<0.01', share
+       columns with values) are stored as strings so every site's columns have one type"""
+    df = df.copy()
+    text_cols = df.columns[df.dtypes == object]
+    df[text_cols] = df[text_cols].astype('string')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SAMPLES_KEY] = json.dumps({'sites': sorted(sites), 'start': start, 'end': end}).encode()
+    with at.atomic_path(path) as temp:
+        pq.write_table(table.replace_schema_metadata(metadata), temp, compression='snappy')
+
+def load_samples(sites: list, start: str=WQ_START, end: str=WQ_END, path: str=SAMPLES_PATH, refresh: bool=False, fetch=None,
+                 workers: int=MAX_WORKERS):
+    """Returns the water-quality samples of the given sites. Sites are only requested (through the fetch pool) the first time they are
+       asked for, or if refresh is set or the stored date range differs, and sites without samples are remembered so they are not
+       requested again"""
+    fetch = fetch or (lambda site: fetch_qwdata(site, start, end))
+    stored, fetched = pd.DataFrame(), set()
+    if os.path.exists(path) and not refresh:
+        table = pq.read_table(path)
+        info = json.loads(table.schema.metadata[SAMPLES_KEY])
+        if (info['start'], info['end']) == (start, end):
+            stored, fetched = table.to_pandas(), set(info['sites'])
+
+    missing = [site for site in dict.fromkeys(sites) if site not in fetched]
+    if missing:
+        frames = [stored] + [df for _, df in fp.iter_records(missing, fetch=fetch, workers=workers) if not df.empty]
+        stored = pd.concat(frames, ignore_index=True)
+        fetched.update(missing)
+        write_samples(stored, list(fetched), start, end, path)
+    if stored.empty:
+        return stored
+    return stored[stored['site_no'].isin(set(sites))].reset_index(drop=True)
+
+#-------------------------------#
+#-------# INTERVAL JOIN #-------#
+#-------------------------------#
+
+def sample_times(samples: pd.DataFrame, time_col: str='datetime'):
+    """Returns sample times as naive UTC datetimes, qwdata times are UTC with an offset"""
+    times = pd.to_datetime(samples[time_col], utc=True)
+    return times.dt.tz_localize(None)
+
+def time_keys(codes: np.ndarray, times, offset_days: int=0):
+    """Returns int64 keys ordered by site code, then time (to the second) shifted by offset_days"""
+    seconds = (np.asarray(times, dtype='datetime64[s]') - KEY_EPOCH).astype(np.int64) + offset_days * fn.SEC_PER_DAY
+    return (codes.astype(np.int64) << TIME_BITS) + seconds
+
+def event_index(samples: pd.DataFrame, events: pd.DataFrame, window: int=0, time_col: str='datetime'):
+    """Keys both sides of the join. Returns the sample keys and the events' start and end keys (widened by window days on both sides)
+       sorted by start, along with the event row order that sorting used"""
+    codes, _ = pd.factorize(pd.concat([samples['site_no'], events['site_no']], ignore_index=True).astype(str))
+    sample_codes, event_codes = codes[:len(samples)], codes[len(samples):]
+    times = sample_times(samples, time_col)
+    # Samples without a time are keyed below every event so they never match
+    sample_key = np.where(times.isna(), -1, time_keys(sample_codes, times.fillna(pd.Timestamp(KEY_EPOCH))))
+    start_key = time_keys(event_codes, events['start'], -window)
+    end_key = time_keys(event_codes, events['end'], window)
+    order = np.argsort(start_key, kind='stable')
+    return sample_key, start_key[order], end_key[order], order
+
+def in_events(samples: pd.DataFrame, events: pd.DataFrame, window: int=0, time_col: str='datetime'):
+    """Returns a boolean array, True for each sample taken between the start and end (inclusive, both at midnight, widened by window
+       days) of any event of its site. Same result as samples[time_col].apply(lambda x: ((x >= events['start']) & (x <= events['end'])).any())
+       per site"""
+    if samples.empty or events.empty:
+        return np.zeros(len(samples), dtype=bool)
+    sample_key, start_key, end_key, _ = event_index(samples, events, window, time_col)
+    # The last event starting at or before each sample, and the latest end of every event starting up to it. Keys of earlier sites
+    # are always lower than a sample's key, so only the sample's own site's events can reach it
+    last = np.searchsorted(start_key, sample_key, side='right') - 1
+    latest_end = np.maximum.accumulate(end_key)
+    return (last >= 0) & (latest_end[np.maximum(last, 0)] >= sample_key)
+
+def match_events(samples: pd.DataFrame, events: pd.DataFrame, window: int=0, time_col: str='datetime'):
+    """Returns one row per (sample, event) pair where the sample was taken during the event (see in_events()), the sample's columns
+       followed by the event's (event, start, end, hmf, ...). A sample within the windows of two neighbouring events is matched to both"""
+    event_cols = [col for col in events.columns if col != 'site_no']
+    if samples.empty or events.empty:
+        return pd.concat([samples.iloc[0:0], events[event_cols].iloc[0:0]], axis=1)
+    sample_key, start_key, end_key, order = event_index(samples, events, window, time_col)
+    last = np.searchsorted(start_key, sample_key, side='right') - 1
+
+    ordered = np.all(np.diff(end_key) >= 0)
+    if ordered:
+        # Events ordered by start are also ordered by end (a site's events never overlap, and widening them all by the same window keeps
+        # that), so each sample's events are the run from the first event ending at or after it to the last starting at or before it
+        first = np.searchsorted(end_key, sample_key, side='left')
+    else:
+        # Nested events, every event of the sample's site starting at or before it is a candidate
+        first = np.searchsorted(start_key, (sample_key >> TIME_BITS) << TIME_BITS, side='left')
+    counts = np.maximum(last - first + 1, 0)
+    sample_pos = np.repeat(np.arange(len(samples)), counts)
+    event_pos = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    if not ordered:
+        keep = end_key[event_pos] >= sample_key[sample_pos]
+        sample_pos, event_pos = sample_pos[keep], event_pos[keep]
+
+    left = samples.iloc[sample_pos].reset_index(drop=True)
+    right = events[event_cols].iloc[order[event_pos]].reset_index(drop=True)
+    right.columns = [f'{col}_event' if col in left.columns else col for col in right.columns]
+    return pd.concat([left, right], axis=1)
+
+def overlap_summary(samples: pd.DataFrame, events: pd.DataFrame, window: int=0, time_col: str='datetime'):
+    """Returns per site counts of samples, samples taken during an event (see in_events()) and events with at least one sample"""
+    matched = match_events(samples[['site_no', time_col]], events[['site_no', 'event', 'start', 'end']], window, time_col)
+    df = pd.DataFrame({'site_no': samples['site_no'].astype(str), 'event_sample': in_events(samples, events, window, time_col)})
+    summary = df.groupby('site_no').agg(samples=('event_sample', 'size'), event_samples=('event_sample', 'sum'))
+    summary['event_sample%'] = (summary['event_samples'] / summary['samples'] * 100).round(2)
+    summary['events'] = events.groupby(events['site_no'].astype(str)).size().reindex(summary.index, fill_value=0)
+    summary['events_sampled'] = matched.groupby(matched['site_no'].astype(str))['event'].nunique().reindex(summary.index, fill_value=0)
+    return summary.reset_index()
+
+#-----------------------------------#
+#-------# OFFLINE BENCHMARK #-------#
+#-----------------------------------#
+
+def synthetic_sites(num_sites: int=500, samples_per_site: int=400, events_per_site: int=150, seed: int=0):
+    """Returns samples (UTC times with an offset, as qwdata returns them) and non-overlapping daily events over WQ_START-WQ_END for
+       num_sites sites"""
+    rng = np.random.default_rng(seed)
+    days = (np.datetime64(WQ_END) - np.datetime64(WQ_START)).astype(int)
+    sample_frames, event_frames = [], []
+    for i in range(num_sites):
+        site = f'{i:08d}'
+        times = np.datetime64(WQ_START, 's') + np.sort(rng.integers(0, days * fn.SEC_PER_DAY, samples_per_site))
+        sample_frames.append(pd.DataFrame({'site_no': site, 'datetime': pd.to_datetime(times).tz_localize('UTC').astype(str),
+                                           'p00010': rng.normal(15, 5, samples_per_site)}))
+        # Events are separated by at least a day, as fn.events_table() produces them
+        gaps = rng.integers(2, 2 * days // events_per_site, events_per_site)
+        durations = rng.integers(1, 20, events_per_site)
+        starts = np.datetime64(WQ_START) + np.cumsum(gaps + np.r_[0, durations[:-1]])
+        event_frames.append(pd.DataFrame({'site_no': site, 'event': np.arange(1, events_per_site + 1), 'start': pd.to_datetime(starts),
+                                          'end': pd.to_datetime(starts + durations - 1), 'hmf': rng.random(events_per_site)}))
+    return pd.concat(sample_frames, ignore_index=True), pd.concat(event_frames, ignore_index=True)
+
+def apply_overlap(samples: pd.DataFrame, events: pd.DataFrame, window: int=0):
+    """The notebook's per-site apply, kept for comparison"""
+    mask = pd.Series(False, index=samples.index)
+    delta = pd.Timedelta(days=window)
+    for site, df_site in samples.groupby('site_no'):
+        df_hmf = events[events['site_no'] == site]
+        times = sample_times(df_site)
+        mask[df_site.index] = times.apply(lambda x: ((x >= df_hmf['start'] - delta) & (x <= df_hmf['end'] + delta)).any())
+    return mask.to_numpy()
+
+def benchmark(num_sites: int=500, window: int=0, apply_sites: int=25):
+    """Times in_events()/match_events() over every site against the per-sample apply (on apply_sites sites, extrapolated), and checks
+       both mark the same samples"""
+    samples, events = synthetic_sites(num_sites)
+    start = time.perf_counter()
+    mask = in_events(samples, events, window)
+    mask_time = time.perf_counter() - start
+    start = time.perf_counter()
+    matched = match_events(samples, events, window)
+    match_time = time.perf_counter() - start
+
+    subset = samples['site_no'].isin(samples['site_no'].unique()[:apply_sites]).to_numpy()
+    start = time.perf_counter()
+    expected = apply_overlap(samples[subset], events, window)
+    apply_time = (time.perf_counter() - start) * num_sites / apply_sites
+    pairs = set(zip(matched['site_no'], matched['datetime'], matched['event']))
+    consistent = len(pairs) == len(matched) and matched['datetime'].nunique() <= mask.sum()
+    print(f'{len(samples)} samples, {len(events)} events over {num_sites} sites, window {window} days')
+    print(f'in_events: {mask_time:.3f}s, match_events: {match_time:.3f}s ({len(matched)} pairs), apply: ~{apply_time:.1f}s '
+          f'({apply_time / mask_time:.0f}x), same samples: {bool(np.array_equal(mask[subset], expected))}, pairs consistent: {consistent}')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 2:
+        print('Usage: python -m Src.water_quality [num_sites] [window]')
+        sys.exit(1)
+    benchmark(int(args[0]) if args else 500, int(args[1]) if len(args) > 1 else 0)